@@ -0,0 +1,208 @@
+import argparse, json, os, platform, random, statistics, sys, time
+import openpyxl
+import loader
+
+# Benchmarks for the loader and search hot paths, run against synthetic spellbooks
+#   python bench.py --sizes 1k,10k --output bench_results.json --baseline old_results.json
+
+HEADERS = ['Spell', 'Level', 'Origin', 'Sch', 'Ritual', 'Time', 'Range', 'Comp', 'Components', 'Duration'] \
+    + loader.all_classes + ['Full Description/Flavour Text']
+
+SIZES = {"1k": 1000, "10k": 10000, "100k": 100000, "1m": 1000000}
+DEFAULT_SIZES = "1k,10k,100k,1m"
+DEFAULT_DATA_DIR = "bench_data"
+DEFAULT_OUTPUT = "bench_results.json"
+
+WORKBOOK_LIMIT = 10000 # openpyxl parsing the sheet dominates from_workbook, above this it takes too long to be worth running
+MIN_BENCH_TIME = 0.5   # Seconds. Cheap operations are repeated until they have run for at least this long
+MAX_REPEATS = 20
+
+NAME_PREFIXES = ["Arcane", "Blazing", "Chilling", "Divine", "Eldritch", "Frozen", "Greater", "Hungry", "Lesser", "Mass",
+                 "Mystic", "Otherworldly", "Radiant", "Shadow", "Spectral", "Thundering", "Vampiric", "Wild"]
+NAME_NOUNS = ["Armour", "Barrier", "Blade", "Bolt", "Chains", "Cloud", "Eye", "Fist", "Gate", "Hand", "Lance", "Missile",
+              "Orb", "Shield", "Step", "Storm", "Touch", "Ward", "Whip", "Word"]
+ORIGINS = ["PHB", "XGE", "TCE", "Homebrew", "Setting"]
+SCHOOLS = ["Abj", "Con", "Div", "Enc", "Evo", "Ill", "Nec", "Tra"]
+TIMES = ["1 action", "1 bonus action", "1 reaction", "1 minute", "10 minutes", "1 hour", "8 hours"]
+RANGES = ["Self", "Touch", "5 feet", "30 feet", "60 feet", "90 feet", "120 feet", "150 feet", "300 feet", "1 mile", "Sight", "Unlimited"]
+COMPS = ["V", "S", "V, S", "V, M", "S, M", "V, S, M"]
+MATERIALS = ["a pinch of sulfur", "a bit of bat fur", "a diamond worth 300 gp", "a sprig of mistletoe", "a tiny bell"]
+DURATIONS = ["Instantaneous", "1 round", "1 minute", "Concentration, up to 1 minute", "Concentration, up to 10 minutes",
+             "1 hour", "Concentration, up to 1 hour", "8 hours", "24 hours", "Until dispelled"]
+WORDS = ("a the creature you target within range must make saving throw on failed save takes damage half as much "
+         "on successful one spell ends if concentration is broken each of its turns at higher levels when cast using "
+         "slot of level or higher increases by for above first").split()
+
+def generate_row(i, rng):
+    row = {
+        'Spell': "{} {} {}".format(rng.choice(NAME_PREFIXES), rng.choice(NAME_NOUNS), i),
+        'Level': rng.randint(0, 9),
+        'Origin': rng.choice(ORIGINS),
+        'Sch': rng.choice(SCHOOLS),
+        'Ritual': "Yes" if rng.random() < 0.1 else "No",
+        'Time': rng.choice(TIMES),
+        'Range': rng.choice(RANGES),
+        'Comp': rng.choice(COMPS),
+        'Duration': rng.choice(DURATIONS),
+    }
+    row['Components'] = rng.choice(MATERIALS) if "M" in row['Comp'] else None
+    for cls in loader.all_classes:
+        row[cls] = "x" if rng.random() < 0.25 else None
+    paragraphs = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(15, 80))).capitalize() + "." for _ in range(rng.randint(1, 4))]
+    row['Full Description/Flavour Text'] = "\n".join(paragraphs)
+    return row
+
+def generate_rows(n, seed=0):
+    rng = random.Random(seed)
+    for i in range(n):
+        yield generate_row(i, rng)
+
+def generate_spellbook(n, seed=0):
+    return loader.Spellbook.from_list([loader.Spell.from_row(row) for row in generate_rows(n, seed)])
+
+def write_workbook(filename, n, seed=0):
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Spells")
+    ws.append(HEADERS)
+    for row in generate_rows(n, seed):
+        ws.append([row.get(header) for header in HEADERS])
+    wb.save(filename)
+
+def write_cache(filename, n, seed=0):
+    generate_spellbook(n, seed).to_cache(filename)
+
+def generate_tags(spellbook, seed=0, tagged_ratio=0.1):
+    rng = random.Random(seed)
+    names = ["Prepared", "Known", "Favourite", "Scroll", "Wand"]
+    tags = {}
+    for spell in spellbook.spells:
+        if rng.random() < tagged_ratio:
+            tags[spell.id] = rng.sample(names, rng.randint(1, 3))
+    return tags
+
+def data_files(data_dir, label, n, workbook=True):
+    os.makedirs(data_dir, exist_ok=True)
+    cache = os.path.join(data_dir, "spells-{}.json".format(label))
+    if not os.path.isfile(cache):
+        print("Generating", cache)
+        write_cache(cache, n)
+    if not workbook: return None, cache
+    wb = os.path.join(data_dir, "spells-{}.xlsx".format(label))
+    if not os.path.isfile(wb):
+        print("Generating", wb)
+        write_workbook(wb, n)
+    return wb, cache
+
+def measure(fn, min_time=MIN_BENCH_TIME, max_repeats=MAX_REPEATS):
+    times = []
+    total = 0
+    while len(times) < max_repeats and (total < min_time or len(times) == 0):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        times.append(elapsed)
+        total += elapsed
+    return {"min": min(times), "median": statistics.median(times), "repeats": len(times)}
+
+def tag_condition(tags, wanted):
+    # Same test TagBar.applyFilters builds
+    return lambda spell: wanted == [] or (spell.id in tags and [tag for tag in wanted if tag in tags[spell.id]] == wanted)
+
+def bench_size(label, n, data_dir, tmp_cache):
+    results = {"rows": n}
+    wb, cache = data_files(data_dir, label, n, workbook=n <= WORKBOOK_LIMIT)
+    if wb:
+        results["from_workbook"] = measure(lambda: loader.Spellbook.from_workbook(wb), max_repeats=1)
+    results["from_cache"] = measure(lambda: loader.Spellbook.from_cache(cache))
+    spellbook = loader.Spellbook.from_cache(cache)
+    results["to_cache"] = measure(lambda: spellbook.to_cache(tmp_cache))
+    os.remove(tmp_cache)
+
+    lazy_cache = os.path.join(data_dir, "spells-{}-lazy.json".format(label))
+    results["to_cache_lazy"] = measure(lambda: loader.Spellbook.from_cache(cache).to_cache(lazy_cache, lazy_descriptions=True), max_repeats=1)
+    results["from_cache_lazy"] = measure(lambda: loader.Spellbook.from_cache(lazy_cache))
+    lazy_memory = loader.Spellbook.from_cache(lazy_cache).memory_report()
+    results["memory_lazy"] = {"total_bytes": lazy_memory["total_bytes"], "bytes_per_spell": lazy_memory["bytes_per_spell"]}
+
+    spells = spellbook.spells
+    def hash_uncached():
+        # Spells keep their hash once worked out, so it's dropped first or every repeat after the first would only time the lookup
+        for spell in spells: spell.__dict__.pop("_hash", None)
+        return [hash(spell) for spell in spells]
+    results["hash"] = measure(hash_uncached)
+    results["hash"]["per_call"] = results["hash"]["min"] / n
+
+    results["search_name"] = measure(lambda: spellbook.search(lambda x: "storm" in x.name.lower()))
+    results["search_level"] = measure(lambda: spellbook.search(lambda x: x.level == 3))
+    results["search_combined"] = measure(lambda: spellbook.search(
+        lambda x: "storm" in x.name.lower() and x.level <= 5 and x.classes["Wizard"] and x.classes["Druid"]))
+    results["search_class"] = measure(lambda: spellbook.search_class("Wizard"))
+
+    sort_keys = [("level", None, False), ("name", None, False)]
+    def sort_cold():
+        spellbook.spells = spells # New data version, so nothing is cached
+        spellbook.sort_spells(spells, sort_keys)
+    results["sort_cold"] = measure(sort_cold)
+    results["sort_cached"] = measure(lambda: spellbook.sort_spells(spells, sort_keys))
+    subset = spellbook.search(lambda x: x.level == 3)
+    results["sort_subset"] = measure(lambda: spellbook.sort_spells(subset, sort_keys))
+
+    memory = spellbook.memory_report()
+    results["memory"] = {"total_bytes": memory["total_bytes"], "bytes_per_spell": memory["bytes_per_spell"]}
+
+    tags = generate_tags(spellbook)
+    results["tag_filter"] = measure(lambda: spellbook.search(tag_condition(tags, ["Prepared"])))
+    results["tag_filter_multi"] = measure(lambda: spellbook.search(tag_condition(tags, ["Prepared", "Scroll"])))
+    return results
+
+def is_timing(value):
+    return isinstance(value, dict) and "min" in value
+
+def compare(results, baseline):
+    print("\n{:<6} {:<18} {:>12} {:>12} {:>8}".format("size", "benchmark", "baseline", "current", "ratio"))
+    for label, current in results["results"].items():
+        old = baseline["results"].get(label, {})
+        for name, value in current.items():
+            if not is_timing(value) or name not in old: continue
+            ratio = value["min"] / old[name]["min"] if old[name]["min"] else float("inf")
+            print("{:<6} {:<18} {:>11.4f}s {:>11.4f}s {:>7.2f}x".format(label, name, old[name]["min"], value["min"], ratio))
+        if "memory" in current and "memory" in old:
+            old_size, new_size = old["memory"]["bytes_per_spell"], current["memory"]["bytes_per_spell"]
+            print("{:<6} {:<18} {:>11.0f}B {:>11.0f}B {:>7.2f}x".format(label, "bytes_per_spell", old_size, new_size, new_size / old_size))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the QSpellbook loader and search paths on synthetic data")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma separated sizes out of " + ", ".join(SIZES))
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="Where generated workbooks and caches are kept between runs")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="Results file from a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+        },
+        "results": {}
+    }
+    tmp_cache = os.path.join(args.data_dir, "to_cache.tmp.json")
+    for label in args.sizes.split(","):
+        label = label.strip().lower()
+        if label not in SIZES:
+            parser.error("Unknown size " + label)
+        print("Benchmarking", label)
+        results["results"][label] = bench_size(label, SIZES[label], args.data_dir, tmp_cache)
+        for name, value in results["results"][label].items():
+            if is_timing(value):
+                print("  {:<18} {:>10.4f}s".format(name, value["min"]))
+        print("  {:<18} {:>10.0f}B".format("bytes_per_spell", results["results"][label]["memory"]["bytes_per_spell"]))
+
+    with open(args.output, "w") as f:
+        f.write(json.dumps(results, indent=2))
+    print("Results written to", args.output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.loads(f.read()))
+
+if __name__ == "__main__": main()
@@ -0,0 +1,223 @@
+import sys, html, threading
+from collections import OrderedDict
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+import instrument, persist
+from formatting import pprintClasses, pprintComp
+
+# Printable spell cards. Cards are laid out with QTextDocument and painted onto a QPdfWriter
+# by CardRenderer, a worker thread, so the main window keeps responding while hundreds render.
+# Everything is laid out in pixels at CARD_DPI and scaled to the PDF's resolution when painted.
+
+CARD_DPI = 96
+PDF_RESOLUTION = 300
+CARD_WIDTH_MM = 63 # Standard playing card
+CARD_HEIGHT_MM = 88
+CARD_PADDING = 8
+CARD_BORDER = 2
+CARD_SPACING_MM = 2
+
+BASE_FONT_PX = 12 # Text is shrunk from here until the card fits, see fit_card
+MIN_FONT_PX = 6
+FONT_FAMILY = "sans-serif"
+
+LAYOUT_CACHE_SIZE = 4000
+
+def mm_to_px(mm):
+    return mm / 25.4 * CARD_DPI
+
+def card_html(spell, tags, font_px):
+    title_px = round(font_px * 1.4)
+    meta = "Cantrip" if spell.level == 0 else "Level {}".format(spell.level)
+    if spell.school: meta += " " + html.escape(str(spell.school))
+    if spell.ritual: meta += " (ritual)"
+    parts = [
+        "<div style='font-size: {}px; font-weight: bold'>{}</div>".format(title_px, html.escape(spell.name)),
+        "<div style='font-style: italic'>{}</div>".format(meta),
+        "<table cellspacing='0' cellpadding='1' style='margin-top: 4px'>",
+    ]
+    fields = [
+        ("Time", spell.time), ("Range", spell.range), ("Duration", spell.duration),
+        ("Comp", (pprintComp(spell) or "").replace("\n", ", ")),
+        ("Classes", (pprintClasses(spell) or "").replace("\n", ", ")),
+    ]
+    if spell.id in tags: fields.append(("Tags", ", ".join(tags[spell.id])))
+    for label, value in fields:
+        if value in (None, ""): continue
+        parts.append("<tr><td><b>{}</b>&nbsp;</td><td>{}</td></tr>".format(label, html.escape(str(value))))
+    parts.append("</table><hr>")
+    for paragraph in (spell.read_description() or "").splitlines():
+        if paragraph.strip(): parts.append("<p style='margin: 0 0 3px 0'>{}</p>".format(html.escape(paragraph)))
+    return "".join(parts)
+
+def card_document(html_text, font_px, width):
+    document = QTextDocument()
+    font = QFont(FONT_FAMILY)
+    font.setPixelSize(font_px)
+    document.setDefaultFont(font)
+    document.setDocumentMargin(0)
+    document.setHtml(html_text)
+    document.setTextWidth(width)
+    return document
+
+class LayoutCache:
+    # (spell id, spell hash, tags, card size) -> (html, font px) of the fitted card. Fitting a
+    # card means laying it out at every font size until it fits, which is most of the cost of
+    # rendering, so it's only done again if the spell, its tags or the card size change
+    def __init__(self, size=LAYOUT_CACHE_SIZE):
+        self.size = size
+        self.layouts = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            layout = self.layouts.get(key)
+            if layout is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.layouts.move_to_end(key)
+            return layout
+
+    def put(self, key, layout):
+        with self.lock:
+            self.layouts[key] = layout
+            self.layouts.move_to_end(key)
+            while len(self.layouts) > self.size:
+                self.layouts.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.layouts.clear()
+
+layout_cache = LayoutCache()
+
+def fit_card(spell, tags, width, height):
+    # Largest font size the card fits at, or MIN_FONT_PX if it never fits (the rest is clipped)
+    key = (spell.id, hash(spell), tuple(tags.get(spell.id, ())), width, height)
+    layout = layout_cache.get(key)
+    if layout is not None: return layout
+    with instrument.span("cards.fit"):
+        low, high = MIN_FONT_PX, BASE_FONT_PX # Binary search, low always fits (or is the smallest there is)
+        while low < high:
+            font_px = (low + high + 1) // 2
+            if card_document(card_html(spell, tags, font_px), font_px, width).size().height() <= height:
+                low = font_px
+            else:
+                high = font_px - 1
+    layout = (card_html(spell, tags, low), low)
+    layout_cache.put(key, layout)
+    return layout
+
+class CardRenderer(QThread):
+    # Renders spells to a PDF of cards, as many to an A4 page as fit (3 x 3 at the default card size).
+    # The spells and tags are copied when it's created, so the window can carry on changing them
+    # (or reload the spellbook) while it runs
+    progress = pyqtSignal(int, int)
+    rendered = pyqtSignal(str) # QThread already has finished, which is emitted even if cancelled
+    failed = pyqtSignal(str)
+
+    def __init__(self, spells, filename, tags=None, parent=None):
+        super().__init__(parent)
+        self.spells = tuple(spells)
+        self.tags = dict(tags or {})
+        self.filename = filename
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            with instrument.span("cards.render", cards=len(self.spells)):
+                done = render_cards(self.spells, self.filename, self.tags, self.report)
+        except Exception as e: # Anything going wrong in the thread is reported back rather than lost
+            self.failed.emit(str(e))
+            return
+        if done:
+            self.rendered.emit(self.filename)
+
+    def report(self, done, total):
+        self.progress.emit(done, total)
+        return not self.cancelled
+
+class CardsCancelled(Exception):
+    pass
+
+def render_cards(spells, filename, tags=None, progress=None):
+    # Returns False if progress returned False. The cards are rendered to a temporary file that only
+    # replaces filename once they're all in it, so a cancelled or failed render leaves filename as it was
+    try:
+        with persist.atomic_path(filename) as temp:
+            if not paint_cards(spells, temp, tags or {}, progress): raise CardsCancelled()
+    except CardsCancelled:
+        return False
+    if progress: progress(len(spells), len(spells))
+    return True
+
+def paint_cards(spells, filename, tags, progress):
+    # Returns False if progress returned False. The writer is done with filename once this returns
+    writer = QPdfWriter(filename)
+    writer.setResolution(PDF_RESOLUTION)
+    writer.setPageSize(QPageSize(QPageSize.A4))
+    writer.setPageMargins(QMarginsF(0, 0, 0, 0))
+    writer.setTitle("Spell cards")
+
+    width, height = round(mm_to_px(CARD_WIDTH_MM)), round(mm_to_px(CARD_HEIGHT_MM))
+    spacing = mm_to_px(CARD_SPACING_MM)
+    page = writer.pageLayout().fullRect(QPageLayout.Millimeter)
+    page_width, page_height = mm_to_px(page.width()), mm_to_px(page.height())
+    per_row = max(1, int((page_width + spacing) // (width + spacing)))
+    per_column = max(1, int((page_height + spacing) // (height + spacing)))
+    left = (page_width - per_row * width - (per_row - 1) * spacing) / 2
+    top = (page_height - per_column * height - (per_column - 1) * spacing) / 2
+    inner_width = width - 2 * (CARD_PADDING + CARD_BORDER)
+    inner_height = height - 2 * (CARD_PADDING + CARD_BORDER)
+
+    painter = QPainter()
+    if not painter.begin(writer):
+        raise OSError("Can't write to " + filename)
+    cancelled = False
+    try:
+        painter.scale(PDF_RESOLUTION / CARD_DPI, PDF_RESOLUTION / CARD_DPI)
+        pen = QPen(Qt.black)
+        pen.setWidth(CARD_BORDER)
+        for i, spell in enumerate(spells):
+            if progress and progress(i, len(spells)) is False:
+                cancelled = True
+                break
+            slot = i % (per_row * per_column)
+            if i and slot == 0: writer.newPage()
+            x = left + (slot % per_row) * (width + spacing)
+            y = top + (slot // per_row) * (height + spacing)
+            html_text, font_px = fit_card(spell, tags, inner_width, inner_height)
+
+            painter.save()
+            painter.translate(x, y)
+            painter.setPen(pen)
+            painter.drawRoundedRect(QRectF(CARD_BORDER / 2, CARD_BORDER / 2, width - CARD_BORDER, height - CARD_BORDER), 6, 6)
+            painter.translate(CARD_PADDING + CARD_BORDER, CARD_PADDING + CARD_BORDER)
+            card_document(html_text, font_px, inner_width).drawContents(painter, QRectF(0, 0, inner_width, inner_height))
+            painter.restore()
+    finally:
+        painter.end()
+    return not cancelled
+
+def main(argv=None):
+    # python cards.py <cache or spreadsheet> <output.pdf> [class] [max level]
+    import loader
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 2:
+        print("Usage: python cards.py <source> <output.pdf> [class] [max level]")
+        return
+    app = QGuiApplication.instance() or QGuiApplication(sys.argv[:1])
+    spellbook = loader.open_spellbook(argv[0])
+    cls = argv[2] if len(argv) > 2 else None
+    level = int(argv[3]) if len(argv) > 3 else 9
+    spells = spellbook.search(lambda spell: (cls is None or spell.classes[cls]) and spell.level <= level)
+    spells = spellbook.sort_spells(spells, [("level", None, False), ("name", None, False)])
+    render_cards(spells, argv[1], progress=lambda done, total: print("\rRendered {}/{} cards".format(done, total), end=""))
+    print()
+
+if __name__ == "__main__": main()
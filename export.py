@@ -0,0 +1,137 @@
+import csv, html, io, json, os
+from formatting import pprintClasses, pprintComp
+import persist
+
+# Streaming export of spells to CSV, JSON lines, Markdown tables and HTML spell cards.
+# Each writer is a generator yielding the output a piece at a time (usually one spell),
+# so the whole export is never held in memory.
+
+# Plain, unabbreviated value of each table column
+COLUMNS = {
+    "Name": lambda spell, tags: spell.name,
+    "Level": lambda spell, tags: spell.level,
+    "Classes": lambda spell, tags: ", ".join(cls for cls, member in spell.classes.items() if member),
+    "Origin": lambda spell, tags: spell.origin,
+    "School": lambda spell, tags: spell.school,
+    "Ritual": lambda spell, tags: "Yes" if spell.ritual else "No",
+    "Time": lambda spell, tags: spell.time,
+    "Range": lambda spell, tags: spell.range,
+    "Comp": lambda spell, tags: spell.compstr + (" ({})".format(spell.components['material']) if spell.components['material'] else ""),
+    "Duration": lambda spell, tags: spell.duration,
+    "Source": lambda spell, tags: spell.__dict__.get("source"),
+    "Tag": lambda spell, tags: ", ".join(tags.get(spell.id, [])),
+    "Description": lambda spell, tags: spell.read_description(), # Without a lazy spell keeping it
+}
+
+DEFAULT_COLUMNS = [column for column in COLUMNS if column != "Source"] # Source is only filled in for merged spreadsheets
+
+EXTENSIONS = {".csv": "csv", ".jsonl": "jsonl", ".md": "markdown", ".html": "html", ".htm": "html"}
+PROGRESS_INTERVAL = 200 # Spells between progress callbacks
+
+CARD_STYLE = """body { font-family: sans-serif; display: flex; flex-wrap: wrap; gap: 12px; }
+.card { border: 2px solid #444; border-radius: 8px; padding: 10px; width: 320px; page-break-inside: avoid; }
+.card h2 { margin: 0 0 4px 0; font-size: 1.2em; }
+.card .meta { font-style: italic; margin-bottom: 6px; }
+.card dl { display: grid; grid-template-columns: auto 1fr; gap: 2px 8px; margin: 0 0 6px 0; }
+.card dt { font-weight: bold; }
+.card dd { margin: 0; }"""
+
+class ExportCancelled(Exception):
+    pass
+
+def values(spell, columns, tags):
+    return [COLUMNS[column](spell, tags) for column in columns]
+
+def csv_writer(spells, columns, tags):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    def flush():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+    writer.writerow(columns)
+    yield flush()
+    for spell in spells:
+        writer.writerow(["" if value is None else value for value in values(spell, columns, tags)])
+        yield flush()
+
+def jsonl_writer(spells, columns, tags):
+    for spell in spells:
+        yield json.dumps(dict(zip(columns, values(spell, columns, tags))), ensure_ascii=False) + "\n"
+
+def markdown_cell(value):
+    if value is None: return ""
+    return str(value).replace("|", "\\|").replace("\r", "").replace("\n", "<br>")
+
+def markdown_writer(spells, columns, tags):
+    yield "| " + " | ".join(columns) + " |\n"
+    yield "|" + "---|" * len(columns) + "\n"
+    for spell in spells:
+        yield "| " + " | ".join(markdown_cell(value) for value in values(spell, columns, tags)) + " |\n"
+
+def html_writer(spells, columns, tags):
+    yield "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>Spells</title>\n<style>\n{}\n</style></head><body>\n".format(CARD_STYLE)
+    details = [column for column in columns if column not in ("Name", "Level", "School", "Description")]
+    for spell in spells:
+        card = ["<div class=\"card\">", "<h2>{}</h2>".format(html.escape(spell.name))]
+        meta = "Cantrip" if spell.level == 0 else "Level {}".format(spell.level)
+        if "School" in columns and spell.school: meta += " " + html.escape(spell.school)
+        if spell.ritual: meta += " (ritual)"
+        card.append("<div class=\"meta\">{}</div>".format(meta))
+        card.append("<dl>")
+        for column in details:
+            if column == "Classes":
+                value = (pprintClasses(spell) or "").replace("\n", ", ")
+            elif column == "Comp":
+                value = (pprintComp(spell) or "").replace("\n", ", ")
+            else:
+                value = COLUMNS[column](spell, tags)
+            if value in (None, ""): continue
+            card.append("<dt>{}</dt><dd>{}</dd>".format(html.escape(column), html.escape(str(value))))
+        card.append("</dl>")
+        description = spell.read_description() if "Description" in columns else None
+        if description:
+            for paragraph in description.splitlines():
+                if paragraph.strip(): card.append("<p>{}</p>".format(html.escape(paragraph)))
+        card.append("</div>\n")
+        yield "\n".join(card)
+    yield "</body></html>\n"
+
+WRITERS = {"csv": csv_writer, "jsonl": jsonl_writer, "markdown": markdown_writer, "html": html_writer}
+
+def format_for(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in EXTENSIONS:
+        raise ValueError("Can't tell the export format from the extension of " + filename)
+    return EXTENSIONS[extension]
+
+def tracked(spells, total, progress):
+    # Passes spells through, calling progress(done, total) every PROGRESS_INTERVAL spells.
+    # Returning False from progress cancels the export. total is None if spells has no length
+    done = 0
+    for spell in spells:
+        if progress and done % PROGRESS_INTERVAL == 0 and progress(done, total) is False:
+            raise ExportCancelled()
+        yield spell
+        done += 1
+    if progress: progress(done, total)
+
+def export(spells, filename, fmt=None, columns=None, tags=None, progress=None):
+    # Writes spells to filename as they are produced. spells can be any iterable, including a generator.
+    # Returns False if progress cancelled the export. The spells go to a temporary file that only
+    # replaces filename once they're all written, so a cancelled or failed export leaves no partial file
+    fmt = fmt or format_for(filename)
+    columns = columns or DEFAULT_COLUMNS
+    tags = tags or {}
+    for column in columns:
+        if column not in COLUMNS: raise ValueError("Unknown column " + column)
+    total = len(spells) if hasattr(spells, "__len__") else None
+    newline = "" if fmt == "csv" else None # The csv module writes its own line endings
+    try:
+        with persist.atomic_open(filename, "w", encoding="utf-8", newline=newline) as f:
+            for chunk in WRITERS[fmt](tracked(spells, total, progress), columns, tags):
+                f.write(chunk)
+    except ExportCancelled:
+        return False
+    return True
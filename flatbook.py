@@ -0,0 +1,229 @@
+import glob, json, mmap, os, struct, sys
+from array import array
+import loader, persist
+
+# Flat, memory-mapped spellbook files, which several QSpellbook windows on one machine share.
+# The first window publishes the spellbook as a book file plus a pointer file naming the current
+# one. Later windows map the book instead of reading the JSON cache: every spell is a fixed size
+# record of references into a table of distinct values, descriptions stay in the map (and so in
+# memory once for every window), and the sort ranks of every SORT_KEYS field come precomputed.
+# A reload publishes a new book under a new stamp and moves the pointer over to it.
+#
+#   MAGIC | header offset, header length | descriptions | records | values | ranks | header (JSON)
+
+MAGIC = b"QSPBOOK\0"
+FORMAT = 1
+PREFIX = struct.Struct("<8sQQ")
+VALUE = struct.Struct("<BI") # Type, length of the encoded value that follows
+NONE, STR, INT, FLOAT, TRUE, FALSE, JSON = range(7)
+
+# Spell fields a record has a value reference for, in order. Anything else a spell has goes in "extra"
+RECORD_FIELDS = ("id", "name", "level", "origin", "school", "ritual", "time", "range", "compstr", "duration")
+COMPONENTS = ("verbal", "somantic", "material")
+
+def record_struct(class_count):
+    # Value references, then description offset and length (-1 for none), content hash, class bits
+    return struct.Struct("<{}IQq20s{}s".format(len(RECORD_FIELDS) + len(COMPONENTS) + 1, (class_count + 7) // 8))
+
+def encode_value(value):
+    if value is None: return NONE, b""
+    if value is True: return TRUE, b""
+    if value is False: return FALSE, b""
+    if type(value) == str: return STR, value.encode("utf-8")
+    if type(value) == int: return INT, str(value).encode("ascii")
+    if type(value) == float: return FLOAT, repr(value).encode("ascii")
+    return JSON, json.dumps(value).encode("utf-8")
+
+def decode_value(kind, data):
+    if kind == STR: return str(data, "utf-8")
+    if kind == INT: return int(data)
+    if kind == FLOAT: return float(data)
+    if kind == JSON: return json.loads(str(data, "utf-8"))
+    return {NONE: None, TRUE: True, FALSE: False}[kind]
+
+def pad(f):
+    # Rank arrays are 4 byte aligned
+    f.write(b"\0" * (-f.tell() % 4))
+
+def write_book(snapshot, filename, ranks=True):
+    # Without ranks the book has no precomputed sort ranks, for a reader that never sorts (see parallel.py)
+    spells = snapshot.spells
+    classes = list(spells[0].classes) if spells else list(loader.all_classes)
+    record = record_struct(len(classes))
+    values = bytearray()
+    refs = {}
+    def ref(value):
+        key = encode_value(value)
+        offset = refs.get(key)
+        if offset is None:
+            offset = refs[key] = len(values)
+            values.extend(VALUE.pack(key[0], len(key[1])))
+            values.extend(key[1])
+        return offset
+
+    with persist.atomic_open(filename, "wb") as f:
+        f.write(PREFIX.pack(MAGIC, 0, 0))
+        sections = {"descriptions": f.tell()}
+        records = bytearray()
+        for spell in spells:
+            fields = {key: value for key, value in spell.__dict__.items() if not key.startswith("_")}
+            fields.pop("description", None)
+            extra = {key: value for key, value in fields.items() if key not in RECORD_FIELDS + ("classes", "components")}
+            components = fields.get("components")
+            if type(components) != dict or list(components) != list(COMPONENTS):
+                extra["components"], components = components, {}
+            bits = 0
+            if list(spell.classes) == classes:
+                for i, member in enumerate(spell.classes.values()):
+                    if member: bits |= 1 << i
+            else:
+                extra["classes"] = dict(spell.classes)
+            description = spell.read_description()
+            if description is None:
+                offset, length = 0, -1
+            else:
+                data = description.encode("utf-8")
+                offset, length = f.tell(), len(data)
+                f.write(data)
+            records.extend(record.pack(
+                *[ref(fields.get(key)) for key in RECORD_FIELDS], *[ref(components.get(key)) for key in COMPONENTS],
+                ref(extra or None), offset, length, spell.__hash__().to_bytes(20, "big"), bits.to_bytes((len(classes) + 7) // 8, "little")))
+        sections["records"] = [f.tell(), len(records)]
+        f.write(records)
+        sections["values"] = [f.tell(), len(values)]
+        f.write(values)
+        offsets = {}
+        for key in loader.SORT_KEYS if ranks else ():
+            pad(f)
+            offsets[key] = f.tell()
+            f.write(array("I", snapshot.sort_ranks(key)).tobytes())
+        header = json.dumps({
+            "format": FORMAT, "byteorder": sys.byteorder, "count": len(spells), "classes": classes,
+            "sections": sections, "ranks": offsets,
+        }).encode("utf-8")
+        header_offset = f.tell()
+        f.write(header)
+        f.seek(0)
+        f.write(PREFIX.pack(MAGIC, header_offset, len(header)))
+
+class FlatBook:
+    # A mapped book file. Spells read from it refer back to it for their descriptions, which is
+    # what keeps it open, see loader.Spell.__getattr__
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_offset, header_length = PREFIX.unpack_from(self.map, 0)
+        if magic != MAGIC: raise ValueError(filename + " isn't a spellbook file")
+        self.header = json.loads(self.map[header_offset:header_offset + header_length])
+        if self.header["format"] != FORMAT or self.header["byteorder"] != sys.byteorder:
+            raise ValueError(filename + " was written by a different version or machine")
+        self.count = self.header["count"]
+        self.classes = self.header["classes"]
+        self.sections = self.header["sections"]
+
+    def read(self, offset, length):
+        if length < 0: return None
+        return self.map[offset:offset + length].decode("utf-8")
+
+    def preview(self, offset, length, chars):
+        if length <= 0: return self.read(offset, length)
+        return self.map[offset:offset + min(length, chars * 4)].decode("utf-8", errors="ignore")[:chars]
+
+    def values(self):
+        # Every distinct value, by reference. There are few enough (names and ids are most of them)
+        # to decode them all at once, and each is then held once however many spells have it
+        data = self.map
+        start, length = self.sections["values"]
+        values = {}
+        position = start
+        while position < start + length:
+            kind, size = VALUE.unpack_from(data, position)
+            begin = position + VALUE.size
+            values[position - start] = decode_value(kind, data[begin:begin + size])
+            position = begin + size
+        return values
+
+    def spells(self, first=0, last=None):
+        # Spells first to last (exclusive), all of them by default
+        record = record_struct(len(self.classes))
+        start, length = self.sections["records"]
+        last = self.count if last is None else min(last, self.count)
+        start, length = start + first * record.size, max(0, last - first) * record.size
+        value = self.values().__getitem__
+        fields_end = len(RECORD_FIELDS)
+        components_end = fields_end + len(COMPONENTS)
+        # Spells with the same classes or components share one (unchanging) dict of them
+        memberships = {}
+        components = {}
+        spells = []
+        for fields in record.iter_unpack(self.map[start:start + length]):
+            spell = loader.Spell()
+            attributes = spell.__dict__
+            attributes.update(zip(RECORD_FIELDS, map(value, fields[:fields_end])))
+            refs = fields[fields_end:components_end]
+            shared = components.get(refs)
+            if shared is None:
+                shared = components[refs] = dict(zip(COMPONENTS, map(value, refs)))
+            attributes["components"] = shared
+            bits = fields[-1]
+            classes = memberships.get(bits)
+            if classes is None:
+                mask = int.from_bytes(bits, "little")
+                classes = memberships[bits] = loader.shared_classes({cls: bool(mask >> i & 1) for i, cls in enumerate(self.classes)})
+            attributes["classes"] = classes
+            extra = value(fields[components_end])
+            if extra:
+                attributes.update(extra)
+                if "classes" in extra: attributes["classes"] = loader.shared_classes(extra["classes"])
+            attributes["_description"] = (self, fields[-4], fields[-3])
+            attributes["_hash"] = int.from_bytes(fields[-2], "big")
+            spells.append(spell)
+        return spells
+
+    def ranks(self):
+        # Views straight into the map, sort_ranks only ever indexes them
+        count = self.count
+        return {key: memoryview(self.map)[offset:offset + 4 * count].cast("I") for key, offset in self.header["ranks"].items()}
+
+    def spellbook(self):
+        spellbook = loader.Spellbook()
+        spellbook.publish(loader.Snapshot(self.spells(), ranks=self.ranks()))
+        return spellbook
+
+def source_stamp(filename):
+    # Which version of the source (the JSON cache) a book was published from
+    if filename is None or not os.path.isfile(filename): return None
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def book_filename(pointer, stamp):
+    return "{}-{}.book".format(os.path.splitext(pointer)[0], stamp)
+
+def publish(spellbook, pointer, stamp, source=None):
+    # Writes the current spells to a new book and points pointer at it. stamp names this version,
+    # source is the file the spells came from, so attach can tell when the book is out of date
+    book = book_filename(pointer, stamp)
+    write_book(spellbook.snapshot(), book)
+    persist.atomic_write(pointer, json.dumps({"book": os.path.basename(book), "stamp": stamp, "source": source_stamp(source)}))
+    for old in glob.glob(book_filename(pointer, "*")):
+        if os.path.abspath(old) == os.path.abspath(book): continue
+        try: os.remove(old)
+        except OSError: pass # Still mapped by a window on Windows, the next publish tries again
+
+def current(pointer, source=None):
+    # The published {"book", "stamp", "source"}, or None if nothing is published or it's older than source
+    try:
+        with open(pointer) as f:
+            published = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if source is not None and published.get("source") != source_stamp(source): return None
+    return published
+
+def attach(pointer, source=None):
+    # (spellbook, stamp) of the published book, raising ValueError or OSError if there isn't a usable one
+    published = current(pointer, source)
+    if published is None: raise ValueError("No spellbook is published at " + pointer)
+    book = FlatBook(os.path.join(os.path.dirname(pointer), published["book"]))
+    return book.spellbook(), published["stamp"]
@@ -0,0 +1,60 @@
+import textwrap
+
+# Plain text formatting of spell fields, shared by the table, exports and spell cards
+
+TOOLTIP_WIDTH = 150
+
+def generateClassStr(spell):
+    classes = [x for x in spell.classes if spell.classes[x]]
+    class_str = ""
+    for cls in classes:
+        class_str += cls[:3].upper() + " "
+    return class_str[:-1]
+
+def pprintClasses(spell):
+    classes = [x for x in spell.classes if spell.classes[x]]
+    class_str = ""
+    for cls in classes:
+        class_str += cls + "\n"
+    return class_str[:-1]
+
+def generateTagStr(spell, tags):
+    if not spell.id in tags: return None
+    tag_str = ""
+    for tag in tags[spell.id]:
+        tag_stripped = ""
+        for char in tag: # Remove punctuation
+            if char.isalnum():
+                tag_stripped += char.upper()
+            if len(tag_stripped) == 3:
+                break
+        if len(tag_stripped) < 3:
+            tag_stripped = tag[:3].upper() # If punction has been removed and the tag is less than 3 chars, keep the punctuation
+        tag_str += tag_stripped + " "
+    return tag_str[:-1]
+
+def pprintTags(spell, tags):
+    if not spell.id in tags: return None
+    tag_str = ""
+    for tag in tags[spell.id]:
+        tag_str += tag + "\n"
+    return tag_str[:-1]
+
+def addLineBreaks(s):
+    # https://stackoverflow.com/a/26538082/8708443
+    newStr = '\n'.join(['\n'.join(textwrap.wrap(line, TOOLTIP_WIDTH,
+        break_long_words=False, replace_whitespace=False))
+        for line in s.splitlines() if line.strip() != ''])
+    return newStr
+
+def pprintComp(spell):
+    comp_str = ""
+    if spell.components['verbal']:
+        comp_str += "Verbal\n"
+    if spell.components['somantic']:
+        comp_str += "Somantic\n"
+    if spell.components['material']:
+        comp_str += spell.components['material'] + "\n"
+    if comp_str[-1:] == "\n": comp_str = comp_str[:-1]
+    if comp_str == "": comp_str = None
+    return comp_str
@@ -0,0 +1,87 @@
+import json, os, threading, time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+# Lightweight timing spans and counters for the slow paths of the app.
+#   with instrument.span("cache.read"): ...
+#   instrument.count("Spell.__hash__")
+# Span totals and counters are always kept, the raw events for the Chrome trace export
+# (chrome://tracing or https://ui.perfetto.dev) are kept in a bounded buffer.
+
+MAX_EVENTS = 100000
+
+_lock = threading.Lock()
+_epoch = time.perf_counter()
+_events = deque(maxlen=MAX_EVENTS)
+_spans = {}    # name -> [count, total seconds, max seconds]
+_counters = {} # name -> int
+last_span = None # (name, seconds) of the most recently finished span
+
+@contextmanager
+def span(name, **args):
+    global last_span
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        elapsed = end - start
+        with _lock:
+            stats = _spans.get(name)
+            if stats is None:
+                _spans[name] = [1, elapsed, elapsed]
+            else:
+                stats[0] += 1
+                stats[1] += elapsed
+                if elapsed > stats[2]: stats[2] = elapsed
+            _events.append((name, start, elapsed, threading.get_ident(), args))
+            last_span = (name, elapsed)
+
+def timed(name):
+    # Decorator version of span
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    # Not locked, a lost increment under contention doesn't matter for a counter like this
+    _counters[name] = _counters.get(name, 0) + n
+
+def spans():
+    with _lock:
+        return {name: {"count": c, "total": total, "mean": total / c, "max": longest} for name, (c, total, longest) in _spans.items()}
+
+def counters():
+    return dict(_counters)
+
+def reset():
+    global last_span
+    with _lock:
+        _events.clear()
+        _spans.clear()
+        _counters.clear()
+        last_span = None
+
+def chrome_trace():
+    pid = os.getpid()
+    with _lock:
+        events = list(_events)
+    trace = []
+    for name, start, elapsed, tid, args in events:
+        trace.append({
+            "name": name, "ph": "X", "pid": pid, "tid": tid,
+            "ts": (start - _epoch) * 1e6, "dur": elapsed * 1e6, "args": args
+        })
+    now = (time.perf_counter() - _epoch) * 1e6
+    for name, value in counters().items():
+        trace.append({"name": name, "ph": "C", "pid": pid, "tid": 0, "ts": now, "args": {"value": value}})
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+def export_chrome_trace(filename):
+    with open(filename, "w") as f:
+        f.write(json.dumps(chrome_trace()))
@@ -1,18 +1,498 @@
-import openpyxl, json
+import openpyxl, json, sys, os, glob, mmap, weakref, re, itertools, argparse, operator, bisect, multiprocessing, tempfile, threading
+from concurrent.futures import ProcessPoolExecutor
 from collections import OrderedDict
 from hashlib import sha1
 from pprint import pprint
+import instrument, export, tagstore, persist
 
 all_classes = ['Accursed', 'Æthera', 'Astromancer', 'Bard', 'Cleric', 'Druid', 'Inquisitor', 'Occultist', 'Odic', 'Odysseer', 'Paladin', 'Ranger', 'Runeshaper', 'Shaman', 'Sorcerer', 'Warden', 'Warlock', 'Wizard']
 default_wb = "Spells.xlsx"
 
-def read_row(ws, row):
-    spell = OrderedDict()
-    for cell in ws.iter_cols(min_row=row, max_row=row):
-        cell = cell[0]
-        header = ws[cell.column_letter+"1"].value
-        spell[header] = cell.value
-    return spell
+# Fields with only a handful of distinct values across the whole book. These are interned
+# when a spell is loaded, so every spell shares the same string objects
+SHARED_FIELDS = ("school", "origin", "time", "range", "duration", "compstr")
+
+DESCRIPTION_EXTENSION = ".desc"
+
+ID_COLUMN = "ID" # Optional spreadsheet column with a fixed ID per spell
+SPELLS_SHEET = "Spells" # The sheet a workbook's spells are read from, unless others are asked for
+SOURCE_INDEX = "sources.json" # Which version of each workbook the caches in a from_workbooks cache directory hold
+
+# Spreadsheet header of each spell field. Any other column is a class, see SheetSchema
+FIELD_HEADERS = {
+    "name": "Spell", "level": "Level", "origin": "Origin", "school": "Sch", "ritual": "Ritual", "time": "Time",
+    "range": "Range", "compstr": "Comp", "material": "Components", "duration": "Duration",
+    "description": "Full Description/Flavour Text", "id": ID_COLUMN,
+}
+REQUIRED_FIELDS = ("name", "level", "compstr")
+CLASS_MARKER = "x"
+
+# Seconds. Casting times within a round are ordered reaction < bonus action < action
+TIME_UNITS = {"reaction": 2, "bonus action": 4, "action": 6, "round": 6, "minute": 60, "hour": 3600, "day": 86400}
+DURATION_UNITS = {"round": 6, "minute": 60, "hour": 3600, "day": 86400, "week": 604800, "month": 2592000, "year": 31536000}
+RANGE_UNITS = {"foot": 1, "feet": 1, "ft": 1, "mile": 5280}
+RANGE_WORDS = {"self": 0, "touch": 5, "sight": 10**6, "unlimited": float("inf")}
+DURATION_WORDS = {"instantaneous": 0, "until dispelled": float("inf"), "permanent": float("inf")}
+
+QUANTITY_PATTERN = re.compile(r"(\d+(?:\.\d+)?)?\s*-?\s*(bonus action|[a-z]+)")
+
+def parse_quantity(text, units, words={}):
+    # First "<number> <unit>" (or bare unit/word) in text converted using units, or None if nothing matches
+    if not isinstance(text, str): return text if isinstance(text, (int, float)) else None
+    text = text.lower()
+    for word, value in words.items():
+        if text.startswith(word): return value
+    for number, unit in QUANTITY_PATTERN.findall(text):
+        unit = unit if unit in units else unit.rstrip("s")
+        if unit in units:
+            return (float(number) if number else 1) * units[unit]
+    return None
+
+def parse_time(text):
+    return parse_quantity(text, TIME_UNITS)
+
+def parse_range(text):
+    return parse_quantity(text, RANGE_UNITS, RANGE_WORDS)
+
+def parse_duration(text):
+    return parse_quantity(text, DURATION_UNITS, DURATION_WORDS)
+
+def numeric_sort_key(parse):
+    # Unparseable values sort after everything else, then by their text
+    def key(value):
+        number = parse(value)
+        return (number is None, number or 0, str(value).casefold())
+    return key
+
+def text_sort_key(value):
+    return (value is None, str(value).casefold() if value is not None else "")
+
+# Typed sort keys for the spell fields, see Spellbook.sort_spells
+SORT_KEYS = {
+    "name": lambda spell: spell.name.casefold(),
+    "level": lambda spell: spell.level,
+    "classes": lambda spell: tuple(not member for member in spell.classes.values()),
+    "origin": lambda spell: text_sort_key(spell.origin),
+    "school": lambda spell: text_sort_key(spell.school),
+    "ritual": lambda spell: not spell.ritual,
+    "time": lambda spell, key=numeric_sort_key(parse_time): key(spell.time),
+    "range": lambda spell, key=numeric_sort_key(parse_range): key(spell.range),
+    "compstr": lambda spell: text_sort_key(spell.compstr),
+    "source": lambda spell: text_sort_key(spell.__dict__.get("source")),
+    "duration": lambda spell, key=numeric_sort_key(parse_duration): key(spell.duration),
+    "description": lambda spell: text_sort_key(spell.description_preview(100)),
+}
+
+# Numeric forms of spell fields that queries can ask for a range of, see Snapshot.range_index.
+# Times and durations are in seconds, ranges in feet, as parse_time etc. give them. None where the text doesn't parse
+NUMERIC_FIELDS = {
+    "level": lambda spell: parse_quantity(spell.level, {}),
+    "time": lambda spell: parse_time(spell.time),
+    "range": lambda spell: parse_range(spell.range),
+    "duration": lambda spell: parse_duration(spell.duration),
+}
+
+def starts_with(value, word):
+    return isinstance(value, str) and value.strip().lower().startswith(word)
+
+# Properties a query can require spells to have, see Snapshot.flag_positions
+FLAGS = {
+    "concentration": lambda spell: isinstance(spell.duration, str) and "concentration" in spell.duration.lower(),
+    "ritual": lambda spell: bool(spell.ritual),
+    "self": lambda spell: starts_with(spell.range, "self"),
+    "touch": lambda spell: starts_with(spell.range, "touch"),
+}
+
+QUERY_CACHE_SIZE = 32 # Recent views whose results are kept, see QueryCache
+
+WORD_PATTERN = re.compile(r"\w+")
+
+SORT_SUBSET_RATIO = 8 # Results smaller than 1/8 of the book are sorted directly rather than filtered out of a cached order
+
+_versions = itertools.count(1)
+
+def sort_by_keys(spells, keys):
+    # Sorts with the key functions themselves, for spells without cached ranks. Same keys and order as Snapshot.sort_spells
+    spells = list(spells)
+    for key, keyfunc, descending in reversed(keys):
+        spells.sort(key=keyfunc or SORT_KEYS[key], reverse=descending)
+    return spells
+
+def spell_id(name, source_id=None):
+    # Stable identity of a spell, used to key tags. Unlike hash(spell) it doesn't change when
+    # the spell's text is edited. Without an ID column it is the spell name, ignoring case and spacing
+    if source_id is not None and str(source_id).strip() != "":
+        return "id:" + str(source_id).strip()
+    return "name:" + " ".join(name.split()).casefold()
+
+class SheetSchema:
+    # Where each field is in a sheet, worked out once from its header row. Class columns are the
+    # block from the first to the last column named after a class in all_classes, so a new class
+    # added among them is picked up, while other columns (notes, page numbers) are ignored. A sheet
+    # with none of all_classes treats every column that isn't a spell field as a class.
+    # The classes in all_classes always come first and in that order, so spells from a sheet
+    # without extra classes hash the same as they always have
+    def __init__(self, header):
+        header = [str(value).strip() if value is not None else None for value in header]
+        fields = {value: field for field, value in FIELD_HEADERS.items()}
+        known = [i for i, value in enumerate(header) if value in all_classes]
+        first, last = (known[0], known[-1]) if known else (0, len(header) - 1)
+        self.positions = {}
+        self.ignored = []
+        extra_classes = []
+        class_positions = {}
+        for i, value in enumerate(header):
+            if not value: continue
+            if value in fields:
+                self.positions.setdefault(fields[value], i)
+            elif not first <= i <= last:
+                self.ignored.append(value)
+            elif value not in class_positions:
+                class_positions[value] = i
+                if value not in all_classes: extra_classes.append(value)
+        missing = [FIELD_HEADERS[field] for field in REQUIRED_FIELDS if field not in self.positions]
+        if missing:
+            raise ValueError("The Spells sheet is missing the {} column(s)".format(", ".join(missing)))
+        self.classes = all_classes + extra_classes
+        self.class_positions = [class_positions.get(cls) for cls in self.classes]
+        self.width = len(header)
+
+    def decoder(self):
+        # Function turning a row tuple (in sheet order) into a Spell. Raises ValueError for rows that aren't a valid spell
+        field_names = list(FIELD_HEADERS)
+        present = [field for field in field_names if field in self.positions]
+        get_fields = operator.itemgetter(*(self.positions[field] for field in present))
+        class_indexes = [(cls, i) for cls, i in zip(self.classes, self.class_positions) if i is not None]
+        absent_classes = {cls: False for cls, i in zip(self.classes, self.class_positions) if i is None}
+        classes = self.classes
+        width = self.width
+
+        def decode(row):
+            if len(row) < width: row = tuple(row) + (None,) * (width - len(row))
+            values = dict.fromkeys(field_names)
+            values.update(zip(present, get_fields(row)))
+            name = values["name"]
+            if type(name) != str or not name.strip(): raise ValueError("no spell name")
+            level = values["level"]
+            if type(level) != int: raise ValueError("level {!r} isn't a whole number".format(level))
+            compstr = values["compstr"]
+            if type(compstr) != str: raise ValueError("no components")
+            membership = dict(absent_classes)
+            for cls, i in class_indexes:
+                membership[cls] = row[i] == CLASS_MARKER
+            spell = Spell()
+            spell.name = name
+            spell.id = spell_id(name, values["id"])
+            spell.classes = {cls: membership[cls] for cls in classes}
+            spell.level = level
+            spell.origin = values["origin"]
+            spell.school = values["school"]
+            spell.ritual = values["ritual"] == "Yes"
+            spell.time = values["time"]
+            spell.range = values["range"]
+            spell.compstr = compstr
+            spell.components = {
+                "verbal": True if "V" in compstr else None,
+                "somantic": True if "S" in compstr else None,
+                "material": values["material"] if "M" in compstr else None
+            }
+            spell.duration = values["duration"]
+            spell.description = values["description"]
+            spell.share_fields()
+            return spell
+        return decode
+
+def iter_rows(rows, schema, rejects, first_row=2):
+    # Spells of rows, one at a time. Rejects are {"row", "name", "reason"} for each row that couldn't be
+    # read, with row the sheet's (1 based) row number, and are appended to rejects. Empty rows are skipped without a reject
+    decode = schema.decoder()
+    name_index = schema.positions["name"]
+    for number, row in enumerate(rows, first_row):
+        try:
+            spell = decode(row)
+        except (ValueError, TypeError) as e:
+            if all(value is None or value == "" for value in row): continue
+            name = row[name_index] if name_index < len(row) else None
+            rejects.append({"row": number, "name": name, "reason": str(e)})
+            continue
+        yield spell
+
+def decode_rows(rows, schema, first_row=2):
+    # Returns (spells, rejects), see iter_rows
+    rejects = []
+    spells = list(iter_rows(rows, schema, rejects, first_row))
+    return spells, rejects
+
+def iter_cache(filename):
+    # Spells of a cache one at a time. Caches are JSON lines, a spell per line, so this only ever holds
+    # one. A lazy cache starts with a line naming its description side file. Caches from before were
+    # a single JSON list, which has to be read whole, or had their side file at description_filename
+    def legacy_store():
+        legacy = description_filename(filename)
+        return DescriptionStore(legacy) if os.path.isfile(legacy) else None
+    with open(filename) as f:
+        start = f.read(64).lstrip()
+        f.seek(0)
+        if start.startswith("["):
+            store = legacy_store()
+            for entry in json.loads(f.read()):
+                yield Spell.from_dict(entry, store)
+            return
+        lines = (line for line in f if line.strip())
+        first = next(lines, None)
+        if first is None: return
+        entry = json.loads(first)
+        if "_descriptions" in entry:
+            store = DescriptionStore(os.path.join(os.path.dirname(filename), entry["_descriptions"]))
+        else:
+            store = legacy_store()
+            yield Spell.from_dict(entry, store)
+        for line in lines:
+            yield Spell.from_dict(json.loads(line), store)
+
+def iter_spells(filename):
+    # Spells of a spreadsheet (.xlsx) or cache one at a time, see open_spellbook
+    if os.path.splitext(filename)[1].lower() == ".xlsx":
+        return iter_workbook(filename)
+    return iter_cache(filename)
+
+def write_cache(spells, filename, lazy_descriptions=False, written=None):
+    # Streams spells, any iterable of them, to a cache at filename a line at a time, so a spellbook
+    # of any size is written in constant memory. With lazy_descriptions the descriptions go to a side
+    # file and the cache only keeps their offsets, and written(spell, store, offset, length) is called for
+    # each spell once both files are in place. Returns the number of spells written.
+    # The side file has a name of its own, which the cache's first line gives. It's written in full
+    # before the cache is replaced, so the cache on disk always goes with the side file it names,
+    # whenever a reader (or a crash) comes along. Side files of earlier caches are deleted after
+    count = 0
+    if not lazy_descriptions:
+        with persist.atomic_open(filename) as f:
+            for spell in spells:
+                f.write(json.dumps(spell.to_dict()))
+                f.write("\n")
+                count += 1
+        remove_description_files(filename)
+        return count
+
+    refs = []
+    desc_filename = description_filename(filename, os.urandom(8).hex())
+    try:
+        with open(desc_filename, "wb") as desc, persist.atomic_open(filename) as f:
+            f.write(json.dumps({"_descriptions": os.path.basename(desc_filename)}))
+            f.write("\n")
+            offset = 0
+            for spell in spells:
+                description = spell.description
+                entry = spell.to_dict()
+                del entry["description"]
+                if description is None:
+                    entry["_description"] = (offset, -1)
+                else:
+                    data = description.encode("utf-8")
+                    desc.write(data)
+                    entry["_description"] = (offset, len(data))
+                    offset += len(data)
+                entry["_hash"] = hash(spell)
+                f.write(json.dumps(entry))
+                f.write("\n")
+                if written: refs.append((spell, entry["_description"]))
+                count += 1
+            desc.flush()
+            os.fsync(desc.fileno())
+    except BaseException:
+        try: os.remove(desc_filename)
+        except OSError: pass
+        raise
+    if written:
+        store = DescriptionStore(desc_filename)
+        for spell, (offset, length) in refs:
+            written(spell, store, offset, length)
+    remove_description_files(filename, desc_filename)
+    return count
+
+def remove_description_files(filename, keep=None):
+    # Side files of the cache at filename other than keep, which nothing reads any more
+    for old in description_files(filename):
+        if keep and os.path.abspath(old) == os.path.abspath(keep): continue
+        if os.name == "nt": DescriptionStore.close_all(old) # Windows won't delete a file that is still mapped
+        try: os.remove(old)
+        except OSError: pass # The next write tries again
+
+def file_stamp(filename):
+    # Changes whenever the file does
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def source_name(filename, sheet=SPELLS_SHEET):
+    # What a spell's source field says for spells read from sheet of filename
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return name if sheet == SPELLS_SHEET else "{} / {}".format(name, sheet)
+
+def iter_workbook(filename, sheets=(SPELLS_SHEET,), rejects=None, source=False):
+    # Spells of the sheets of filename with these titles one at a time, as the rows are read. With
+    # sheets None they come from every sheet whose header row has the spell columns. Rows that
+    # aren't a valid spell are appended to rejects, see iter_rows. With source each spell and reject
+    # has a source field naming its file and sheet, see source_name. Sheets with different class
+    # columns give spells with different classes, which read_workbook evens out
+    rejects = [] if rejects is None else rejects
+    wb = openpyxl.load_workbook(filename=filename, read_only=True)
+    try:
+        worksheets = {worksheet.title: worksheet for worksheet in wb.worksheets}
+        for title in sheets or ():
+            if title not in worksheets: raise ValueError("{} has no {} sheet".format(filename, title))
+        for title in sheets or list(worksheets):
+            rows = worksheets[title].iter_rows(values_only=True)
+            try:
+                schema = SheetSchema(next(rows, ()))
+            except ValueError:
+                if sheets: raise
+                continue # Not a sheet of spells
+            name = source_name(filename, title) if source else None
+            first_reject = len(rejects)
+            for spell in iter_rows(rows, schema, rejects):
+                if source: spell.source = name
+                yield spell
+            if source:
+                for reject in rejects[first_reject:]: reject["source"] = name
+    finally:
+        wb.close()
+
+def read_workbook(filename, sheets=(SPELLS_SHEET,), source=False):
+    # (spells, rejects), see iter_workbook
+    rejects = []
+    spells = unify_classes(list(iter_workbook(filename, sheets, rejects, source)))
+    instrument.count("spells.decoded", len(spells))
+    instrument.count("spells.rejected", len(rejects))
+    return spells, rejects
+
+def parse_source(filename, sheets, cache):
+    # One workbook of Spellbook.from_workbooks, parsed into its own cache. Runs in a worker process
+    spells, rejects = read_workbook(filename, sheets, source=True)
+    Spellbook.from_list(spells).to_cache(cache)
+    return rejects
+
+def unify_classes(spells):
+    # Sheets can have different class columns. Gives every spell the same classes, in the order they
+    # first appear, as everything after loading expects. Spells that already have them are left alone
+    memberships = {id(spell.classes): spell.classes for spell in spells}
+    classes = list(dict.fromkeys(cls for membership in memberships.values() for cls in membership))
+    widened = {key: shared_classes({cls: membership.get(cls, False) for cls in classes})
+               for key, membership in memberships.items() if list(membership) != classes}
+    if widened:
+        for spell in spells:
+            spell.classes = widened.get(id(spell.classes), spell.classes)
+    return spells
+
+def merge_spells(sources):
+    # The spells of every source (each a list of spells) in one list, with one spell per id. A spell
+    # from a later source replaces the one with its id from an earlier source, in the earlier one's place
+    merged = {}
+    total = 0
+    for spells in sources:
+        for spell in spells:
+            merged[spell.id] = spell
+            total += 1
+    instrument.count("spells.duplicates", total - len(merged))
+    return unify_classes(list(merged.values()))
+
+def diff_spells(old, new):
+    # (spells, added, removed, changed) going from the spells old to new, matched up by id. spells is
+    # new with every spell that didn't change swapped for its old self, so whatever holds on to those
+    # (table rows, the indexes of a patched snapshot) still applies. The others are lists of ids
+    before = {spell.id: spell for spell in old}
+    spells = []
+    added = []
+    changed = []
+    for spell in new:
+        previous = before.get(spell.id)
+        if previous is None:
+            added.append(spell.id)
+        elif hash(previous) != hash(spell) or previous.__dict__.get("source") != spell.__dict__.get("source"):
+            changed.append(spell.id)
+        else:
+            spell = previous
+        spells.append(spell)
+    present = {spell.id for spell in new}
+    removed = [spell_id for spell_id in before if spell_id not in present]
+    instrument.count("diff.changed", len(added) + len(removed) + len(changed))
+    return spells, added, removed, changed
+
+class ClassMembership(dict):
+    # Read only class -> bool mapping. Spells with the same classes share a single instance,
+    # see shared_classes(). Still a dict so json, repr (and so Spell.__hash__) are unchanged
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Class membership is shared between spells and can't be modified")
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (shared_classes, (dict(self),))
+
+_class_memberships = {}
+
+def shared_classes(classes):
+    key = tuple(classes.items())
+    membership = _class_memberships.get(key)
+    if membership is None:
+        membership = _class_memberships[key] = ClassMembership(classes)
+    return membership
+
+def deep_sizeof(obj, seen):
+    # Objects already in seen aren't counted again, so anything shared between spells is only counted once
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif isinstance(obj, Spell):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+def description_filename(cache_filename, stamp=None):
+    # Side file the descriptions of a lazy cache are kept in, next to the cache itself. Each write
+    # gets its own stamp, see write_cache. Caches from before that had one without
+    base = os.path.splitext(cache_filename)[0]
+    return base + DESCRIPTION_EXTENSION if stamp is None else "{}-{}{}".format(base, stamp, DESCRIPTION_EXTENSION)
+
+def description_files(cache_filename):
+    # Every side file there is for the cache at cache_filename, current or not
+    stamped = description_filename(glob.escape(cache_filename), "[0-9a-f]" * 16)
+    return [filename for filename in [description_filename(cache_filename)] + glob.glob(stamped) if os.path.isfile(filename)]
+
+class DescriptionStore:
+    # Read only, memory-mapped view of a description side file. Spells only keep an
+    # (offset, length) reference into it, see Spell.__getattr__
+    _open = weakref.WeakSet()
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.file = open(filename, "rb")
+        # mmap can't map an empty file, which is what you get if no spell has a description
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(filename) else None
+        DescriptionStore._open.add(self)
+
+    def read(self, offset, length):
+        if length < 0: return None
+        if length == 0: return ""
+        return self.map[offset:offset + length].decode("utf-8")
+
+    def preview(self, offset, length, chars):
+        # Only the start of the description is read. A cut multi-byte character at the end is dropped
+        if length <= 0: return self.read(offset, length)
+        data = self.map[offset:offset + min(length, chars * 4)]
+        return data.decode("utf-8", errors="ignore")[:chars]
+
+    def close(self):
+        if self.map: self.map.close()
+        self.file.close()
+        DescriptionStore._open.discard(self)
+
+    @classmethod
+    def close_all(cls, filename):
+        filename = os.path.abspath(filename)
+        for store in list(cls._open):
+            if store.filename == filename: store.close()
 
 class Spell:
     def __init__(self):
@@ -23,6 +503,7 @@ class Spell:
         spell = cls()
         spell.name = row['Spell']
         assert type(spell.name) == str and len(spell.name) > 0
+        spell.id = spell_id(spell.name, row.get(ID_COLUMN))
         # Fancy dict comprehension. Reads through all classes, True if an x is listed, False otherwise
         spell.classes = {cls: row.get(cls, False) == "x" for cls in all_classes}
         spell.level = row['Level']
@@ -42,28 +523,611 @@ class Spell:
 
         spell.duration = row['Duration']
         spell.description = row['Full Description/Flavour Text']
+        spell.share_fields()
         return spell
 
     @classmethod
-    def from_dict(cls, data):
+    def from_dict(cls, data, store=None):
         spell = cls()
         for key in data:
             spell.__setattr__(key, data[key])
+        if "_description" in data:
+            if store is None: raise ValueError("Spell {} has its description in a side file, but no side file was given".format(spell.name))
+            offset, length = data["_description"]
+            spell._description = (store, offset, length)
+        if "id" not in data: # Caches from before spells had IDs
+            spell.id = spell_id(spell.name)
+        spell.share_fields()
         return spell
 
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set. For a spell loaded from a lazy cache that
+        # includes description, which is read from the side file on first use and then kept
+        if name == "description" and "_description" in self.__dict__:
+            store, offset, length = self.__dict__["_description"]
+            self.description = store.read(offset, length)
+            return self.description
+        raise AttributeError(name)
+
+    def read_description(self):
+        # The description, without a lazy spell keeping a copy of it
+        if "description" not in self.__dict__ and "_description" in self.__dict__:
+            store, offset, length = self._description
+            return store.read(offset, length)
+        return self.description
+
+    def description_preview(self, chars):
+        # The first chars characters of the description, without loading the rest of a lazy description
+        if "description" not in self.__dict__ and "_description" in self.__dict__:
+            store, offset, length = self._description
+            return store.preview(offset, length, chars)
+        return self.description[:chars] if self.description else self.description
+
+    def unload_description(self, store, offset, length):
+        # The reference is set first, so another thread reading the description always finds one or the other
+        self._description = (store, offset, length)
+        self.__dict__.pop("description", None)
+
+    def to_dict(self):
+        # Underscore attributes are bookkeeping (cached hash, lazy description reference) rather than spell data
+        data = {key: value for key, value in self.__dict__.items() if not key.startswith("_")}
+        if "_description" in self.__dict__:
+            data["description"] = self.description
+        return data
+
+    def share_fields(self):
+        for field in SHARED_FIELDS:
+            value = self.__dict__.get(field)
+            if type(value) == str:
+                self.__dict__[field] = sys.intern(value)
+        if "classes" in self.__dict__:
+            self.classes = shared_classes(self.classes)
+
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return self.to_dict() == other.to_dict()
 
     def __repr__(self):
         return self.name
 
     def __hash__(self): # https://stackoverflow.com/questions/5884066/hashing-a-dictionary
-        return int(sha1(repr(sorted(self.__dict__.items())).encode("utf-8")).hexdigest(), 16)
+        # A hash of the spell's content, which old tag files are keyed by. The id is left out so
+        # these hashes are the same as they were before spells had one, and the source so a spell
+        # hashes the same whichever workbook it was read from.
+        # Spells aren't changed after loading, so the hash is worked out once. Lazy caches store
+        # it, so hashing doesn't have to read the description
+        if "_hash" not in self.__dict__:
+            instrument.count("Spell.__hash__") # Only hashes worked out, a cached one is just the lookup
+            data = self.to_dict()
+            data.pop("id", None)
+            data.pop("source", None)
+            self._hash = int(sha1(repr(sorted(data.items())).encode("utf-8")).hexdigest(), 16)
+        return self._hash
+
+def distance_from(pattern):
+    # Levenshtein distance function from pattern, using Myers' bit-parallel algorithm: each
+    # character of the other string is one step of integer operations over all of pattern at once
+    m = len(pattern)
+    if m == 0: return len
+    peq = {}
+    for i, char in enumerate(pattern):
+        peq[char] = peq.get(char, 0) | (1 << i)
+    mask = (1 << m) - 1
+    last = 1 << (m - 1)
+    def distance(text):
+        pv, mv, score = mask, 0, m
+        for char in text:
+            eq = peq.get(char, 0)
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | (~(xh | pv) & mask)
+            mh = pv & xh
+            if ph & last: score += 1
+            elif mh & last: score -= 1
+            ph = ((ph << 1) | 1) & mask
+            mh = (mh << 1) & mask
+            pv = mh | (~(xv | ph) & mask)
+            mv = ph & xv
+        return score
+    return distance
+
+def edit_distance(a, b):
+    return distance_from(a)(b)
+
+def fuzzy_tolerance(word):
+    # Typos allowed in a word of this length
+    if len(word) <= 2: return 0
+    if len(word) <= 4: return 1
+    return 2
+
+class BKTree:
+    # Burkhard-Keller tree of strings by edit distance. Searching only follows children whose
+    # distance to their parent is within max_distance of the target's, so most of the tree is never compared
+    def __init__(self, words=()):
+        self.root = None
+        self.size = 0
+        for word in words: self.add(word)
+
+    def add(self, word):
+        if self.root is None:
+            self.root = (word, {})
+            self.size = 1
+            return
+        node = self.root
+        distance_to = distance_from(word)
+        while True:
+            distance = distance_to(node[0])
+            if distance == 0: return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (word, {})
+                self.size += 1
+                return
+            node = child
+
+    def search(self, word, max_distance):
+        # [(distance, word)] for every word within max_distance of word
+        if self.root is None: return []
+        found = []
+        stack = [self.root]
+        distance_to = distance_from(word)
+        while stack:
+            node_word, children = stack.pop()
+            distance = distance_to(node_word)
+            if distance <= max_distance: found.append((distance, node_word))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+class FuzzyIndex:
+    # BK-tree over the words in spell names, see Spellbook.fuzzy_search. Numbers are only
+    # matched exactly, "Symbol 2" isn't a typo of "Symbol 3"
+    def __init__(self, spells):
+        self.names = {}
+        self.words = {}
+        for i, spell in enumerate(spells):
+            name = " ".join(WORD_PATTERN.findall(spell.name.lower()))
+            self.names.setdefault(name, []).append(i)
+            for word in set(name.split()):
+                self.words.setdefault(word, []).append(i)
+        with instrument.span("fuzzy.build"):
+            self.word_tree = BKTree(word for word in self.words if not word.isdigit())
+
+    def matches(self, word, max_distance):
+        if word.isdigit():
+            return [(0, word)] if word in self.words else []
+        return self.word_tree.search(word, fuzzy_tolerance(word) if max_distance is None else max_distance)
+
+    def search(self, text, max_distance=None):
+        # {spell position: distance}. Every word in text has to be close to a word in the name,
+        # and the distance is their total. The last word may be half typed, so words it is the start
+        # of are distance 0, as are names containing text as it is typed
+        text = " ".join(WORD_PATTERN.findall(text.lower()))
+        if not text: return {}
+        distances = None
+        words = text.split()
+        for n, word in enumerate(words):
+            found = self.matches(word, max_distance)
+            if n == len(words) - 1:
+                found += [(0, match) for match in self.words if match.startswith(word)]
+            matches = {}
+            for distance, match in found:
+                for i in self.words[match]:
+                    if distance < matches.get(i, distance + 1): matches[i] = distance
+            if distances is None:
+                distances = matches
+            else:
+                distances = {i: distances[i] + distance for i, distance in matches.items() if i in distances}
+        if max_distance is not None:
+            distances = {i: distance for i, distance in distances.items() if distance <= max_distance}
+        for name, positions in self.names.items():
+            if text in name:
+                for i in positions: distances[i] = 0
+        return distances
+
+class Query:
+    # A view of the spellbook: spells whose name contains name, of level (if not None), in every one
+    # of classes and with every one of tags. Normalized, so queries giving the same spells compare equal.
+    # With fuzzy the name is matched allowing for typos, and the results are ordered closest first.
+    # ranges narrows it to spells with NUMERIC_FIELDS in ranges, {field: (low, high)} with either
+    # bound None for no limit, flags to spells with every one of flags (see FLAGS), and text to
+    # spells with it in their description. sources narrows it to spells from any one of sources (see source_name)
+    def __init__(self, name="", level=None, classes=(), tags=(), fuzzy=False, ranges=None, flags=(), text="", sources=()):
+        self.name = name.strip().lower()
+        self.level = level
+        self.classes = tuple(sorted(set(classes)))
+        self.tags = tuple(sorted(set(tags)))
+        self.fuzzy = bool(fuzzy and self.name)
+        ranges = dict(ranges or {})
+        if level is not None: ranges["level"] = (level, level)
+        for field in ranges:
+            if field not in NUMERIC_FIELDS: raise ValueError("Unknown range field " + str(field))
+        self.ranges = tuple(sorted((field, low, high) for field, (low, high) in ranges.items() if (low, high) != (None, None)))
+        for flag in flags:
+            if flag not in FLAGS: raise ValueError("Unknown flag " + str(flag))
+        self.flags = tuple(sorted(set(flags)))
+        self.text = text.strip().casefold()
+        self.sources = tuple(sorted(set(sources)))
+        self.key = (self.name, self.ranges, self.classes, self.tags, self.flags, self.text, self.sources, self.fuzzy)
+
+    @property
+    def ordered(self):
+        # Whether results are in a meaningful order of their own, rather than spellbook order
+        return self.fuzzy
+
+    def __eq__(self, other):
+        return isinstance(other, Query) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return "Query{}".format(self.key)
+
+    def run(self, spellbook, tags=None):
+        snapshot = spellbook.snapshot()
+        if snapshot.parallel is not None and not self.fuzzy and snapshot.parallel.ready():
+            spells = snapshot.parallel.run(self, tags)
+            if spells is not None: return spells # Otherwise the worker processes have gone, and it's searched here
+        if self.ranges or self.flags:
+            # Bisecting the range indexes narrows it down first, so only those spells are tested
+            selected = snapshot.select(self.ranges, self.flags)
+            if self.fuzzy:
+                selected = set(selected)
+                positions = snapshot.positions()
+                condition = self.condition(tags, name=False)
+                return [spell for spell in snapshot.fuzzy_search(self.name) if positions[id(spell)] in selected and condition(spell)]
+            condition = self.condition(tags)
+            spells = snapshot.spells
+            return [spells[i] for i in selected if condition(spells[i])]
+        if not self.fuzzy:
+            return snapshot.search(self.condition(tags))
+        condition = self.condition(tags, name=False)
+        return [spell for spell in snapshot.fuzzy_search(self.name) if condition(spell)]
+
+    def condition(self, tags=None, name=True):
+        # Tests everything but ranges and flags, which run answers from the snapshot's indexes
+        name, classes, wanted, text = self.name if name else "", self.classes, self.tags, self.text
+        sources = set(self.sources)
+        tags = tags or {}
+        def condition(spell):
+            if name and name not in spell.name.lower(): return False
+            if sources and spell.__dict__.get("source") not in sources: return False
+            for cls in classes:
+                if not spell.classes[cls]: return False
+            if wanted:
+                spell_tags = tags.get(spell.id)
+                if spell_tags is None: return False
+                for tag in wanted:
+                    if tag not in spell_tags: return False
+            if text and text not in (spell.read_description() or "").casefold(): return False
+            return True
+        return condition
+
+class QueryCache:
+    # Bounded LRU of query results. Entries are keyed by the query, and only hold for one spellbook
+    # version and tag version: the first lookup after either changes empties the cache.
+    # The results are shared between lookups, so callers mustn't modify them. Threads can share one:
+    # lookups are locked, but a query runs outside the lock, so queries on different threads run side by side
+    def __init__(self, size=QUERY_CACHE_SIZE):
+        self.size = size
+        self.results = OrderedDict()
+        self.version = None
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def search(self, spellbook, query, tags=None, tag_version=0):
+        snapshot = spellbook.snapshot() # So the version and results can't come from different spells
+        version = (snapshot.version, tag_version)
+        with self.lock:
+            if version != self.version:
+                if self.results: self.invalidations += 1
+                self.results.clear()
+                self.version = version
+            results = self.results.get(query)
+            if results is not None:
+                self.hits += 1
+                instrument.count("query.hit")
+                self.results.move_to_end(query)
+                return results
+            self.misses += 1
+        instrument.count("query.miss")
+        results = query.run(snapshot, tags)
+        with self.lock:
+            if version == self.version: # Not if the spellbook or tags changed while it ran
+                self.results[query] = results
+                while len(self.results) > self.size:
+                    self.results.popitem(last=False)
+                    self.evictions += 1
+        return results
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.version = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.results), "capacity": self.size, "hits": self.hits, "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0, "evictions": self.evictions, "invalidations": self.invalidations,
+        }
+
+class RangeIndex:
+    # Positions of spells ordered by one numeric field, so the spells with it in a range are found
+    # by bisecting. Spells whose field didn't parse are left out
+    def __init__(self, values):
+        self.positions = sorted((i for i, value in enumerate(values) if value is not None), key=values.__getitem__)
+        self.values = [values[i] for i in self.positions]
+
+    def between(self, low=None, high=None):
+        # Positions of spells with low <= value <= high, either bound None for no limit
+        start = 0 if low is None else bisect.bisect_left(self.values, low)
+        end = len(self.values) if high is None else bisect.bisect_right(self.values, high)
+        return self.positions[start:end]
+
+    def replaced(self, changes):
+        # A copy with the values of some positions changed, changes being {position: (old value, new value)}.
+        # Equal values stay in position order, so this is the same as building it again from every value
+        index = RangeIndex(())
+        index.positions, index.values = list(self.positions), list(self.values)
+        for i, (before, after) in changes.items():
+            if before is not None:
+                start = bisect.bisect_left(index.values, before)
+                at = bisect.bisect_left(index.positions, i, start, bisect.bisect_right(index.values, before))
+                del index.positions[at], index.values[at]
+            if after is not None:
+                start = bisect.bisect_left(index.values, after)
+                at = bisect.bisect_left(index.positions, i, start, bisect.bisect_right(index.values, after))
+                index.positions.insert(at, i)
+                index.values.insert(at, after)
+        return index
+
+class Snapshot:
+    # One version of a spellbook's spells, which never changes once made. The indexes (positions,
+    # sort ranks and orders, range indexes, the fuzzy index) are built from the spells on first use and belong to
+    # the snapshot, so a reader holding one, on any thread, sees the same spells and indexes
+    # however often the spellbook is reloaded. Two threads building the same index at once both
+    # get identical results, so that needs no lock either
+    def __init__(self, spells=(), rejects=(), ranks=None):
+        # ranks are sort_ranks worked out beforehand, {key: ranks}, as a flat spellbook (see flatbook.py) has them
+        self.spells = tuple(spells)
+        self.rejects = tuple(rejects)
+        self.version = next(_versions)
+        self._sort_cache = {("ranks", key): value for key, value in (ranks or {}).items()}
+        self._positions = None
+        self._ids = None
+        self._fuzzy = None
+        self._ranges = {}
+        self._flags = {}
+        self.parallel = None # Sharded search over worker processes, which parallel.attach gives big spellbooks
+
+    def snapshot(self):
+        return self
+
+    def prepare(self, keys=()):
+        # Builds the indexes a view sorted by keys needs, and the range indexes, so they're ready before the snapshot is published
+        self.positions()
+        if keys: self.sort_order(keys)
+        for field in NUMERIC_FIELDS: self.range_index(field)
+        return self
+
+    @instrument.timed("snapshot.patch")
+    def patched(self, spells, rejects=()):
+        # A new snapshot of spells (see diff_spells), keeping what it can of this one's indexes. When
+        # the ids are the same and in the same order, only the entries of the spells that changed are
+        # updated, and sort ranks and the fuzzy index are kept if no value they're built from changed.
+        # Spells added, removed or moved get a snapshot that builds its indexes afresh
+        snapshot = Snapshot(spells, rejects)
+        if len(spells) != len(self.spells) or any(a.id != b.id for a, b in zip(self.spells, spells)):
+            return snapshot
+        changed = [(i, a, b) for i, (a, b) in enumerate(zip(self.spells, spells)) if a is not b]
+        if self._positions is not None:
+            positions = snapshot._positions = dict(self._positions)
+            for i, before, after in changed:
+                del positions[id(before)]
+                positions[id(after)] = i
+        if self._ids is not None:
+            snapshot._ids = dict(self._ids)
+            snapshot._ids.update((after.id, after) for _, _, after in changed)
+        for field, index in self._ranges.items():
+            parse = NUMERIC_FIELDS[field]
+            changes = {i: (parse(before), parse(after)) for i, before, after in changed}
+            changes = {i: values for i, values in changes.items() if values[0] != values[1]}
+            snapshot._ranges[field] = index.replaced(changes) if changes else index
+        for flag, flagged in self._flags.items():
+            has_flag = FLAGS[flag]
+            flagged = set(flagged)
+            for i, _, after in changed:
+                if has_flag(after): flagged.add(i)
+                else: flagged.discard(i)
+            snapshot._flags[flag] = sorted(flagged)
+        if all(before.name == after.name for _, before, after in changed):
+            snapshot._fuzzy = self._fuzzy
+        # Ranks of keys that come from outside the spellbook (tags) can't be checked, so only SORT_KEYS are kept
+        kept = {key for key in SORT_KEYS if all(SORT_KEYS[key](before) == SORT_KEYS[key](after) for _, before, after in changed)}
+        for cache_key, value in self._sort_cache.items():
+            keys = [cache_key[1]] if cache_key[0] == "ranks" else [key for key, _ in cache_key[1:]]
+            if all(key in kept for key in keys): snapshot._sort_cache[cache_key] = value
+        return snapshot
+
+    @instrument.timed("search")
+    def search(self, condition):
+        return [x for x in self.spells if condition(x)]
+
+    @instrument.timed("search")
+    def search_class(self, cls):
+        assert not self.spells or cls in self.spells[0].classes
+        return [x for x in self.spells if x.classes[cls]]
+
+    @instrument.timed("search.fuzzy")
+    def fuzzy_search(self, text, max_distance=None):
+        # Spells whose names are close to text, closest first. max_distance defaults to more
+        # typos for longer text. The index is built on first use and kept until the spells change
+        if self._fuzzy is None:
+            self._fuzzy = FuzzyIndex(self.spells)
+        distances = self._fuzzy.search(text, max_distance)
+        order = sorted(distances, key=lambda i: (distances[i], self.spells[i].name.lower(), i))
+        return [self.spells[i] for i in order]
+
+    def positions(self):
+        if self._positions is None:
+            self._positions = {id(spell): i for i, spell in enumerate(self.spells)}
+        return self._positions
+
+    def by_id(self):
+        # Spell ids are unique within a spellbook, see spell_id
+        if self._ids is None:
+            self._ids = {spell.id: spell for spell in self.spells}
+        return self._ids
+
+    def range_index(self, field):
+        # Each NUMERIC_FIELDS field is parsed once per snapshot, into its RangeIndex
+        index = self._ranges.get(field)
+        if index is None:
+            with instrument.span("index.range", field=field):
+                parse = NUMERIC_FIELDS[field]
+                index = self._ranges[field] = RangeIndex([parse(spell) for spell in self.spells])
+        return index
+
+    def flag_positions(self, flag):
+        positions = self._flags.get(flag)
+        if positions is None:
+            has_flag = FLAGS[flag]
+            positions = self._flags[flag] = [i for i, spell in enumerate(self.spells) if has_flag(spell)]
+        return positions
+
+    @instrument.timed("search.ranges")
+    def select(self, ranges=(), flags=()):
+        # Positions, in spellbook order, of spells with every (field, low, high) of ranges within
+        # [low, high] and every one of flags. Starts from the fewest matches and intersects the rest into them
+        matches = [self.range_index(field).between(low, high) for field, low, high in ranges]
+        matches += [self.flag_positions(flag) for flag in flags]
+        if not matches: return list(range(len(self.spells)))
+        matches.sort(key=len)
+        selected = set(matches[0])
+        for positions in matches[1:]:
+            if not selected: break
+            selected.intersection_update(positions)
+        return sorted(selected)
+
+    def sort_ranks(self, key, keyfunc=None):
+        # rank[i] is where self.spells[i] comes when sorted by key, with equal keys sharing a rank.
+        # key is a SORT_KEYS name, or any hashable name for keyfunc (which should change when keyfunc's results do)
+        ranks = self._sort_cache.get(("ranks", key))
+        if ranks is None:
+            keyfunc = keyfunc or SORT_KEYS[key]
+            values = [keyfunc(spell) for spell in self.spells]
+            order = sorted(range(len(values)), key=values.__getitem__)
+            ranks = [0] * len(values)
+            rank = 0
+            for position, i in enumerate(order):
+                if position and values[i] != values[order[position - 1]]: rank += 1
+                ranks[i] = rank
+            if key not in SORT_KEYS: self._forget_versions(key)
+            self._sort_cache[("ranks", key)] = ranks
+        return ranks
+
+    def _forget_versions(self, key):
+        # Keys that don't only depend on the spellbook are (name, version). Once there are ranks for a
+        # new version the ranks and orders of the older ones are never asked for again, so they're dropped
+        if type(key) != tuple or not key: return
+        def stale(name):
+            return type(name) == tuple and name and name[0] == key[0] and name != key
+        for cache_key in list(self._sort_cache):
+            names = [cache_key[1]] if cache_key[0] == "ranks" else [name for name, _ in cache_key[1:]]
+            if any(stale(name) for name in names): self._sort_cache.pop(cache_key, None)
+
+    def _composite_key(self, keys):
+        ranks = [(self.sort_ranks(key, keyfunc), descending) for key, keyfunc, descending in keys]
+        if len(ranks) == 1 and not ranks[0][1]:
+            return ranks[0][0].__getitem__
+        return lambda i: tuple(-rank[i] if descending else rank[i] for rank, descending in ranks) + (i,)
+
+    def sort_order(self, keys):
+        # Cached permutation of self.spells, sorted by keys: a list of (key, keyfunc, descending), most significant first.
+        # Ties keep spellbook order
+        cache_key = ("order",) + tuple((key, descending) for key, _, descending in keys)
+        order = self._sort_cache.get(cache_key)
+        if order is None:
+            order = sorted(range(len(self.spells)), key=self._composite_key(keys))
+            self._sort_cache[cache_key] = order
+        return order
+
+    @instrument.timed("sort")
+    def sort_spells(self, spells, keys):
+        # Sorts spells (some or all of self.spells) using the cached ranks and orders of the whole book
+        positions = self.positions()
+        try:
+            if len(spells) * SORT_SUBSET_RATIO < len(self.spells):
+                composite = self._composite_key(keys)
+                return sorted(spells, key=lambda spell: composite(positions[id(spell)]))
+            members = {positions[id(spell)] for spell in spells}
+        except KeyError: # Spells from another snapshot, so none of the cached ranks apply
+            return sort_by_keys(spells, keys)
+        return [self.spells[i] for i in self.sort_order(keys) if i in members]
 
 class Spellbook:
+    # Holds the current Snapshot of the spells. Setting spells, or publishing a snapshot, replaces it
+    # in one assignment: anything that took the previous snapshot keeps using it undisturbed, and
+    # anything asking afterwards gets the new one, indexes and all. Readers that make more than one
+    # call (or run on another thread) should take snapshot() once and use that
 
     def __init__(self):
-        self.spells = []
+        self._snapshot = Snapshot()
+
+    def snapshot(self):
+        return self._snapshot
+
+    def publish(self, snapshot):
+        self._snapshot = snapshot
+
+    @property
+    def spells(self):
+        return self._snapshot.spells
+
+    @spells.setter
+    def spells(self, spells):
+        # Every new set of spells gets a new version, which anything cached from the spells is keyed by
+        self.publish(Snapshot(spells))
+
+    @property
+    def rejects(self):
+        return self._snapshot.rejects
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def search(self, condition):
+        return self._snapshot.search(condition)
+
+    def search_class(self, cls):
+        return self._snapshot.search_class(cls)
+
+    def fuzzy_search(self, text, max_distance=None):
+        return self._snapshot.fuzzy_search(text, max_distance)
+
+    def positions(self):
+        return self._snapshot.positions()
+
+    def by_id(self):
+        return self._snapshot.by_id()
+
+    def range_index(self, field):
+        return self._snapshot.range_index(field)
+
+    def select(self, ranges=(), flags=()):
+        return self._snapshot.select(ranges, flags)
+
+    def sort_ranks(self, key, keyfunc=None):
+        return self._snapshot.sort_ranks(key, keyfunc)
+
+    def sort_order(self, keys):
+        return self._snapshot.sort_order(keys)
+
+    def sort_spells(self, spells, keys):
+        return self._snapshot.sort_spells(spells, keys)
 
     @classmethod
     def from_list(cls, spells):
@@ -72,61 +1136,221 @@ class Spellbook:
         return spellbook
 
     @classmethod
-    def from_json(cls, data):
+    def from_json(cls, data, store=None):
         spellbook = cls()
         spells = []
         data = json.loads(data)
         for spell in data:
-            spell = Spell.from_dict(spell)
+            spell = Spell.from_dict(spell, store)
             spells.append(spell)
+        instrument.count("spells.decoded", len(spells))
         spellbook.spells = spells
         return spellbook
 
     @classmethod
+    @instrument.timed("cache.read")
     def from_cache(cls, filename):
-        with open(filename) as f:
-            data = f.read()
-        return cls.from_json(data)
+        spells = list(iter_cache(filename))
+        instrument.count("spells.decoded", len(spells))
+        return cls.from_list(spells)
 
     @classmethod
-    def from_workbook(cls, filename):
+    @instrument.timed("load.workbook")
+    def from_workbook(cls, filename, sheets=(SPELLS_SHEET,)):
+        # Rows that aren't a valid spell are skipped and listed in spellbook.rejects. See read_workbook for sheets
         spellbook = cls()
-        wb = openpyxl.load_workbook(filename=filename)
-        ws = None
-        for worksheet in wb.worksheets:
-            if worksheet.title == "Spells":
-                ws = worksheet
-        assert ws != None
-        spells = []
-        for row in range(1, ws.max_row):
-            rowdata = read_row(ws, row)
-            try:
-                spell = Spell.from_row(rowdata)
-                spells.append(spell)
-            except:
-                pass
-        spellbook.spells = spells
+        spells, rejects = read_workbook(filename, sheets)
+        spellbook.publish(Snapshot(spells, rejects))
+        return spellbook
+
+    @classmethod
+    @instrument.timed("load.workbooks")
+    def from_workbooks(cls, filenames, cache_dir=None, sheets=None, processes=None):
+        # The spells of several workbooks merged into one book, see merge_spells, each spell's source
+        # field saying where it came from. Every workbook is cached on its own in cache_dir, and only
+        # the ones changed since are parsed again, side by side in worker processes when there are
+        # several. rejects are the rows of the workbooks parsed this time. Without cache_dir nothing is kept
+        if cache_dir is None:
+            with tempfile.TemporaryDirectory() as cache_dir:
+                return cls.from_workbooks(filenames, cache_dir, sheets, processes)
+        os.makedirs(cache_dir, exist_ok=True)
+        index_filename = os.path.join(cache_dir, SOURCE_INDEX)
+        try:
+            with open(index_filename) as f:
+                index = json.loads(f.read())
+        except (OSError, ValueError):
+            index = {}
+        caches = []
+        stale = []
+        for filename in filenames:
+            key = sha1(json.dumps([os.path.abspath(filename), sheets]).encode("utf-8")).hexdigest()[:16]
+            cache = os.path.join(cache_dir, "source-{}.json".format(key))
+            caches.append(cache)
+            stamp = file_stamp(filename)
+            if index.get(os.path.basename(cache)) != stamp or not os.path.isfile(cache):
+                stale.append((filename, cache, stamp))
+        rejects = []
+        if stale:
+            processes = min(len(stale), processes or os.cpu_count() or 1)
+            filenames, stale_caches, stamps = zip(*stale)
+            if processes > 1:
+                # Spawned rather than forked, which isn't safe from a process running other threads
+                with ProcessPoolExecutor(processes, multiprocessing.get_context("spawn")) as pool:
+                    results = list(pool.map(parse_source, filenames, [sheets] * len(stale), stale_caches))
+            else:
+                results = [parse_source(filename, sheets, cache) for filename, cache in zip(filenames, stale_caches)]
+            for cache, stamp, source_rejects in zip(stale_caches, stamps, results):
+                index[os.path.basename(cache)] = stamp
+                rejects.extend(source_rejects)
+            persist.atomic_write(index_filename, json.dumps(index))
+        spellbook = cls()
+        spellbook.publish(Snapshot(merge_spells(cls.from_cache(cache).spells for cache in caches), rejects))
         return spellbook
 
     def to_json(self):
-        return json.dumps([spell.__dict__ for spell in self.spells])
+        return json.dumps([spell.to_dict() for spell in self.spells])
 
-    def to_cache(self, filename):
-        data = self.to_json()
-        with open(filename, "w") as f:
-            f.write(data)
+    @instrument.timed("cache.write")
+    def to_cache(self, filename, lazy_descriptions=False):
+        # With lazy_descriptions the descriptions are written to a side file and the cache only
+        # keeps their offsets. The spells in this spellbook are then switched over to the side
+        # file too, so their descriptions no longer have to be kept in memory. See write_cache
+        spells = self.spells
+        if lazy_descriptions:
+            write_cache(spells, filename, True, lambda spell, store, offset, length: spell.unload_description(store, offset, length))
+            return
+        write_cache(spells, filename) # Which loads every description still in the old side file, see Spell.to_dict
 
-    def search(self, condition):
-        return [x for x in self.spells if condition(x)]
+    def export(self, filename, spells=None, fmt=None, columns=None, tags=None, progress=None):
+        # Writes spells (all of the book by default) out with the streaming writers in export.py
+        return export.export(self.spells if spells is None else spells, filename, fmt, columns, tags, progress)
 
-    def search_class(self, cls):
-        assert cls in all_classes
-        return [x for x in self.spells if x.classes[cls]]
+    def memory_report(self):
+        spells = self.spells
+        total = deep_sizeof(spells, set())
+        fields = {}
+        seen = set()
+        for spell in spells:
+            for field, value in spell.__dict__.items():
+                fields[field] = fields.get(field, 0) + deep_sizeof(value, seen)
+        return {
+            "spells": len(spells),
+            "total_bytes": total,
+            "bytes_per_spell": total / len(spells) if spells else 0,
+            "field_bytes": fields,
+        }
 
     def __eq__(self, other):
         return self.spells == other.spells
 
-def main():
-    pass
+def parse_sort_keys(text):
+    # "level,-name" -> sort_spells keys, most significant first. - reverses a field
+    keys = []
+    for key in text.split(","):
+        key = key.strip()
+        descending = key.startswith("-")
+        key = key.lstrip("-")
+        if key not in SORT_KEYS: raise ValueError("Unknown sort field " + key)
+        keys.append((key, None, descending))
+    return keys
+
+# How the bounds of a range filter are read, in the units of NUMERIC_FIELDS: "60 ft", "1 mile", "1 bonus action"
+BOUND_PARSERS = {"level": lambda text: int(text) if text.isdigit() else None, "time": parse_time, "range": parse_range, "duration": parse_duration}
+
+def parse_range_filter(text):
+    # "level=1..3", "range=60ft..", "time=1 action" -> (field, low, high) for Query ranges. A bound
+    # left out has no limit, a single value is a range of one
+    field, separator, bounds = text.partition("=")
+    field = field.strip().lower()
+    if not separator or field not in BOUND_PARSERS:
+        raise ValueError("Range filters are <field>=<low>..<high> with a field out of " + ", ".join(BOUND_PARSERS))
+    low, dots, high = bounds.partition("..")
+    if not dots: high = low
+    parsed = []
+    for bound in (low.strip(), high.strip()):
+        value = BOUND_PARSERS[field](bound) if bound else None
+        if bound and value is None: raise ValueError("Can't read {!r} as a {}".format(bound, field))
+        parsed.append(value)
+    return field, parsed[0], parsed[1]
+
+def range_condition(ranges, flags=()):
+    # Tests a spell against (field, low, high) ranges and flags the way Snapshot.select does, for
+    # spells that aren't in a snapshot with indexes to bisect
+    bounds = [(NUMERIC_FIELDS[field], low, high) for field, low, high in ranges]
+    tests = [FLAGS[flag] for flag in flags]
+    def condition(spell):
+        for parse, low, high in bounds:
+            value = parse(spell)
+            if value is None or (low is not None and value < low) or (high is not None and value > high): return False
+        return all(test(spell) for test in tests)
+    return condition
+
+def open_spellbook(filename):
+    if os.path.splitext(filename)[1].lower() == ".xlsx":
+        return Spellbook.from_workbook(filename)
+    return Spellbook.from_cache(filename)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="QSpellbook spell loader")
+    commands = parser.add_subparsers(dest="command")
+    exportParser = commands.add_parser("export", help="Export spells to CSV, JSON lines, Markdown or HTML spell cards")
+    exportParser.add_argument("source", help="Spreadsheet (.xlsx) or cache (.json) to read the spells from")
+    exportParser.add_argument("output", help="File to write, the format is taken from its extension unless --format is given")
+    exportParser.add_argument("--format", choices=sorted(export.WRITERS))
+    exportParser.add_argument("--name", help="Only spells with this in their name")
+    exportParser.add_argument("--level", type=int, action="append", help="Only spells of this level, can be repeated")
+    exportParser.add_argument("--class", dest="classes", action="append", choices=all_classes, help="Only spells of this class, can be repeated for spells of every one given")
+    exportParser.add_argument("--text", default="", help="Only spells with this in their description")
+    exportParser.add_argument("--where", action="append", default=[], help="Only spells with a field in a range, e.g. level=1..3, range=60ft.. or time=1 action. Can be repeated")
+    exportParser.add_argument("--flag", action="append", default=[], choices=sorted(FLAGS), help="Only spells with this property, can be repeated")
+    exportParser.add_argument("--columns", help="Comma separated columns out of " + ", ".join(export.COLUMNS))
+    exportParser.add_argument("--sort", default="name", help="Comma separated fields out of " + ", ".join(SORT_KEYS)
+                              + ", prefix with - to reverse. none keeps the source's order, and streams the spells through without loading them all")
+    exportParser.add_argument("--tags", help="Tag file to fill the Tag column from")
+    args = parser.parse_args(argv)
+    if args.command != "export":
+        parser.print_help()
+        return
+
+    stream = args.sort.strip().lower() == "none"
+    try:
+        ranges = [parse_range_filter(text) for text in args.where]
+        keys = None if stream else parse_sort_keys(args.sort)
+    except ValueError as e:
+        parser.error(str(e))
+    name = args.name.casefold() if args.name else None
+    text = args.text.casefold()
+    in_ranges = range_condition(ranges, args.flag)
+    def wanted(spell):
+        return ((name is None or name in spell.name.casefold())
+                and (not args.level or spell.level in args.level)
+                and all(spell.classes[cls] for cls in args.classes or ())
+                and in_ranges(spell)
+                and (not text or text in (spell.read_description() or "").casefold()))
+
+    columns = [column.strip() for column in args.columns.split(",")] if args.columns else None
+    tags = {}
+    if args.tags:
+        try:
+            tags = tagstore.load_tags(args.tags)
+        except (OSError, ValueError) as e:
+            parser.error("Can't read the tags in {}: {}".format(args.tags, e))
+    if stream:
+        # Read through twice, once for the tags and once to export, rather than held in memory
+        if tags:
+            tags, _ = tagstore.remap_tags(tags, iter_spells(args.source))
+        spells = (spell for spell in iter_spells(args.source) if wanted(spell))
+    else:
+        spellbook = open_spellbook(args.source)
+        spells = spellbook.sort_spells(spellbook.search(wanted), keys)
+        if tags:
+            tags, _ = tagstore.remap_tags(tags, spellbook.spells)
+    def progress(done, total):
+        print("\rExported {}{} spells".format(done, "/{}".format(total) if total is not None else ""), end="", file=sys.stderr)
+    try:
+        export.export(spells, args.output, args.format, columns, tags, progress)
+    except ValueError as e:
+        parser.error(str(e))
+    print(file=sys.stderr)
 
 if __name__ == "__main__": main()
\ No newline at end of file
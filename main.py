@@ -1,11 +1,14 @@
-import sys, textwrap, os, json, shutil
+import sys, os, shutil, time, math, difflib, itertools, threading
+STARTUP_T0 = time.perf_counter() # Taken before the Qt imports so the startup report includes them
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
-import loader
+import loader, instrument, tagstore, export, cards, persist, flatbook, parallel
+from formatting import generateClassStr, pprintClasses, generateTagStr, pprintTags, addLineBreaks, pprintComp
 
 VERSION = "v1.2"
-DEBUG = False
+DEBUG = "--debug" in sys.argv
+TRACE_FILENAME = sys.argv[sys.argv.index("--trace") + 1] if "--trace" in sys.argv[:-1] else None # Chrome trace written on exit
 
 APPDATA = QStandardPaths.standardLocations(QStandardPaths.AppDataLocation)[0]
 APPDATA = os.path.join(APPDATA, "QSpellbook")
@@ -13,14 +16,41 @@ APPDATA = os.path.join(APPDATA, "QSpellbook")
 WB_DEFAULT_FILENAME = "Spells.xlsx"
 CACHE_FILENAME = os.path.join(APPDATA, "spells.json")
 TAGS_FILENAME = os.path.join(APPDATA, "tags.json")
+SOURCES_DIRNAME = os.path.join(APPDATA, "sources") # Each spreadsheet's own cache when several are loaded, see loader.Spellbook.from_workbooks
+SHARED_FILENAME = os.path.join(APPDATA, "spells.shared") # Points at the spellbook shared between windows, see flatbook.py
+SHARED_POLL_INTERVAL = 2000 # ms between checks for a spellbook another window has published
+WATCH_DEBOUNCE = 1000 # ms a watched spreadsheet has to be left alone before it's reloaded, spreadsheet programs save in several writes
+# Choices in the FilterBar's casting time, range and duration boxes: (text, (low, high) in the units
+# of loader.NUMERIC_FIELDS or None, flags). None bounds are open
+TIME_FILTERS = [
+    ("Any", None, ()),
+    ("Reaction", (loader.TIME_UNITS["reaction"], loader.TIME_UNITS["reaction"]), ()),
+    ("Bonus action", (loader.TIME_UNITS["bonus action"], loader.TIME_UNITS["bonus action"]), ()),
+    ("Action", (loader.TIME_UNITS["action"], loader.TIME_UNITS["action"]), ()),
+    ("Up to 1 action", (None, loader.TIME_UNITS["action"]), ()),
+    ("1 minute or longer", (loader.TIME_UNITS["minute"], None), ()),
+]
+RANGE_FILTERS = [
+    ("Any", None, ()),
+    ("Self", None, ("self",)),
+    ("Touch", None, ("touch",)),
+    ("At least 30 ft", (30, None), ()),
+    ("At least 60 ft", (60, None), ()),
+    ("At least 120 ft", (120, None), ()),
+    ("At least 1 mile", (loader.RANGE_UNITS["mile"], None), ()),
+]
+DURATION_FILTERS = [
+    ("Any", None, ()),
+    ("Instantaneous", (0, 0), ()),
+    ("Up to 1 minute", (None, loader.DURATION_UNITS["minute"]), ()),
+    ("Up to 1 hour", (None, loader.DURATION_UNITS["hour"]), ()),
+    ("1 hour or longer", (loader.DURATION_UNITS["hour"], None), ()),
+]
+EXPORT_FILTERS = "CSV (*.csv);;JSON lines (*.jsonl);;Markdown (*.md);;HTML spell cards (*.html)"
 
 PROGRAM_NAME = "QSpellbook"
 PROGRAM_AUTHOR = "Ethan Crooks"
 
-app = QApplication(sys.argv)
-screen = app.primaryScreen()
-SCREEN_H, SCREEN_W = screen.availableGeometry().height(), screen.availableGeometry().width()
-
 DEFAULT_HEIGHT_RATIO = 0.7
 MAIN_HEIGHT_RATIO = 0.8
 MAIN_WIDTH_RATIO = 0.9
@@ -33,9 +63,17 @@ COLUMN_SHORT = 100
 COLUMN_TINY = 70
 
 TABLE_MAX_ROW_HEIGHT = 50
-TOOLTIP_WIDTH = 150
+DESCRIPTION_PREVIEW_CHARS = 400 # More than fits in a collapsed row, so the rest of a description doesn't need to be read
 
 TABLE_SCROLL_SPEED = 30
+ROW_SIZING_MARGIN = 20 # Rows either side of the viewport that are measured ahead of scrolling to them
+MAX_TEXT_LAYOUTS = 2000 # Cached layouts for painting, enough for several screens of cells
+MAX_TEXT_SIZES = 200000
+MAX_SORT_COLUMNS = 3
+
+DEBUG_REFRESH_INTERVAL = 500 # ms
+
+STARTUP_REPORT = DEBUG or "--startup-report" in sys.argv
 
 TABLEITEM_FLAGS_NOEDIT = Qt.ItemIsEnabled | Qt.ItemIsUserCheckable | Qt.ItemIsSelectable
 TABLEITEM_FLAGS_EDIT = Qt.ItemIsEnabled | Qt.ItemIsEditable | Qt.ItemIsUserCheckable | Qt.ItemIsSelectable
@@ -45,48 +83,32 @@ def except_hook(cls, exception, traceback):
     sys.__excepthook__(cls, exception, traceback)
     sys.exit(1)
 
-def generateClassStr(spell):
-    classes = [x for x in spell.classes if spell.classes[x]]
-    class_str = ""
-    for cls in classes:
-        class_str += cls[:3].upper() + " "
-    return class_str[:-1]
-
-def pprintClasses(spell):
-    classes = [x for x in spell.classes if spell.classes[x]]
-    class_str = ""
-    for cls in classes:
-        class_str += cls + "\n"
-    return class_str[:-1]
-
-def generateTagStr(spell, tags):
-    if not hash(spell) in tags: return None
-    tag_str = ""
-    for tag in tags[hash(spell)]:
-        tag_stripped = ""
-        for char in tag: # Remove punctuation
-            if char.isalnum():
-                tag_stripped += char.upper()
-            if len(tag_stripped) == 3:
-                break
-        if len(tag_stripped) < 3:
-            tag_stripped = tag[:3].upper() # If punction has been removed and the tag is less than 3 chars, keep the punctuation
-        tag_str += tag_stripped + " "
-    return tag_str[:-1]
-
-def pprintTags(spell, tags):
-    if not hash(spell) in tags: return None
-    tag_str = ""
-    for tag in tags[hash(spell)]:
-        tag_str += tag + "\n"
-    return tag_str[:-1]
-
-def addLineBreaks(s):
-    # https://stackoverflow.com/a/26538082/8708443
-    newStr = '\n'.join(['\n'.join(textwrap.wrap(line, TOOLTIP_WIDTH,
-        break_long_words=False, replace_whitespace=False))
-        for line in s.splitlines() if line.strip() != ''])
-    return newStr
+def screenSize():
+    geometry = QApplication.primaryScreen().availableGeometry()
+    return geometry.height(), geometry.width()
+
+class StartupTimer:
+    # Records how long each startup stage took, relative to the previous stage and to process start
+    def __init__(self, start=STARTUP_T0):
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, (now - self.last) * 1000, (now - self.start) * 1000))
+        self.last = now
+
+    def elapsed(self, phase):
+        for name, _, total in self.phases:
+            if name == phase: return total
+        return None
+
+    def report(self):
+        lines = ["Startup timings (ms):"]
+        for phase, duration, total in self.phases:
+            lines.append("  {:<12} {:>8.1f} {:>8.1f}".format(phase, duration, total))
+        return "\n".join(lines)
 
 def borderLine():
     line = QFrame()
@@ -94,17 +116,218 @@ def borderLine():
     line.setFrameShadow(QFrame.Sunken)
     return line
 
-def pprintComp(spell):
-    comp_str = ""
-    if spell.components['verbal']:
-        comp_str += "Verbal\n"
-    if spell.components['somantic']:
-        comp_str += "Somantic\n"
-    if spell.components['material']:
-        comp_str += spell.components['material'] + "\n"
-    if comp_str[-1:] == "\n": comp_str = comp_str[:-1]
-    if comp_str == "": comp_str = None
-    return comp_str
+class SpellTableModel(QAbstractTableModel):
+    # The spells shown in the table, in their sorted order. Cell text is worked out when the view
+    # asks for it, and sorting uses the spellbook's typed sort keys rather than the cell text
+    def __init__(self, parent):
+        super().__init__()
+        self.parent = parent
+        self.spells = []
+        self.columns = []
+        self.sortColumns = [] # (column name, Qt.SortOrder), most significant first
+        self.ordered = False # The spells are in an order of their own (closest fuzzy matches first) rather than sorted
+        self.textCache = {}
+        self.alignment = Qt.AlignVCenter
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.spells)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.columns[section]
+        return super().headerData(section, orientation, role)
+
+    def flags(self, index):
+        return TABLEITEM_FLAGS_NOEDIT
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole:
+            key = (index.row(), index.column())
+            text = self.textCache.get(key)
+            if text is None:
+                header = self.parent.spellheaders[self.columns[index.column()]]
+                text = self.textCache[key] = str(header['value'](self.spells[index.row()]))
+            return text
+        if role == Qt.ToolTipRole:
+            tooltip = self.parent.spellheaders[self.columns[index.column()]]['tooltip']
+            return tooltip(self.spells[index.row()]) if tooltip else None
+        if role == Qt.TextAlignmentRole:
+            return self.alignment
+        return None
+
+    def setSpells(self, spells, columns, alignment=Qt.AlignVCenter, ordered=False):
+        self.beginResetModel()
+        self.columns = columns
+        self.alignment = alignment
+        self.ordered = ordered
+        self.spells = list(spells) if ordered else self.sortedSpells(spells)
+        self.textCache = {}
+        self.endResetModel()
+
+    def replaceSpells(self, spells, ordered=False):
+        # Moves the table over to spells a row at a time rather than resetting it, so the view keeps its
+        # scroll position, selection and row heights for the rows that stay. Rows are matched up by spell id,
+        # and a spell that changed is updated in its row. Returns how many rows were inserted, removed or changed
+        spells = list(spells) if ordered else self.sortedSpells(spells)
+        self.ordered = ordered
+        matcher = difflib.SequenceMatcher(None, [spell.id for spell in self.spells], [spell.id for spell in spells], autojunk=False)
+        opcodes = matcher.get_opcodes()
+        changed = []
+        self.textCache = {}
+        # From the end, so the rows of the changes still to come don't move
+        for tag, i1, i2, j1, j2 in reversed(opcodes):
+            if tag == "equal":
+                changed += [j1 + k for k in range(i2 - i1) if self.spells[i1 + k] is not spells[j1 + k]]
+                continue
+            if i2 > i1:
+                self.beginRemoveRows(QModelIndex(), i1, i2 - 1)
+                del self.spells[i1:i2]
+                self.endRemoveRows()
+            if j2 > j1:
+                self.beginInsertRows(QModelIndex(), i1, i1 + j2 - j1 - 1)
+                self.spells[i1:i1] = spells[j1:j2]
+                self.endInsertRows()
+        self.spells = spells
+        for row in changed:
+            self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.columns) - 1))
+        return len(changed) + sum(max(i2 - i1, j2 - j1) for tag, i1, i2, j1, j2 in opcodes if tag != "equal")
+
+    def sortKeys(self):
+        keys = []
+        for name, order in self.sortColumns:
+            header = self.parent.spellheaders[name]
+            key, keyfunc = header['sortkey'], None
+            if callable(key): # Keys that don't only depend on the spellbook, see sortKeyVersion
+                key, keyfunc = (name, header['sortkeyVersion']()), key
+            keys.append((key, keyfunc, order == Qt.DescendingOrder))
+        return keys
+
+    def sortedSpells(self, spells):
+        if not self.sortColumns or not self.parent.spellbook: return list(spells)
+        return self.parent.spellbook.snapshot().sort_spells(spells, self.sortKeys())
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if column < 0 or column >= len(self.columns): return
+        # The previous sort columns are kept as tie breakers, so sorting by School then Level
+        # gives spells by level, then school within each level
+        name = self.columns[column]
+        self.sortColumns = ([(name, order)] + [x for x in self.sortColumns if x[0] != name])[:MAX_SORT_COLUMNS]
+        self.ordered = False
+        self.layoutAboutToBeChanged.emit()
+        self.spells = self.sortedSpells(self.spells)
+        self.textCache = {}
+        self.layoutChanged.emit()
+
+class WrappedTextDelegate(QStyledItemDelegate):
+    # Paints cell text from cached QTextLayouts and answers size hints from cached measurements.
+    # Both are keyed by (spell id, column, text, width), so a cell is only laid out again when
+    # its text or column width changes
+    def __init__(self, parent):
+        super().__init__()
+        self.parent = parent
+        self.layouts = {}
+        self.heights = {}
+        self.widths = {}
+
+    def cellKey(self, index, text):
+        model = self.parent.tableModel
+        return (model.spells[index.row()].id, model.columns[index.column()], hash(text))
+
+    def margin(self, option):
+        style = option.widget.style() if option.widget else QApplication.style()
+        return style.pixelMetric(QStyle.PM_FocusFrameHMargin, None, option.widget) + 1
+
+    def layoutText(self, text, font, width):
+        # Qt only breaks lines at a line separator, not at \n
+        textLayout = QTextLayout(text.replace("\n", "\u2028"), font)
+        textOption = QTextOption()
+        textOption.setWrapMode(QTextOption.WrapAtWordBoundaryOrAnywhere)
+        textLayout.setTextOption(textOption)
+        textLayout.beginLayout()
+        height = 0
+        while True:
+            line = textLayout.createLine()
+            if not line.isValid(): break
+            line.setLineWidth(width)
+            line.setPosition(QPointF(0, height))
+            height += line.height()
+        textLayout.endLayout()
+        return textLayout, int(height + 0.5)
+
+    def textLayout(self, key, text, font, width):
+        key += (width,)
+        cached = self.layouts.get(key)
+        if cached is None:
+            if len(self.layouts) >= MAX_TEXT_LAYOUTS: self.layouts = {}
+            cached = self.layouts[key] = self.layoutText(text, font, width)
+            self.heights[key] = cached[1]
+        return cached
+
+    def textHeight(self, key, text, font, width):
+        key += (width,)
+        height = self.heights.get(key)
+        if height is None:
+            if len(self.heights) >= MAX_TEXT_SIZES: self.heights = {}
+            height = self.heights[key] = self.layoutText(text, font, width)[1]
+        return height
+
+    def textWidth(self, key, text, font):
+        width = self.widths.get(key)
+        if width is None:
+            if len(self.widths) >= MAX_TEXT_SIZES: self.widths = {}
+            metrics = QFontMetricsF(font)
+            width = self.widths[key] = math.ceil(max(metrics.horizontalAdvance(line) for line in text.split("\n")))
+        return width
+
+    def sizeHint(self, option, index):
+        text = index.data(Qt.DisplayRole) or ""
+        margin = self.margin(option)
+        key = self.cellKey(index, text)
+        width = self.textWidth(key, text, option.font) + 2 * margin
+        # Column sizing asks without a width, row sizing with the column's width
+        if option.rect.width() > 2 * margin:
+            height = self.textHeight(key, text, option.font, option.rect.width() - 2 * margin)
+        else:
+            height = QFontMetrics(option.font).height() * (text.count("\n") + 1)
+        return QSize(width, height + margin)
+
+    def paint(self, painter, option, index):
+        option = QStyleOptionViewItem(option)
+        self.initStyleOption(option, index)
+        widget = option.widget
+        style = widget.style() if widget else QApplication.style()
+        margin = self.margin(option)
+        rect = style.subElementRect(QStyle.SE_ItemViewItemText, option, widget).adjusted(margin, 0, -margin, 0)
+        text = option.text
+        option.text = ""
+        style.drawControl(QStyle.CE_ItemViewItem, option, painter, widget) # Background and selection, without the text
+        if not text or rect.width() <= 0: return
+        textLayout, height = self.textLayout(self.cellKey(index, text), text, option.font, rect.width())
+        top = rect.top() if option.displayAlignment & Qt.AlignTop else rect.top() + max(0, (rect.height() - height) // 2)
+        group = QPalette.Normal if option.state & QStyle.State_Enabled else QPalette.Disabled
+        role = QPalette.HighlightedText if option.state & QStyle.State_Selected else QPalette.Text
+        painter.save()
+        painter.setClipRect(rect)
+        painter.setPen(option.palette.color(group, role))
+        if height <= rect.height():
+            textLayout.draw(painter, QPointF(rect.left(), top))
+        else:
+            # Only whole lines are drawn, with the last one that fits elided like the default delegate does
+            layoutText = textLayout.text()
+            metrics = QFontMetrics(option.font)
+            for i in range(textLayout.lineCount()):
+                line = textLayout.lineAt(i)
+                nextLine = textLayout.lineAt(i + 1) if i + 1 < textLayout.lineCount() else None
+                if nextLine is None or nextLine.y() + nextLine.height() <= rect.height():
+                    line.draw(painter, QPointF(rect.left(), top))
+                    continue
+                rest = layoutText[line.textStart():].replace("\u2028", " ")
+                painter.drawText(QPointF(rect.left(), top + line.y() + line.ascent()), metrics.elidedText(rest, Qt.ElideRight, rect.width()))
+                break
+        painter.restore()
 
 class VisibilityBar(QWidget):
     def __init__(self, parent):
@@ -156,7 +379,8 @@ class VisibilityBar(QWidget):
             columns[colCheckBox.col] = colCheckBox.isChecked()
         for col in columns:
             self.parent.spellheaders[col]['enabled'] = columns[col]
-        self.parent.applyFilters()
+        # Only which columns are shown changes, the spells shown and their order stay as they are
+        self.parent.updateColumnVisibility()
 
 class FilterBar(QWidget):
     def __init__(self, parent):
@@ -180,6 +404,16 @@ class FilterBar(QWidget):
         nameLabel.setAlignment(Qt.AlignHCenter)
 
         nameEdit = QLineEdit()
+        fuzzyCheckBox = QCheckBox("Fuzzy")
+        fuzzyCheckBox.setToolTip("Allow for typos in the name, closest matches first")
+        nameHBox = QHBoxLayout()
+        nameHBox.addWidget(nameEdit)
+        nameHBox.addWidget(fuzzyCheckBox)
+
+        textLabel = QLabel("DESCRIPTION")
+        textLabel.setAlignment(Qt.AlignHCenter)
+        textEdit = QLineEdit()
+        textEdit.setPlaceholderText("Text in the description")
 
         classLabel = QLabel("CLASS")
         classLabel.setAlignment(Qt.AlignHCenter)
@@ -207,6 +441,19 @@ class FilterBar(QWidget):
         classSelectHBox.addWidget(classSelectAllButton)
         classSelectHBox.addWidget(classSelectNoneButton)
 
+        # Only shown with spells from more than one spreadsheet, see reupSources
+        sourceLabel = QLabel("SOURCE")
+        sourceLabel.setAlignment(Qt.AlignHCenter)
+        sourceVBox = QVBoxLayout()
+        sourceVBox.setContentsMargins(0, 0, 0, 0)
+        sourceMainVBox = QVBoxLayout()
+        sourceMainVBox.setContentsMargins(0, 0, 0, 0)
+        sourceMainVBox.addWidget(borderLine())
+        sourceMainVBox.addWidget(sourceLabel)
+        sourceMainVBox.addLayout(sourceVBox)
+        sourceWidget = QWidget()
+        sourceWidget.setLayout(sourceMainVBox)
+
         levelLabel = QLabel("LEVEL 0")
         levelLabel.setAlignment(Qt.AlignHCenter)
         levelCheckBox = QCheckBox()
@@ -215,15 +462,46 @@ class FilterBar(QWidget):
         levelSlider.setMinimum(0)
         levelSlider.setMaximum(maxLevel)
         levelSlider.setEnabled(False)
+        levelMaxSlider = QSlider(Qt.Horizontal)
+        levelMaxSlider.setMinimum(0)
+        levelMaxSlider.setMaximum(maxLevel)
+        levelMaxSlider.setEnabled(False)
 
         minLevelLabel = QLabel("0")
         maxLevelLabel = QLabel(str(maxLevel))
+        toLevelLabel = QLabel("To")
 
         levelHBox = QHBoxLayout()
         levelHBox.addWidget(levelCheckBox)
         levelHBox.addWidget(minLevelLabel)
         levelHBox.addWidget(levelSlider)
         levelHBox.addWidget(maxLevelLabel)
+        levelMaxHBox = QHBoxLayout()
+        levelMaxHBox.addWidget(toLevelLabel)
+        levelMaxHBox.addWidget(levelMaxSlider)
+
+        timeLabel = QLabel("CASTING TIME")
+        timeLabel.setAlignment(Qt.AlignHCenter)
+        timeComboBox = QComboBox()
+        timeComboBox.addItems([text for text, _, _ in TIME_FILTERS])
+        ritualCheckBox = QCheckBox("Ritual")
+        timeHBox = QHBoxLayout()
+        timeHBox.addWidget(timeComboBox, 1)
+        timeHBox.addWidget(ritualCheckBox)
+
+        rangeLabel = QLabel("RANGE")
+        rangeLabel.setAlignment(Qt.AlignHCenter)
+        rangeComboBox = QComboBox()
+        rangeComboBox.addItems([text for text, _, _ in RANGE_FILTERS])
+
+        durationLabel = QLabel("DURATION")
+        durationLabel.setAlignment(Qt.AlignHCenter)
+        durationComboBox = QComboBox()
+        durationComboBox.addItems([text for text, _, _ in DURATION_FILTERS])
+        concentrationCheckBox = QCheckBox("Concentration")
+        durationHBox = QHBoxLayout()
+        durationHBox.addWidget(durationComboBox, 1)
+        durationHBox.addWidget(concentrationCheckBox)
 
         applyButton = QPushButton("Update")
         applyButton.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.Fixed)
@@ -236,26 +514,51 @@ class FilterBar(QWidget):
         mainVBox.addLayout(titleHBox)
         mainVBox.addWidget(borderLine())
         mainVBox.addWidget(nameLabel)
-        mainVBox.addWidget(nameEdit)
+        mainVBox.addLayout(nameHBox)
+        mainVBox.addWidget(textLabel)
+        mainVBox.addWidget(textEdit)
         mainVBox.addWidget(borderLine())
         mainVBox.addWidget(classLabel)
         mainVBox.addLayout(classMainHBox)
         mainVBox.addLayout(classSelectHBox)
+        mainVBox.addWidget(sourceWidget)
         mainVBox.addWidget(borderLine())
         mainVBox.addWidget(levelLabel)
         mainVBox.addLayout(levelHBox)
+        mainVBox.addLayout(levelMaxHBox)
+        mainVBox.addWidget(borderLine())
+        mainVBox.addWidget(timeLabel)
+        mainVBox.addLayout(timeHBox)
+        mainVBox.addWidget(rangeLabel)
+        mainVBox.addWidget(rangeComboBox)
+        mainVBox.addWidget(durationLabel)
+        mainVBox.addLayout(durationHBox)
         mainVBox.addWidget(borderLine())
         mainVBox.addLayout(applyHBox)
         mainVBox.addStretch(0)
 
         levelCheckBox.stateChanged.connect(lambda state: levelSlider.setEnabled(state))
-        levelSlider.valueChanged.connect(lambda value: levelLabel.setText("LEVEL " + str(value)))
+        levelCheckBox.stateChanged.connect(lambda state: levelMaxSlider.setEnabled(state))
+        # The sliders push each other along, so the range never runs backwards
+        levelSlider.valueChanged.connect(lambda value: levelMaxSlider.setValue(max(value, levelMaxSlider.value())))
+        levelMaxSlider.valueChanged.connect(lambda value: levelSlider.setValue(min(value, levelSlider.value())))
+        levelSlider.valueChanged.connect(self.updateLevelLabel)
+        levelMaxSlider.valueChanged.connect(self.updateLevelLabel)
 
         nameEdit.editingFinished.connect(lambda: self.applyFiltersAutoWrapper(True))
         nameEdit.textChanged.connect(lambda: self.applyFiltersAutoWrapper(False))
+        textEdit.editingFinished.connect(lambda: self.applyFiltersAutoWrapper(True))
+        textEdit.textChanged.connect(lambda: self.applyFiltersAutoWrapper(False))
+        fuzzyCheckBox.stateChanged.connect(lambda: self.applyFiltersAutoWrapper())
         levelCheckBox.stateChanged.connect(lambda: self.applyFiltersAutoWrapper())
         levelSlider.sliderReleased.connect(lambda: self.applyFiltersAutoWrapper(True))
         levelSlider.valueChanged.connect(lambda: self.applyFiltersAutoWrapper(False))
+        levelMaxSlider.sliderReleased.connect(lambda: self.applyFiltersAutoWrapper(True))
+        levelMaxSlider.valueChanged.connect(lambda: self.applyFiltersAutoWrapper(False))
+        for comboBox in (timeComboBox, rangeComboBox, durationComboBox):
+            comboBox.currentIndexChanged.connect(lambda: self.applyFiltersAutoWrapper())
+        ritualCheckBox.stateChanged.connect(lambda: self.applyFiltersAutoWrapper())
+        concentrationCheckBox.stateChanged.connect(lambda: self.applyFiltersAutoWrapper())
         autoCheckBox.stateChanged.connect(lambda: self.applyFiltersAutoWrapper())
         autoCheckBox.stateChanged.connect(lambda state: applyButton.setEnabled(not state))
 
@@ -265,13 +568,25 @@ class FilterBar(QWidget):
         applyButton.clicked.connect(self.applyFilters)
 
         self.nameEdit = nameEdit
+        self.textEdit = textEdit
+        self.fuzzyCheckBox = fuzzyCheckBox
         self.classLeftVBox = classLeftVBox
         self.classRightVBox = classRightVBox
+        self.sourceVBox = sourceVBox
+        self.sourceWidget = sourceWidget
         self.levelCheckBox = levelCheckBox
         self.levelSlider = levelSlider
+        self.levelMaxSlider = levelMaxSlider
+        self.levelLabel = levelLabel
+        self.timeComboBox = timeComboBox
+        self.rangeComboBox = rangeComboBox
+        self.durationComboBox = durationComboBox
+        self.ritualCheckBox = ritualCheckBox
+        self.concentrationCheckBox = concentrationCheckBox
         self.autoCheckBox = autoCheckBox
         self.clearButton = clearButton
 
+        self.reupSources()
         self.updateClearButton()
         self.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.MinimumExpanding)
         margins = QMargins(0,0,10,0)
@@ -296,6 +611,28 @@ class FilterBar(QWidget):
                 classes.append(classCheckBox.cls)
         return classes
 
+    def reupSources(self):
+        # A checkbox per source of the spells, keeping what was checked
+        checked = set(self.collectSources())
+        while self.sourceVBox.count():
+            self.sourceVBox.takeAt(0).widget().deleteLater()
+        sources = [source for source in dict.fromkeys(spell.__dict__.get("source") for spell in self.parent.spellbook.spells) if source]
+        for source in sources:
+            sourceCheckBox = QCheckBox(source)
+            sourceCheckBox.source = source
+            sourceCheckBox.setChecked(source in checked)
+            sourceCheckBox.stateChanged.connect(lambda: self.applyFiltersAutoWrapper())
+            self.sourceVBox.addWidget(sourceCheckBox)
+        self.sourceWidget.setVisible(len(sources) > 1)
+
+    def collectSources(self):
+        sources = []
+        for widget in range(self.sourceVBox.count()):
+            sourceCheckBox = self.sourceVBox.itemAt(widget).widget()
+            if sourceCheckBox.isChecked():
+                sources.append(sourceCheckBox.source)
+        return sources
+
     def classesSetEnabled(self, enabled):
         enabled = 2 if enabled else 0
         for widget in range(self.classLeftVBox.count()):
@@ -305,26 +642,54 @@ class FilterBar(QWidget):
             classCheckBox = self.classRightVBox.itemAt(widget).widget()
             classCheckBox.setCheckState(enabled)
 
+    def updateLevelLabel(self):
+        low, high = self.levelSlider.value(), self.levelMaxSlider.value()
+        self.levelLabel.setText("LEVEL " + (str(low) if low == high else "{} TO {}".format(low, high)))
+
+    def comboBoxes(self):
+        return [(self.timeComboBox, "time", TIME_FILTERS), (self.rangeComboBox, "range", RANGE_FILTERS),
+                (self.durationComboBox, "duration", DURATION_FILTERS)]
+
     def clearFilters(self):
         self.nameEdit.setText("")
+        self.textEdit.setText("")
         self.classesSetEnabled(False)
+        for widget in range(self.sourceVBox.count()):
+            self.sourceVBox.itemAt(widget).widget().setChecked(False)
         self.levelCheckBox.setChecked(False)
+        for comboBox, _, _ in self.comboBoxes():
+            comboBox.setCurrentIndex(0)
+        self.ritualCheckBox.setChecked(False)
+        self.concentrationCheckBox.setChecked(False)
         self.applyFiltersAutoWrapper()
 
     def updateClearButton(self):
-        enabled = self.nameEdit.text().strip() != "" or self.levelCheckBox.isChecked() or len(self.collectClasses()) > 0
+        enabled = self.nameEdit.text().strip() != "" or self.textEdit.text().strip() != "" or self.levelCheckBox.isChecked() or len(self.collectClasses()) > 0 or len(self.collectSources()) > 0 \
+            or any(comboBox.currentIndex() != 0 for comboBox, _, _ in self.comboBoxes()) \
+            or self.ritualCheckBox.isChecked() or self.concentrationCheckBox.isChecked()
         self.clearButton.setEnabled(enabled)
 
     def applyFilters(self):
-        conditions = []
-        if self.nameEdit.text().strip() != "":
-            conditions.append(lambda x: self.nameEdit.text().strip().lower() in x.name.lower())
+        # Level, casting time, range and duration go to the query as ranges, which it answers from the spellbook's range indexes
+        ranges = {}
+        flags = []
         if self.levelCheckBox.isChecked():
-            conditions.append(lambda x: x.level == self.levelSlider.value())
-        classes = self.collectClasses()
-        for cls in classes:
-            conditions.append(lambda x, cls=cls: x.classes[cls])
-        self.parent.filterCondition = lambda spell: all([condition(spell) for condition in conditions])
+            ranges["level"] = (self.levelSlider.value(), self.levelMaxSlider.value())
+        for comboBox, field, choices in self.comboBoxes():
+            _, bounds, choiceFlags = choices[comboBox.currentIndex()]
+            if bounds is not None: ranges[field] = bounds
+            flags.extend(choiceFlags)
+        if self.ritualCheckBox.isChecked(): flags.append("ritual")
+        if self.concentrationCheckBox.isChecked(): flags.append("concentration")
+        self.parent.filterQuery = {
+            "name": self.nameEdit.text(),
+            "text": self.textEdit.text(),
+            "ranges": ranges,
+            "flags": flags,
+            "classes": self.collectClasses(),
+            "sources": self.collectSources(),
+            "fuzzy": self.fuzzyCheckBox.isChecked(),
+        }
         self.parent.applyFilters()
 
 class TagBar(QWidget):
@@ -352,11 +717,12 @@ class TagBar(QWidget):
         self.setLayout(mainVBox)
 
     def reupTagBox(self):
-        self.allTags = self.parent.tags
-        self.mainVBox.itemAt(2).widget().hide()
-        self.mainVBox.itemAt(2).widget().setParent(None)
-        self.tagMainHBox = self.generateTagBox()
-        self.mainVBox.insertWidget(2, self.tagMainHBox)
+        with instrument.span("tags.box"):
+            self.allTags = self.parent.tags
+            self.mainVBox.itemAt(2).widget().hide()
+            self.mainVBox.itemAt(2).widget().setParent(None)
+            self.tagMainHBox = self.generateTagBox()
+            self.mainVBox.insertWidget(2, self.tagMainHBox)
 
     def generateTagBox(self):
         tagLeftVBox = QVBoxLayout()
@@ -396,16 +762,8 @@ class TagBar(QWidget):
         for widget in range(self.tagRightVBox.count()):
             tagCheckBox = self.tagRightVBox.itemAt(widget).widget()
             if tagCheckBox.isChecked(): tags.append(tagCheckBox.tag)
-
-        #  - There are no tags selected, or
-        #   - The spell is tagged
-        #   - Every tag that is in tags is also in self.allTag[hash(spell)]
-        # There is probably a better way to represent the last one in a lambda function
-        # Lol look at this fucking abomination
-        self.parent.tagCondition = lambda spell, allTags=self.allTags, tags=tags: \
-            tags == [] or (
-            hash(spell) in allTags and
-            [tag for tag in tags if tag in self.allTags[hash(spell)]] == tags)
+        # Spells are shown if no tags are selected, or they have every selected tag
+        self.parent.tagQuery = tags
         self.parent.applyFilters()
 
 class TagDialog(QDialog): # If remove=False, adding a tag. If remove=True, removing a tag
@@ -428,7 +786,7 @@ class TagDialog(QDialog): # If remove=False, adding a tag. If remove=True, remov
             if self.bulk:
                 tagsList.addItems(self.getAllTags())
             else:
-                tagsList.addItems(self.tags[hash(self.selectedSpell)])
+                tagsList.addItems(self.tags[self.selectedSpell.id])
             self.setWindowTitle("Remove a Tag")
         else:
             titleLabel = QLabel("Add a tag")
@@ -539,10 +897,89 @@ class SettingsDialog(QDialog):
         self.setLayout(mainLayout)
         self.setWindowTitle("Preferences")
 
+class DebugBar(QWidget):
+    def __init__(self, parent):
+        super().__init__()
+        self.parent = parent
+        self.initUI()
+
+    def initUI(self):
+        titleLabel = QLabel("<h1>Debug</h1>")
+
+        spanTable = QTableWidget(0, 5)
+        spanTable.setHorizontalHeaderLabels(["Span", "Count", "Total ms", "Mean ms", "Max ms"])
+        counterTable = QTableWidget(0, 2)
+        counterTable.setHorizontalHeaderLabels(["Counter", "Value"])
+        for table in (spanTable, counterTable):
+            table.verticalHeader().hide()
+            table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+            table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+
+        resetButton = QPushButton("Reset")
+        exportButton = QPushButton("Export Trace")
+        buttonHBox = QHBoxLayout()
+        buttonHBox.addWidget(resetButton)
+        buttonHBox.addWidget(exportButton)
+
+        mainVBox = QVBoxLayout()
+        mainVBox.addWidget(titleLabel)
+        mainVBox.addWidget(borderLine())
+        mainVBox.addWidget(spanTable)
+        mainVBox.addWidget(counterTable)
+        mainVBox.addLayout(buttonHBox)
+
+        resetButton.clicked.connect(lambda: (instrument.reset(), self.refresh()))
+        exportButton.clicked.connect(self.exportTrace)
+
+        self.spanTable = spanTable
+        self.counterTable = counterTable
+        self.setLayout(mainVBox)
+
+    def refresh(self):
+        spans = instrument.spans()
+        self.spanTable.setRowCount(len(spans))
+        for row, name in enumerate(sorted(spans, key=lambda name: -spans[name]['total'])):
+            stats = spans[name]
+            values = [name, str(stats['count'])] + ["{:.1f}".format(stats[key] * 1000) for key in ("total", "mean", "max")]
+            for col, value in enumerate(values):
+                self.spanTable.setItem(row, col, QTableWidgetItem(value))
+        counters = instrument.counters()
+        for name, value in self.parent.queryCache.stats().items():
+            counters["queryCache." + name] = "{:.0%}".format(value) if name == "hit_rate" else value
+        for name, value in self.parent.writer.stats().items():
+            counters["writer." + name] = value
+        self.counterTable.setRowCount(len(counters))
+        for row, name in enumerate(sorted(counters)):
+            self.counterTable.setItem(row, 0, QTableWidgetItem(name))
+            self.counterTable.setItem(row, 1, QTableWidgetItem(str(counters[name])))
+
+    def exportTrace(self):
+        filepath, _ = QFileDialog.getSaveFileName(self, "Export Trace", os.getcwd(), "*.json")
+        if filepath:
+            instrument.export_chrome_trace(filepath)
+
 class MainWindow(QMainWindow):
+    startupFinished = pyqtSignal()
+    startupLoaded = pyqtSignal(object) # Emitted from the startup load thread with the exception it raised, or None
+    saveFailed = pyqtSignal(str) # Emitted from the persistence thread, so it's queued over to the GUI thread
+
     def __init__(self):
         super().__init__()
         self.initDataFiles()
+        # Tags, settings and the spell cache are saved in the background, see persist.py
+        self.writer = persist.WriteBehind(lambda target, error: self.saveFailed.emit("Couldn't save {}: {}".format(target, error)))
+        self.saveFailed.connect(lambda message: QMessageBox.warning(self, "Save Error", message))
+        self.sharedStamp = None # Stamp of the shared spellbook this window has or last published
+        sharedTimer = QTimer(self)
+        sharedTimer.timeout.connect(self.checkSharedSpellbook)
+        sharedTimer.start(SHARED_POLL_INTERVAL)
+        # Saves of a watched spreadsheet restart watchTimer, which reloads once they stop, see watchSpreadsheets
+        self.watcher = QFileSystemWatcher(self)
+        self.watchTimer = QTimer(self)
+        self.watchTimer.setSingleShot(True)
+        self.watchTimer.setInterval(WATCH_DEBOUNCE)
+        self.watchTimer.timeout.connect(lambda: self.reloadSpellbook(automatic=True))
+        self.watcher.fileChanged.connect(lambda path: self.watchTimer.start())
         self.regSettings = QSettings(PROGRAM_AUTHOR, PROGRAM_NAME)
         self.settingsTemplate = {
             "Basic": {
@@ -564,6 +1001,36 @@ class MainWindow(QMainWindow):
                     "type":"checkbox",
                     "default":True,
                     "onChange":None
+                },
+                "lazyDescriptions": {
+                    "name":"Keep spell descriptions on disk",
+                    "description": (
+                        "Spell descriptions are kept in a file next to the spell cache and only read when they are shown, rather than all being loaded at startup.\n"
+                        "This keeps memory use and startup time down for large spellbooks."
+                    ),
+                    "type":"checkbox",
+                    "default":True,
+                    "onChange":lambda value: self.saveCache(value)
+                },
+                "sharedSpellbook": {
+                    "name":"Share the spellbook between windows",
+                    "description": (
+                        "The first QSpellbook window publishes its spells to a memory-mapped file, and any other window opened on this computer uses those rather than loading its own copy.\n"
+                        "Reloading the spreadsheet in one window updates the others. Useful when several players share one laptop."
+                    ),
+                    "type":"checkbox",
+                    "default":False,
+                    "onChange":lambda value: self.publishSpellbook()
+                },
+                "watchSpreadsheet": {
+                    "name":"Reload the spreadsheet when it changes",
+                    "description": (
+                        "Watches the spreadsheet (and any added ones) and reloads the spells when it is saved, keeping your filters and scroll position.\n"
+                        "Only the spells that changed are updated in the table."
+                    ),
+                    "type":"checkbox",
+                    "default":False,
+                    "onChange":lambda value: self.watchSpreadsheets()
                 }
             },
             "Experimental": {
@@ -582,25 +1049,158 @@ class MainWindow(QMainWindow):
         }
         self.currentSettings = self.loadSettings()
         self.spellspreadsheet = self.regSettings.value("spreadsheet", WB_DEFAULT_FILENAME)
+        # Further spreadsheets (homebrew, setting spells) merged in with the main one
+        self.extraSpreadsheets = [filepath for filepath in self.regSettings.value("extraSpreadsheets", [], list) if os.path.isfile(filepath)]
         if not os.path.isfile(self.spellspreadsheet):
             #QMessageBox.information(self, "Select Spellbook","Please select your Excel spreadsheet spellbook.")
             result = self.setSpellbook()
             if not result: sys.exit(1)
-        if os.path.isfile(CACHE_FILENAME):
-            self.spellbook = loader.Spellbook.from_cache(CACHE_FILENAME)
-        else:
-            self.spellbook = loader.Spellbook.from_workbook(self.spellspreadsheet)
-            self.spellbook.to_cache(CACHE_FILENAME)
-        self.filterCondition = lambda spell: True
-        self.tagCondition = lambda spell: True
-        self.spells = []
+        self.spellbook = None
+        self.filterQuery = {} # Name, description text, classes, sources, ranges and flags from the FilterBar, see applyFilters
+        self.tagQuery = [] # Tags from the TagBar
+        self.queryCache = loader.QueryCache()
         self.tags = {}
+        self.tagVersion = 0
+        self.orphanTags = {}
+        self.startupComplete = False
+        self.cardRenderer = None
+        self.startupTimer = StartupTimer()
+        self.startupTimer.mark("import")
+        # Only the window shell is built here. The spellbook, docks and full table are built
+        # by the startup stages once the event loop is running, see startup()
         self.initUI()
-        self.initDockWidgets()
         self.initMenu()
         self.initStatusBar()
-        self.restoreTags()
+        self.menuBar().setEnabled(False)
         self.show()
+        self.startupTimer.mark("shell")
+
+    def startup(self):
+        # Each stage is queued behind the events of the previous one, so the window stays
+        # responsive and gets painted between stages. The first screenful comes from the start of
+        # the cache, then the spellbook, indexes and tags are loaded on a thread (see startupLoad),
+        # and the docks and full table are built once they're in
+        self.startupLoaded.connect(self.startupContinue)
+        self.runStages([self.startupFirstPaint, self.startupLoad])
+
+    def runStages(self, stages):
+        def runStage(i=0):
+            with instrument.span("startup." + stages[i].__name__):
+                stages[i]()
+            if i + 1 < len(stages):
+                QTimer.singleShot(0, lambda: runStage(i + 1))
+        QTimer.singleShot(0, runStage)
+
+    def startupFirstPaint(self):
+        rowHeight = self.table.verticalHeader().defaultSectionSize()
+        rows = self.table.viewport().height() // rowHeight + 1
+        spells = []
+        if os.path.isfile(CACHE_FILENAME):
+            try: # Only the first spells of the cache, as many as fit, sorted the way the full table is
+                spells = sorted(itertools.islice(loader.iter_cache(CACHE_FILENAME), rows), key=loader.SORT_KEYS["name"])
+            except (ValueError, KeyError, OSError): pass # Unreadable cache, startupLoad rebuilds it
+        self.updateTable(spells)
+        self.resizeTableCols(True)
+        self.resizeTableRows()
+        screenH, screenW = screenSize()
+        self.resize(int(min(self.table.width() + COLUMN_LONG, screenW*MAIN_HEIGHT_RATIO)), int(min(screenH*DEFAULT_HEIGHT_RATIO, screenH*MAIN_WIDTH_RATIO)))
+        self.restore()
+        self.table.viewport().repaint()
+        self.startupTimer.mark("first paint")
+
+    def startupLoad(self):
+        # The sort keys come from the table, so they're taken here rather than on the thread
+        sortKeys = self.tableModel.sortKeys()
+        def load():
+            try:
+                with instrument.span("startup.load"):
+                    self.loadSpellbook()
+                    self.spellbook.snapshot().prepare(sortKeys)
+                    parallel.attach(self.spellbook.snapshot()) # Only does anything for very large spellbooks
+                    self.loadTags()
+            except Exception as e:
+                self.startupLoaded.emit(e)
+                return
+            self.startupLoaded.emit(None)
+        threading.Thread(target=load, name="startup-load", daemon=True).start()
+
+    def startupContinue(self, error):
+        if error is not None: raise error
+        self.startupTimer.mark("load")
+        self.runStages([self.startupDocks, self.startupFullTable])
+
+    def startupDocks(self):
+        self.initDockWidgets()
+        self.initDockMenu()
+        self.startupTimer.mark("docks")
+
+    def startupFullTable(self):
+        self.updateTable(self.spellbook.spells)
+        self.resizeTableCols()
+        self.resizeTableRows()
+        self.table.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.menuBar().setEnabled(True)
+        self.startupComplete = True
+        self.startupTimer.mark("full table")
+        self.statusBar().showMessage("First paint in {:.0f} ms".format(self.startupTimer.elapsed("first paint")), 5000)
+        self.reportOrphanTags()
+        self.reportRejects()
+        if STARTUP_REPORT: print(self.startupTimer.report())
+        self.watchSpreadsheets()
+        self.startupFinished.emit()
+
+    def loadSpellbook(self):
+        if self.currentSettings['sharedSpellbook']:
+            try: # Another window has published these spells already
+                self.spellbook, self.sharedStamp = flatbook.attach(SHARED_FILENAME, CACHE_FILENAME)
+                return
+            except (ValueError, KeyError, OSError): pass # Nothing published yet, or it's older than the cache
+        if os.path.isfile(CACHE_FILENAME):
+            try:
+                self.spellbook = loader.Spellbook.from_cache(CACHE_FILENAME)
+                self.publishSpellbook()
+                return
+            except (ValueError, KeyError, OSError): pass # Unreadable cache, rebuild it from the spreadsheet
+        self.spellbook = self.readSpreadsheets()
+        self.saveCache()
+
+    def readSpreadsheets(self):
+        # With added spreadsheets every one is cached separately, so a reload only reads the ones that changed
+        if not self.extraSpreadsheets:
+            return loader.Spellbook.from_workbook(self.spellspreadsheet)
+        return loader.Spellbook.from_workbooks([self.spellspreadsheet] + self.extraSpreadsheets, SOURCES_DIRNAME)
+
+    def saveCache(self, lazyDescriptions=None):
+        # Writes whichever spells are current when the write runs, so a reload in the meantime is what gets saved
+        if lazyDescriptions is None: lazyDescriptions = self.currentSettings['lazyDescriptions']
+        spellbook = self.spellbook
+        self.writer.submit(CACHE_FILENAME, lambda: spellbook.to_cache(CACHE_FILENAME, lazy_descriptions=lazyDescriptions))
+        self.publishSpellbook() # Queued after the cache, which a shared spellbook is checked against
+
+    def publishSpellbook(self):
+        if not self.currentSettings['sharedSpellbook']: return
+        stamp = self.sharedStamp = os.urandom(8).hex()
+        spellbook = self.spellbook
+        self.writer.submit(SHARED_FILENAME, lambda: flatbook.publish(spellbook, SHARED_FILENAME, stamp, CACHE_FILENAME))
+
+    def checkSharedSpellbook(self):
+        # Picks up spells another window published after reloading the spreadsheet
+        if not self.startupComplete or not self.currentSettings['sharedSpellbook']: return
+        if self.writer.is_pending(CACHE_FILENAME) or self.writer.is_pending(SHARED_FILENAME): return # Publishing our own
+        published = flatbook.current(SHARED_FILENAME, CACHE_FILENAME)
+        if published is None or published["stamp"] == self.sharedStamp: return
+        try:
+            spellbook, self.sharedStamp = flatbook.attach(SHARED_FILENAME, CACHE_FILENAME)
+        except (ValueError, KeyError, OSError): return
+        previous = self.spellbook.snapshot()
+        spells, _, _, _ = loader.diff_spells(previous.spells, spellbook.spells)
+        self.spellbook.publish(previous.patched(spells, spellbook.rejects).prepare(self.tableModel.sortKeys()))
+        parallel.attach(self.spellbook.snapshot())
+        self.tags, self.orphanTags = tagstore.remap_tags(self.tags, self.spellbook.spells)
+        self.tagVersion += 1
+        self.tagBar.widget().reupTagBox()
+        self.refreshTable()
+        self.statusBar().showMessage("Spellbook reloaded by another window", 5000)
 
     def initUI(self):
         self.spellheaders = {
@@ -608,66 +1208,85 @@ class MainWindow(QMainWindow):
                 "value": lambda spell: spell.name,
                 "tooltip": None,
                 "size": COLUMN_MED,
+                "sortkey": "name",
                 "enabled": True
             },
             "Level": {
                 "value": lambda spell: spell.level,
                 "tooltip": None,
                 "size": COLUMN_TINY,
+                "sortkey": "level",
                 "enabled": True
             },
             "Classes": {
                 "value": lambda spell: pprintClasses(spell) if self.expandRowsAction.isChecked() else generateClassStr(spell),
                 "tooltip": lambda spell: None if self.expandRowsAction.isChecked() else pprintClasses(spell),
                 "size": COLUMN_SHORT,
+                "sortkey": "classes",
                 "enabled": True
             },
             "Origin": {
                 "value": lambda spell: spell.origin,
                 "tooltip": None,
                 "size": COLUMN_SHORT,
+                "sortkey": "origin",
                 "enabled": False
             },
             "School": {
                 "value": lambda spell: spell.school,
                 "tooltip": None,
                 "size": COLUMN_SHORT,
+                "sortkey": "school",
                 "enabled": True
             },
             "Ritual": {
                 "value": lambda spell: "Yes" if spell.ritual else "No",
                 "tooltip": None,
                 "size": COLUMN_SHORT,
+                "sortkey": "ritual",
                 "enabled": False
             },
             "Time": {
                 "value": lambda spell: spell.time,
                 "tooltip": None,
                 "size": COLUMN_TINY,
+                "sortkey": "time",
                 "enabled": True
             },
             "Range": {
                 "value": lambda spell: spell.range,
                 "tooltip": None,
                 "size": COLUMN_TINY,
+                "sortkey": "range",
                 "enabled": True
             },
             "Comp": {
                 "value": lambda spell: pprintComp(spell) if self.expandRowsAction.isChecked() and self.currentSettings['expandComp'] else spell.compstr,
                 "tooltip": lambda spell: None if self.expandRowsAction.isChecked() and self.currentSettings['expandComp'] else pprintComp(spell),
                 "size": COLUMN_SHORT,
+                "sortkey": "compstr",
                 "enabled": True
             },
             "Duration": {
                 "value": lambda spell: spell.duration,
                 "tooltip": None,
                 "size": COLUMN_SHORT,
+                "sortkey": "duration",
                 "enabled": True
             },
+            "Source": {
+                "value": lambda spell: spell.__dict__.get("source"),
+                "tooltip": None,
+                "size": COLUMN_SHORT,
+                "sortkey": "source",
+                "enabled": False
+            },
             "Tag": {
                 "value": lambda spell: generateTagStr(spell, self.tags),
                 "tooltip": lambda spell: pprintTags(spell, self.tags),
                 "size": COLUMN_SHORT,
+                "sortkey": lambda spell: generateTagStr(spell, self.tags) or "",
+                "sortkeyVersion": lambda: self.tagVersion,
                 "enabled": True
             },
             "Description": {
@@ -675,20 +1294,36 @@ class MainWindow(QMainWindow):
                 "value": self.descriptionlogic,
                 "tooltip": lambda spell: addLineBreaks(str(spell.description)),
                 "size": COLUMN_LONG,
+                "sortkey": "description",
                 "enabled": True
             }
         }
 
-        table = QTableWidget(1, len(self.spellheaders))
-        table.setHorizontalHeaderLabels(list(self.spellheaders.keys()))
+        tableModel = SpellTableModel(self)
+        table = QTableView()
+        table.setModel(tableModel)
         table.setSelectionBehavior(QAbstractItemView.SelectRows)
         table.setSelectionMode(QAbstractItemView.NoSelection)
         table.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Preferred)
         table.setWordWrap(True)
-        table.setContextMenuPolicy(Qt.CustomContextMenu)
+        table.setContextMenuPolicy(Qt.NoContextMenu) # Enabled once startup has finished
         table.customContextMenuRequested.connect(self.showTableContextMenu)
 
+        # Row heights are only measured for rows near the viewport, see sizeVisibleRows
+        self.textDelegate = WrappedTextDelegate(self)
+        table.setItemDelegate(self.textDelegate)
+        self.sizedRows = set()
+        self.rowSizingScheduled = False
+        tableModel.modelReset.connect(self.resetRowSizes)
+        tableModel.layoutChanged.connect(self.resetRowSizes)
+        table.verticalScrollBar().valueChanged.connect(self.scheduleRowSizing)
+        table.verticalScrollBar().rangeChanged.connect(self.scheduleRowSizing)
+        table.horizontalHeader().sectionResized.connect(self.resetRowSizes)
+
         self.table = table
+        self.tableModel = tableModel
+        self.tableModel.sortColumns = [("Name", Qt.AscendingOrder)]
+        self.table.setSortingEnabled(True)
         self.table.sortByColumn(0, Qt.AscendingOrder)
 
         self.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
@@ -713,12 +1348,18 @@ class MainWindow(QMainWindow):
         return currentSettings
 
     def saveSettings(self):
-        self.regSettings.beginGroup("settings")
-        for settingkey, value in self.currentSettings.items():
-            if value == "true":  value = "true_"
-            if value == "false": value = "false_"
-            self.regSettings.setValue(settingkey, value)
-        self.regSettings.endGroup()
+        # Written on the persistence thread with its own QSettings, which are reentrant but not thread safe
+        currentSettings = dict(self.currentSettings)
+        def write():
+            regSettings = QSettings(PROGRAM_AUTHOR, PROGRAM_NAME)
+            regSettings.beginGroup("settings")
+            for settingkey, value in currentSettings.items():
+                if value == "true":  value = "true_"
+                if value == "false": value = "false_"
+                regSettings.setValue(settingkey, value)
+            regSettings.endGroup()
+            regSettings.sync()
+        self.writer.submit("settings", write)
 
     def openSettingsDialog(self):
         dialog = SettingsDialog(self.settingsTemplate, self.currentSettings)
@@ -735,11 +1376,12 @@ class MainWindow(QMainWindow):
             self.saveSettings()
 
     def descriptionlogic(self, spell):
-        if not spell.description: return None
         if self.expandRowsAction.isChecked():
-            return spell.description
+            return spell.description if spell.description else None
         else:
-            return spell.description.replace("\n", " ")
+            # Collapsed rows only show the start of the description anyway
+            preview = spell.description_preview(DESCRIPTION_PREVIEW_CHARS)
+            return preview.replace("\n", " ") if preview else None
 
     def setSpellbook(self):
         dialog = QFileDialog()
@@ -757,24 +1399,83 @@ class MainWindow(QMainWindow):
                 return True
         return False
 
-    def reloadSpellbook(self):
+    def reloadSpellbook(self, automatic=False):
+        # automatic is a reload of a watched spreadsheet that was saved, which reports to the status bar
+        # rather than with dialogs, and tries again later if the spreadsheet is mid save
         if not os.path.exists(self.spellspreadsheet):
+            if automatic:
+                self.watchTimer.start()
+                return
             QMessageBox.critical(self, "Reload Error", "The currently loaded spreadsheet no longer exists.\nPlease select a new spreadsheet.")
             self.setSpellbook()
-        self.filterCondition = lambda spell: True
-        self.tagCondition = lambda spell: True
-        os.remove(CACHE_FILENAME)
-        self.spellbook = loader.Spellbook.from_workbook(self.spellspreadsheet)
-        self.spellbook.to_cache(CACHE_FILENAME)
-        self.updateTable(self.spellbook.spells)
-        self.dirLabel.setText(self.spellspreadsheet + " ") # Space for padding
-        self.resizeTableCols()
-        self.resizeTableRows()
+        previous = self.spellbook.snapshot()
+        orphanCount = len(self.orphanTags)
+        try:
+            spellbook = self.readSpreadsheets()
+        except Exception as e:
+            if not automatic: raise
+            self.statusBar().showMessage("Couldn't reload the spreadsheet: {}".format(e), 10000)
+            self.watchSpreadsheets()
+            return
+        # Spells that didn't change are kept as they were, along with their index entries and table rows.
+        # The new snapshot and the indexes the table's sort needs are built before being published in one go.
+        # Anything still working from the previous snapshot (printing cards, say) carries on with it
+        spells, added, removed, changed = loader.diff_spells(previous.spells, spellbook.spells)
+        self.spellbook.publish(previous.patched(spells, spellbook.rejects).prepare(self.tableModel.sortKeys()))
+        parallel.attach(self.spellbook.snapshot())
+        if added or removed or changed: self.saveCache()
+        # Tags still keyed by the old spell hashes are moved over to spell ids, using the spells from before the reload
+        self.tags, self.orphanTags = tagstore.remap_tags(self.tags, self.spellbook.spells, previous.spells)
+        self.saveTags()
+        self.tagBar.widget().reupTagBox()
+        if len(self.orphanTags) > orphanCount:
+            self.reportOrphanTags(dialog=not automatic)
+        self.reportRejects(dialog=not automatic)
+        filterBar = self.filterBar.widget().widget()
+        filterBar.reupSources()
+        if "sources" in self.filterQuery: self.filterQuery["sources"] = filterBar.collectSources() # Sources that are gone can't be filtered by
+        self.refreshTable()
+        self.dirLabel.setText(self.spreadsheetsLabel())
+        self.watchSpreadsheets()
+        if not self.spellbook.rejects or not automatic:
+            self.statusBar().showMessage("Reloaded: {} added, {} removed, {} changed".format(len(added), len(removed), len(changed)), 5000)
+
+    def watchSpreadsheets(self):
+        # Spreadsheet programs save by replacing the file, which the watcher stops watching, so the files are watched again after every reload
+        if self.watcher.files(): self.watcher.removePaths(self.watcher.files())
+        if not self.currentSettings['watchSpreadsheet']: return
+        filepaths = [filepath for filepath in [self.spellspreadsheet] + self.extraSpreadsheets if os.path.isfile(filepath)]
+        if filepaths: self.watcher.addPaths(filepaths)
 
     def reloadFromFileWrapper(self):
         result = self.setSpellbook()
         if result: self.reloadSpellbook()
 
+    def addSpreadsheet(self):
+        dialog = QFileDialog()
+        dialog.setWindowTitle("Add Excel Spellbook")
+        dialog.setAcceptMode(QFileDialog.AcceptOpen)
+        dialog.setFileMode(QFileDialog.ExistingFiles)
+        dialog.setNameFilter("*.xlsx")
+        dialog.setDirectory(os.getcwd())
+        if not dialog.exec(): return
+        known = {os.path.abspath(filepath) for filepath in [self.spellspreadsheet] + self.extraSpreadsheets}
+        added = [os.path.relpath(filepath) for filepath in dialog.selectedFiles() if os.path.abspath(filepath) not in known]
+        if not added: return
+        self.extraSpreadsheets += added
+        self.regSettings.setValue("extraSpreadsheets", self.extraSpreadsheets)
+        self.reloadSpellbook()
+
+    def removeSpreadsheets(self):
+        if not self.extraSpreadsheets: return
+        self.extraSpreadsheets = []
+        self.regSettings.setValue("extraSpreadsheets", self.extraSpreadsheets)
+        self.reloadSpellbook()
+
+    def spreadsheetsLabel(self):
+        extra = " (+{} more)".format(len(self.extraSpreadsheets)) if self.extraSpreadsheets else ""
+        return self.spellspreadsheet + extra + " " # Space for padding
+
     def initDataFiles(self):
         head, tail = os.path.split(CACHE_FILENAME)
         if head and not os.path.isdir(head): os.makedirs(head)
@@ -793,30 +1494,35 @@ class MainWindow(QMainWindow):
         dialog.setNameFilter("*.tags")
         if dialog.exec() and len(dialog.selectedFiles()) > 0:
             filepath = dialog.selectedFiles()[0]
-            msgBox = QMessageBox()
-            msgBox.setText("Are you sure you want to import?")
-            msgBox.setInformativeText("This will replace all current tags")
-            msgBox.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
-            if msgBox.exec() == QMessageBox.Yes:
-                try: # QA tests
-                    with open(filepath) as f:
-                        data = json.loads(f.read()) # Does it json parse?
-                        if type(data) != dict: raise ValueError() # Is it a dictionary?
-                        for key in data: # Is every value...
-                            if type(key) != str: raise ValueError() # A str?
-                            _ = int(key) # A number?
-                            value = data[key] # ...and connected to...
-                            if type(value) != list: raise ValueError() # A list?
-                            for entry in value: # of strs?
-                                if type(entry) != str: raise ValueError()
-                except json.JSONDecodeError:
-                    msgBox.critical(self, "Error", "Error importing tags\nTags file cannot be read\n(JSON decode error)")
-                except ValueError or KeyError:
-                    msgBox.critical(self, "Error", "Error importing tags\nTags file cannot be read\n(Misc read error)")
-                else:
-                    os.remove(TAGS_FILENAME)
-                    shutil.copyfile(filepath, TAGS_FILENAME)
-                    self.restoreTags()
+            msgBox = QMessageBox(self)
+            msgBox.setWindowTitle("Import Tags")
+            msgBox.setText("How should the imported tags be combined with yours?")
+            msgBox.setInformativeText(
+                "Merge adds the imported tags to the ones you have.\n"
+                "Replace drops your tags and keeps only the imported ones.\n"
+                "Only Existing Spells merges, but skips tags for spells that aren't in your spellbook.")
+            buttons = {
+                msgBox.addButton("Merge", QMessageBox.AcceptRole): "merge",
+                msgBox.addButton("Replace", QMessageBox.DestructiveRole): "replace",
+                msgBox.addButton("Only Existing Spells", QMessageBox.AcceptRole): "existing",
+            }
+            msgBox.addButton(QMessageBox.Cancel)
+            msgBox.exec()
+            mode = buttons.get(msgBox.clickedButton())
+            if mode is None: return
+            try: # The file is checked entry by entry as it's read, and nothing changes unless all of it is good
+                with instrument.span("tags.import", mode=mode):
+                    tags, counts = tagstore.import_tags(self.tags, tagstore.iter_tag_file(filepath), self.spellbook.spells, mode)
+            except (ValueError, OSError) as e:
+                QMessageBox.critical(self, "Error", "Error importing tags\n" + str(e))
+                return
+            self.tags, self.orphanTags = tagstore.remap_tags(tags, self.spellbook.spells)
+            self.tagVersion += 1
+            self.saveTags()
+            self.tagBar.widget().reupTagBox()
+            self.applyFilters()
+            self.statusBar().showMessage("Imported tags: {merged} merged, {skipped} skipped, {orphaned} orphaned".format(**counts), 10000)
+            if counts["orphaned"]: self.reportOrphanTags(dialog=True)
 
     def exportTags(self):
         dialog = QFileDialog()
@@ -826,29 +1532,104 @@ class MainWindow(QMainWindow):
         dialog.setNameFilter("*.tags")
         if dialog.exec() and len(dialog.selectedFiles()) > 0:
             self.saveTags()
+            self.writer.flush()
             filepath = dialog.selectedFiles()[0]
             shutil.copyfile(TAGS_FILENAME, filepath)
         else:
             QMessageBox.warning(self, " ", "Tags not exported.")
 
+    def exportView(self):
+        # Exports the spells and columns currently shown, in the order shown
+        filepath, _ = QFileDialog.getSaveFileName(self, "Export View", os.getcwd(), EXPORT_FILTERS)
+        if not filepath: return
+        spells = self.spells
+        progressDialog = QProgressDialog("Exporting spells...", "Cancel", 0, len(spells), self)
+        progressDialog.setWindowModality(Qt.WindowModal)
+        progressDialog.setMinimumDuration(500)
+        def progress(done, total):
+            progressDialog.setValue(done)
+            QApplication.processEvents()
+            return not progressDialog.wasCanceled()
+        try:
+            with instrument.span("export.view", rows=len(spells)):
+                exported = export.export(spells, filepath, columns=self.visibleColumns(), tags=self.tags, progress=progress)
+        except (ValueError, OSError) as e:
+            progressDialog.close()
+            QMessageBox.warning(self, " ", "Export failed: " + str(e))
+            return
+        progressDialog.close()
+        if exported:
+            self.statusBar().showMessage("Exported {} spells to {}".format(len(spells), filepath), 10000)
+
+    def printCards(self):
+        # Renders cards for the spells shown, in the order shown, on a worker thread
+        if self.cardRenderer is not None and self.cardRenderer.isRunning():
+            QMessageBox.warning(self, " ", "Cards are already being rendered.")
+            return
+        filepath, _ = QFileDialog.getSaveFileName(self, "Print Cards", os.getcwd(), "PDF (*.pdf)")
+        if not filepath: return
+        renderer = cards.CardRenderer(self.spells, filepath, self.tags, self)
+        progressDialog = QProgressDialog("Rendering spell cards...", "Cancel", 0, len(renderer.spells), self)
+        progressDialog.setMinimumDuration(500)
+        progressDialog.canceled.connect(renderer.cancel)
+        renderer.progress.connect(lambda done, total: progressDialog.setValue(done))
+        renderer.rendered.connect(lambda filename: self.statusBar().showMessage(
+            "Rendered {} cards to {}".format(len(renderer.spells), filename), 10000))
+        renderer.failed.connect(lambda error: QMessageBox.warning(self, " ", "Printing cards failed: " + error))
+        renderer.finished.connect(progressDialog.close)
+        self.cardRenderer = renderer
+        renderer.start()
+
     def saveTags(self):
-        with open(TAGS_FILENAME, "w") as f:
-            f.write(json.dumps(self.tags))
+        with instrument.span("tags.save"):
+            # The window goes on changing the tag lists in place, so the write gets its own copy
+            tags = {key: list(values) for key, values in self.tags.items()}
+            self.writer.submit(TAGS_FILENAME, lambda: tagstore.save_tags(tags, TAGS_FILENAME))
+
+    def loadTags(self):
+        with instrument.span("tags.load"):
+            tags = tagstore.load_tags(TAGS_FILENAME)
+            self.tags, self.orphanTags = tagstore.remap_tags(tags, self.spellbook.spells)
+            self.tagVersion += 1
+            if self.tags != tags: self.saveTags() # Save the move from spell hashes to spell ids
+
+    def reportOrphanTags(self, dialog=False):
+        # Orphaned tags are kept in case the spell comes back (or was renamed by mistake), but the user should know about them
+        if not self.orphanTags: return
+        message = "{} tagged spell(s) don't match any spell in the spellbook. Their tags have been kept.".format(len(self.orphanTags))
+        if dialog:
+            names = sorted(self.orphanTags)
+            details = "\n".join(names[:10]) + ("\n..." if len(names) > 10 else "")
+            QMessageBox.warning(self, "Orphaned Tags", message + "\n\n" + details)
+        else:
+            self.statusBar().showMessage(message, 10000)
+
+    def reportRejects(self, dialog=False):
+        # Rows of the spreadsheet that couldn't be read as a spell, see loader.decode_rows
+        rejects = self.spellbook.rejects
+        if not rejects: return
+        message = "{} row(s) of the spreadsheet couldn't be read and were skipped.".format(len(rejects))
+        if dialog:
+            details = "\n".join("{}Row {}: {} ({})".format(reject["source"] + ", " if reject.get("source") else "", reject["row"], reject["name"] or "No name", reject["reason"])
+                                for reject in rejects[:10])
+            QMessageBox.warning(self, "Skipped Rows", message + "\n\n" + details + ("\n..." if len(rejects) > 10 else ""))
+        else:
+            self.statusBar().showMessage(message, 10000)
 
     def restoreTags(self):
-        with open(TAGS_FILENAME) as f:
-            data = json.loads(f.read())
-            self.tags = {int(key):data[key] for key in data}
+        self.loadTags()
         self.tagBar.widget().reupTagBox()
         self.updateTable(self.spells)
         self.resizeTableCols()
 
     def applyFilters(self):
-        mainCondition = lambda spell: self.filterCondition(spell) and self.tagCondition(spell)
-        spells = self.spellbook.search(mainCondition)
-        self.updateTable(spells)
-        self.resizeTableCols()
-        self.resizeTableRows()
+        with instrument.span("filter.apply"):
+            # Recent views come straight from the query cache, which is emptied whenever the spellbook or tags change
+            query = loader.Query(tags=self.tagQuery, **self.filterQuery)
+            spells = self.queryCache.search(self.spellbook, query, self.tags, self.tagVersion)
+            self.updateTable(spells, ordered=query.ordered)
+            self.resizeTableCols()
+            self.resizeTableRows()
         
     def addTag(self, row=None, bulk=False):
         spell = self.spells[row] if not bulk else None
@@ -858,41 +1639,37 @@ class MainWindow(QMainWindow):
             if tag == "Add New...":
                 tag, state = QInputDialog.getText(self, "New Tag", "Enter a new tag:", QLineEdit.Normal, "")
                 if not state: return
-            if bulk:
-                for spell in self.spells: # Loop through and tag all spells rather than selected spell
-                    if hash(spell) in self.tags:
-                        self.tags[hash(spell)].append(tag)
-                    else:
-                        self.tags[hash(spell)] = [tag]
-            else:
-                if hash(spell) in self.tags:
-                    self.tags[hash(spell)].append(tag)
-                else:
-                    self.tags[hash(spell)] = [tag]
-            self.updateTable(self.spells)
-            self.resizeTableCols()
-            self.tagBar.widget().reupTagBox()
-            self.saveTags()
+            # If bulk, tag all shown spells rather than the selected spell
+            self.tagSpells(self.spells if bulk else [spell], tag)
 
     def removeTag(self, row=None, bulk=False):
         spell = self.spells[row] if not bulk else None
         dialog = TagDialog(self.tags, spell, remove=True, bulk=bulk)
         if dialog.exec():
-            tag = dialog.tag
-            if bulk:
-                for spell in self.spells: # Loop through and untag all spells rather than selected spell
-                    if hash(spell) in self.tags and tag in self.tags[hash(spell)]:
-                        self.tags[hash(spell)].remove(tag)
-                        if self.tags[hash(spell)] == []:
-                            self.tags.pop(hash(spell))
+            self.untagSpells(self.spells if bulk else [spell], dialog.tag)
+
+    def tagSpells(self, spells, tag):
+        for spell in spells:
+            if spell.id in self.tags:
+                self.tags[spell.id].append(tag)
             else:
-                self.tags[hash(spell)].remove(tag)
-                if self.tags[hash(spell)] == []:
-                    self.tags.pop(hash(spell))
-            self.updateTable(self.spells)
-            self.resizeTableCols()
-            self.tagBar.widget().reupTagBox()
-            self.saveTags()
+                self.tags[spell.id] = [tag]
+        self.refreshTags()
+
+    def untagSpells(self, spells, tag):
+        for spell in spells:
+            if spell.id in self.tags and tag in self.tags[spell.id]:
+                self.tags[spell.id].remove(tag)
+                if self.tags[spell.id] == []:
+                    self.tags.pop(spell.id)
+        self.refreshTags()
+
+    def refreshTags(self):
+        self.tagVersion += 1
+        self.updateTable(self.spells)
+        self.resizeTableCols()
+        self.tagBar.widget().reupTagBox()
+        self.saveTags()
 
     def wipeTags(self):
         msgBox = QMessageBox()
@@ -901,17 +1678,18 @@ class MainWindow(QMainWindow):
         msgBox.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
         if msgBox.exec() == QMessageBox.Yes:
             self.tags = {}
-            self.updateTable(self.spells)
-            self.resizeTableCols()
-            self.tagBar.widget().reupTagBox()
-            self.saveTags()
+            self.refreshTags()
 
     def initMenu(self):
         menuBar = self.menuBar()
 
         fileMenu = menuBar.addMenu("&File")
         openNewAction = fileMenu.addAction("&Open New File")
+        addFileAction = fileMenu.addAction("&Add File...")
+        removeFilesAction = fileMenu.addAction("Remove A&dded Files")
         reloadAction = fileMenu.addAction("&Reload Current File")
+        exportViewAction = fileMenu.addAction("E&xport View...")
+        printCardsAction = fileMenu.addAction("Print &Cards...")
         settingsAction = fileMenu.addAction("&Preferences")
         quitAction = fileMenu.addAction("&Quit")
 
@@ -941,15 +1719,23 @@ class MainWindow(QMainWindow):
         visBarAction.setCheckable(True)
         tagBarAction = windowMenu.addAction("&Tags")
         tagBarAction.setCheckable(True)
+        self.filterBarAction = filterBarAction
+        self.visBarAction = visBarAction
+        self.tagBarAction = tagBarAction
 
         if DEBUG:
-            debugAction = menuBar.addAction("Debug")
-            debugAction.triggered.connect(self.debug)
+            debugBarAction = windowMenu.addAction("&Debug")
+            debugBarAction.setCheckable(True)
+            self.debugBarAction = debugBarAction
 
         openNewAction.triggered.connect(self.reloadFromFileWrapper)
-        reloadAction.triggered.connect(self.reloadSpellbook)
+        addFileAction.triggered.connect(self.addSpreadsheet)
+        removeFilesAction.triggered.connect(self.removeSpreadsheets)
+        reloadAction.triggered.connect(lambda: self.reloadSpellbook())
+        exportViewAction.triggered.connect(self.exportView)
+        printCardsAction.triggered.connect(self.printCards)
         settingsAction.triggered.connect(self.openSettingsDialog)
-        quitAction.triggered.connect(lambda: app.exit(0))
+        quitAction.triggered.connect(lambda: QApplication.exit(0))
 
         expandRowsAction.triggered.connect(lambda: self.updateTable())
         expandRowsAction.triggered.connect(lambda: self.resizeTableCols())
@@ -973,6 +1759,9 @@ class MainWindow(QMainWindow):
         stateSaveAction.triggered.connect(self.save)
         stateRestoreAction.triggered.connect(self.restore)
 
+    def initDockMenu(self):
+        # The docks are built after the menu during startup, so their actions are connected separately
+        filterBarAction, visBarAction, tagBarAction = self.filterBarAction, self.visBarAction, self.tagBarAction
         filterBarAction.changed.connect(lambda: self.filterBar.setHidden(not filterBarAction.isChecked()))
         self.filterBar.visibilityChanged.connect(lambda: filterBarAction.setChecked(not self.filterBar.isHidden()))
         filterBarAction.setChecked(not self.filterBar.isHidden())
@@ -985,18 +1774,21 @@ class MainWindow(QMainWindow):
         self.tagBar.visibilityChanged.connect(lambda: tagBarAction.setChecked(not self.tagBar.isHidden()))
         tagBarAction.setChecked(not self.tagBar.isHidden())
 
-    def debug(self):
-        print("debug")
+        if DEBUG:
+            debugBarAction = self.debugBarAction
+            debugBarAction.changed.connect(lambda: self.debugBar.setHidden(not debugBarAction.isChecked()))
+            self.debugBar.visibilityChanged.connect(lambda: debugBarAction.setChecked(not self.debugBar.isHidden()))
+            debugBarAction.setChecked(not self.debugBar.isHidden())
 
     def showTableContextMenu(self, pos):
-        item = self.table.itemAt(pos)
-        if not item: return
-        row = item.unsortedRow
+        index = self.table.indexAt(pos)
+        if not index.isValid(): return
+        row = index.row()
         contextMenu = QMenu()
 
         addTagAction = contextMenu.addAction("&Add Tag")
         addTagAction.triggered.connect(lambda: self.addTag(row))
-        if hash(self.spells[row]) in self.tags:
+        if self.spells[row].id in self.tags:
             removeTagAction = contextMenu.addAction("&Remove Tag")
             removeTagAction.triggered.connect(lambda: self.removeTag(row))
 
@@ -1004,6 +1796,12 @@ class MainWindow(QMainWindow):
 
     def closeEvent(self, *args, **kwargs):
         self.save()
+        if self.cardRenderer is not None and self.cardRenderer.isRunning():
+            self.cardRenderer.cancel()
+            self.cardRenderer.wait()
+        self.writer.close() # Anything still queued is written first
+        parallel.close()
+        if TRACE_FILENAME: instrument.export_chrome_trace(TRACE_FILENAME)
         return super().closeEvent(*args, **kwargs)
 
     def save(self):
@@ -1020,13 +1818,27 @@ class MainWindow(QMainWindow):
 
     def initStatusBar(self):
         statusBar = self.statusBar()
-        dirLabel = QLabel(self.spellspreadsheet + " ") # Space for padding
+        dirLabel = QLabel(self.spreadsheetsLabel())
         countLabel = QLabel("Count: 0")
         statusBar.addPermanentWidget(dirLabel)
         statusBar.addPermanentWidget(countLabel)
         #statusBar.setSizeGripEnabled(False)
         self.dirLabel = dirLabel
         self.countLabel = countLabel
+        if DEBUG:
+            spanLabel = QLabel()
+            statusBar.addPermanentWidget(spanLabel)
+            self.spanLabel = spanLabel
+            debugTimer = QTimer(self)
+            debugTimer.timeout.connect(self.updateDebugReadout)
+            debugTimer.start(DEBUG_REFRESH_INTERVAL)
+
+    def updateDebugReadout(self):
+        if instrument.last_span:
+            name, elapsed = instrument.last_span
+            self.spanLabel.setText("{} {:.1f} ms ".format(name, elapsed * 1000))
+        if self.startupComplete and not self.debugBar.isHidden():
+            self.debugBar.widget().refresh()
 
     def initDockWidgets(self):
         self.setDockOptions(
@@ -1059,67 +1871,149 @@ class MainWindow(QMainWindow):
         self.addDockWidget(Qt.LeftDockWidgetArea, visBar)
         self.addDockWidget(Qt.RightDockWidgetArea, tagBar)
 
-    def updateTable(self, spells=None, alignment=Qt.AlignVCenter):
+        if DEBUG:
+            debugBar = QDockWidget("Debug")
+            debugBar.setAllowedAreas(Qt.LeftDockWidgetArea | Qt.RightDockWidgetArea)
+            debugBar.setWidget(DebugBar(self))
+            self.debugBar = debugBar
+            self.addDockWidget(Qt.RightDockWidgetArea, debugBar)
+
+    def updateTable(self, spells=None, alignment=Qt.AlignVCenter, ordered=None):
+        with instrument.span("table.populate"):
+            self.populateTable(spells, alignment, ordered)
+
+    def populateTable(self, spells, alignment, ordered):
+        # With ordered the spells are shown in the order given rather than sorted. By default the
+        # current view keeps whichever it had
+        if ordered is None: ordered = self.tableModel.ordered and (spells is None or spells is self.spells)
         spells = spells if not spells == None else self.spells
-        self.spells = spells
-        self.table.setSortingEnabled(False)
-        self.table.clearContents()
-        spellheaders = {x:self.spellheaders[x] for x in self.spellheaders if self.spellheaders[x]['enabled']}
-        self.table.setColumnCount(len(spellheaders))
-        self.table.setHorizontalHeaderLabels(spellheaders.keys())
-        self.table.setRowCount(len(spells))
-        for x, spell in enumerate(spells):
-            row = [x for x in spellheaders.values()]
-            for y, cell in enumerate(row):
-                item = QTableWidgetItem(str(row[y]['value'](spell)))
-                item.setFlags(TABLEITEM_FLAGS_NOEDIT)
-                item.setTextAlignment(alignment)
-                item.unsortedRow = x
-                if row[y]["tooltip"] != None:#
-                    item.setToolTip(row[y]['tooltip'](spell))
-                self.table.setItem(x, y, item)
-            if self.currentSettings['updateTableProcessEvents']:
-                app.processEvents()
+        # The model has every column, the ones turned off in the Visibility dock are hidden in the view.
+        # Hidden cells are never asked for, so they cost nothing
+        columns = list(self.spellheaders)
+        self.tableModel.setSpells(spells, columns, alignment, ordered)
+        self.applyColumnVisibility() # Resetting the model shows every column again
+        instrument.count("table.rows", len(spells))
         self.countLabel.setText("Count: "+str(len(spells)))
-        self.table.setSortingEnabled(True)
-        #self.table.sortByColumn(0, Qt.AscendingOrder)
+        header = self.table.horizontalHeader()
+        header.blockSignals(True)
+        if ordered:
+            header.setSortIndicator(-1, Qt.AscendingOrder)
+        elif self.tableModel.sortColumns:
+            name, order = self.tableModel.sortColumns[0]
+            header.setSortIndicator(columns.index(name), order)
+        header.blockSignals(False)
+
+    def refreshTable(self):
+        # Runs the current filters again after the spells changed, and updates only the rows that differ.
+        # Unlike updateTable the view keeps its scroll position
+        with instrument.span("table.refresh"):
+            query = loader.Query(tags=self.tagQuery, **self.filterQuery)
+            spells = self.queryCache.search(self.spellbook, query, self.tags, self.tagVersion)
+            if not self.tableModel.replaceSpells(spells, query.ordered): return
+            self.countLabel.setText("Count: "+str(len(spells)))
+            self.resizeTableCols()
+            self.resetRowSizes()
+
+    @property
+    def spells(self):
+        return self.tableModel.spells
+
+    def visibleColumns(self):
+        return [x for x in self.spellheaders if self.spellheaders[x]['enabled']]
+
+    def applyColumnVisibility(self):
+        for col, name in enumerate(self.tableModel.columns):
+            self.table.setColumnHidden(col, not self.spellheaders[name]['enabled'])
+
+    def updateColumnVisibility(self):
+        # Shows and hides columns in place, keeping the spells, their sort and the scroll position.
+        # Only the newly shown columns are sized, and only the rows in view are measured again
+        with instrument.span("table.columnVisibility"):
+            header = self.table.horizontalHeader()
+            shown = [col for col, name in enumerate(self.tableModel.columns) if self.spellheaders[name]['enabled'] and header.isSectionHidden(col)]
+            self.applyColumnVisibility()
+            self.stretchLastColumn()
+            for col in shown:
+                self.sizeTableCol(col)
+            self.resetRowSizes()
 
     def resizeTableCols(self, resizeTable=False):
-        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Fixed)
-        self.table.horizontalHeader().setSectionResizeMode(self.table.columnCount() - 1, QHeaderView.Stretch)
+        with instrument.span("table.sizeColumns"):
+            self.sizeTableCols(resizeTable)
+
+    def sizeTableCols(self, resizeTable):
+        self.stretchLastColumn()
         totalSize = 0
-        self.table.resizeColumnsToContents()
-        #for col in range(self.table.columnCount()):
-        #    self.table.setColumnWidth(col, self.table.sizeHintForColumn(col))
-        spellheaders = {x: self.spellheaders[x] for x in self.spellheaders if self.spellheaders[x]['enabled']}
-        for col in range(self.table.columnCount()):
-            key = list(spellheaders.keys())[col]
-            if self.table.columnWidth(col) > spellheaders[key]['size']:
-                self.table.setColumnWidth(col, spellheaders[key]['size'])
+        header = self.table.horizontalHeader()
+        for col in range(self.tableModel.columnCount()):
+            if header.isSectionHidden(col): continue
+            self.sizeTableCol(col)
             totalSize += self.table.columnWidth(col)
             if self.currentSettings['updateTableProcessEvents']:
-                app.processEvents()
+                QApplication.processEvents()
         totalSize += self.table.verticalScrollBar().width()
         totalSize += self.table.verticalHeader().width()
         if resizeTable:
             self.table.resize(max(totalSize, self.table.width()), self.table.height())
 
-    def resizeTableRows(self):
-        if self.expandRowsAction.isChecked():
-            self.table.resizeRowsToContents()
-            self.resizeTableCols()
-        else:
-            self.table.resizeRowsToContents()
-            for row in range(self.table.rowCount()):
-                if self.table.rowHeight(row) >= TABLE_MAX_ROW_HEIGHT:
-                    self.table.setRowHeight(row, TABLE_MAX_ROW_HEIGHT)
+    def sizeTableCol(self, col):
+        self.table.resizeColumnToContents(col)
+        size = self.spellheaders[self.tableModel.columns[col]]['size']
+        if self.table.columnWidth(col) > size:
+            self.table.setColumnWidth(col, size)
 
-    def layoutCleanup(self):
-        self.updateTable(self.spellbook.spells)
-        self.resizeTableCols(True)
-        self.resizeTableRows()
-        self.resize(min(self.table.width() + COLUMN_LONG, SCREEN_W*MAIN_HEIGHT_RATIO), min(SCREEN_H*DEFAULT_HEIGHT_RATIO, SCREEN_H*MAIN_WIDTH_RATIO))
-        self.restore()
+    def stretchLastColumn(self):
+        header = self.table.horizontalHeader()
+        visible = [col for col in range(self.tableModel.columnCount()) if not header.isSectionHidden(col)]
+        for col in range(self.tableModel.columnCount()):
+            header.setSectionResizeMode(col, QHeaderView.Stretch if visible and col == visible[-1] else QHeaderView.Fixed)
+
+    def resizeTableRows(self):
+        with instrument.span("table.sizeRows"):
+            if self.expandRowsAction.isChecked():
+                self.resizeTableCols()
+            self.sizedRows = set()
+            self.sizeVisibleRows(estimate=True)
+
+    def resetRowSizes(self, *args):
+        self.sizedRows = set()
+        self.scheduleRowSizing()
+
+    def scheduleRowSizing(self, *args):
+        # Scrolling and resizing can ask many times in a row, the rows are only sized once they're done
+        if self.rowSizingScheduled: return
+        self.rowSizingScheduled = True
+        QTimer.singleShot(0, self.sizeVisibleRows)
+
+    def visibleRows(self):
+        rowCount = self.tableModel.rowCount()
+        if rowCount == 0: return range(0)
+        first = max(self.table.rowAt(0), 0)
+        last = self.table.rowAt(self.table.viewport().height() - 1)
+        if last < 0: last = rowCount - 1
+        return range(max(first - ROW_SIZING_MARGIN, 0), min(last + ROW_SIZING_MARGIN + 1, rowCount))
+
+    def sizeVisibleRows(self, estimate=False):
+        # Measures the rows in and around the viewport. Everything else keeps the default height,
+        # which with estimate is set to the median of the rows measured here.
+        # Rows changing height changes which rows are visible, so this goes until nothing new is visible
+        self.rowSizingScheduled = False
+        expanded = self.expandRowsAction.isChecked()
+        with instrument.span("table.sizeVisibleRows"):
+            while True:
+                heights = {}
+                for row in self.visibleRows():
+                    if row in self.sizedRows: continue
+                    height = self.table.sizeHintForRow(row)
+                    heights[row] = height if expanded else min(height, TABLE_MAX_ROW_HEIGHT)
+                if not heights: break
+                if estimate:
+                    self.table.verticalHeader().setDefaultSectionSize(sorted(heights.values())[len(heights) // 2])
+                    estimate = False
+                for row, height in heights.items():
+                    self.table.setRowHeight(row, height)
+                self.sizedRows.update(heights)
+                instrument.count("table.rowsSized", len(heights))
 
     def totalTableRefresh(self):
         self.updateTable()
@@ -1128,9 +2022,9 @@ class MainWindow(QMainWindow):
 
 def main():
     sys.excepthook = except_hook
-    #sys.setprofile(tracefunc)
+    app = QApplication(sys.argv)
     win = MainWindow()
-    win.layoutCleanup()
+    win.startup()
     sys.exit(app.exec_())
 
 if __name__ == "__main__": main()
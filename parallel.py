@@ -0,0 +1,190 @@
+import argparse, atexit, json, multiprocessing, os, platform, shutil, sys, tempfile, threading, time
+from concurrent.futures import ProcessPoolExecutor
+import loader, flatbook, instrument
+
+# Sharded search for very large spellbooks, where one core scanning every spell is the bottleneck.
+# The spellbook is written once to a flat book file (see flatbook.py) and split into contiguous
+# shards, one per worker process. Each worker maps the file and decodes only its own shard, so the
+# descriptions a text search reads are shared read-only pages rather than a copy per process. A
+# query runs on every shard at once and the shards' matches are joined in shard order, which is
+# spellbook order. Fuzzy queries order their results by closeness across the whole book, so they
+# stay in the calling process
+#   python parallel.py --sizes 100k,1m --processes 1,2,4,8
+
+PARALLEL_THRESHOLD = 100000 # Spells. Below this the search is over sooner than handing it to the workers would take
+MAX_PROCESSES = 8
+
+DEFAULT_SIZES = "100k"
+DEFAULT_PROCESSES = "1,2,4,8"
+DEFAULT_OUTPUT = "parallel_results.json"
+
+# Queries the benchmark times, heaviest last
+BENCH_QUERIES = {
+    "name": loader.Query("storm"),
+    "combined": loader.Query("storm", classes=["Wizard"], ranges={"level": (1, 5)}),
+    "text": loader.Query(text="saving throw on"),
+    "text_combined": loader.Query(classes=["Druid"], flags=["concentration"], text="higher levels"),
+}
+
+_shard = None # (first position, Snapshot) of the shard this worker holds
+
+def load_shard(filename, first, last):
+    global _shard
+    _shard = (first, loader.Snapshot(flatbook.FlatBook(filename).spells(first, last)))
+
+def shard_ready():
+    return len(_shard[1].spells)
+
+def search_shard(query, tags):
+    # Positions in the whole spellbook of the shard's matches
+    first, snapshot = _shard
+    positions = snapshot.positions()
+    return [first + positions[id(spell)] for spell in query.run(snapshot, tags)]
+
+class ShardedSearch:
+    # Worker processes holding shards of snapshot. start() does the slow part (writing the book and
+    # starting the workers), and ready() is False until it's done
+    def __init__(self, snapshot, processes=None):
+        self.snapshot = snapshot
+        self.processes = processes or min(os.cpu_count() or 1, MAX_PROCESSES)
+        self.directory = None
+        self.executors = []
+        self.started = threading.Event()
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        try:
+            with instrument.span("parallel.start", processes=self.processes):
+                directory = tempfile.mkdtemp(prefix="qspellbook-")
+                filename = os.path.join(directory, "shards.book")
+                flatbook.write_book(self.snapshot, filename, ranks=False)
+                count = len(self.snapshot.spells)
+                bounds = [count * i // self.processes for i in range(self.processes + 1)]
+                # Spawned rather than forked, which isn't safe from a process running other threads
+                context = multiprocessing.get_context("spawn")
+                with self.lock:
+                    self.directory = directory
+                    if self.closed: return
+                    self.executors = [ProcessPoolExecutor(1, context, load_shard, (filename, first, last))
+                                      for first, last in zip(bounds, bounds[1:])]
+                    ready = [executor.submit(shard_ready) for executor in self.executors]
+                if sum(future.result() for future in ready) != count: raise RuntimeError("Shards don't cover the spellbook")
+            self.started.set()
+        except Exception:
+            self.close()
+
+    def ready(self):
+        return self.started.is_set() and not self.closed
+
+    def wait(self, timeout=None):
+        self.started.wait(timeout)
+        return self.ready()
+
+    @instrument.timed("search.parallel")
+    def run(self, query, tags=None):
+        # The query's results, or None if the workers couldn't run it
+        if query.tags: # The workers only need the tags of spells that have every tag asked for
+            tags = {spell_id: spell_tags for spell_id, spell_tags in (tags or {}).items() if all(tag in spell_tags for tag in query.tags)}
+        else:
+            tags = None
+        try:
+            futures = [executor.submit(search_shard, query, tags) for executor in self.executors]
+            positions = [position for future in futures for position in future.result()]
+        except Exception: # A worker died (BrokenProcessPool) or was shut down
+            self.close()
+            return None
+        spells = self.snapshot.spells
+        return [spells[i] for i in positions]
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            executors, self.executors = self.executors, []
+        for executor in executors:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if self.directory: shutil.rmtree(self.directory, ignore_errors=True)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def attach(snapshot, threshold=PARALLEL_THRESHOLD, processes=None):
+    # Starts a ShardedSearch for snapshot in the background if it's big enough, so its queries use it
+    # once it's ready. Only the latest snapshot attached has one: the engine of the one before is closed
+    global _engine
+    processes = processes or min(os.cpu_count() or 1, MAX_PROCESSES)
+    with _engine_lock:
+        if _engine is not None and _engine.snapshot is snapshot: return _engine
+        previous, _engine = _engine, None
+        if len(snapshot.spells) >= threshold and processes > 1:
+            _engine = snapshot.parallel = ShardedSearch(snapshot, processes)
+            threading.Thread(target=_engine.start, name="parallel-start", daemon=True).start()
+        engine = _engine
+    if previous is not None: previous.close()
+    return engine
+
+def close():
+    global _engine
+    with _engine_lock:
+        engine, _engine = _engine, None
+    if engine is not None: engine.close()
+
+atexit.register(close)
+
+def bench_size(n, process_counts):
+    import bench
+    print("Generating", n, "spells")
+    snapshot = bench.generate_spellbook(n).snapshot()
+    results = {"rows": n, "serial": {}, "parallel": {}}
+    expected = {name: query.run(snapshot) for name, query in BENCH_QUERIES.items()}
+    for name, query in BENCH_QUERIES.items():
+        results["serial"][name] = bench.measure(lambda: query.run(snapshot))
+        print("  {:<14} serial      {:>9.4f}s".format(name, results["serial"][name]["min"]))
+    for processes in process_counts:
+        engine = ShardedSearch(snapshot, processes)
+        start = time.perf_counter()
+        engine.start()
+        if not engine.ready():
+            print("  Couldn't start", processes, "workers")
+            continue
+        timings = results["parallel"][str(processes)] = {"start": time.perf_counter() - start}
+        for name, query in BENCH_QUERIES.items():
+            assert engine.run(query) == expected[name] # Same spells in the same order as searching here
+            timings[name] = bench.measure(lambda: engine.run(query))
+            timings[name]["speedup"] = results["serial"][name]["min"] / timings[name]["min"]
+            print("  {:<14} {:>2} processes {:>9.4f}s {:>6.2f}x".format(name, processes, timings[name]["min"], timings[name]["speedup"]))
+        engine.close()
+    return results
+
+def main(argv=None):
+    import bench
+    parser = argparse.ArgumentParser(description="Benchmark sharded search against searching in one process, by process count")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma separated sizes out of " + ", ".join(bench.SIZES))
+    parser.add_argument("--processes", default=DEFAULT_PROCESSES, help="Comma separated worker process counts")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSON file the results are written to")
+    args = parser.parse_args(argv)
+    try:
+        process_counts = [int(count) for count in args.processes.split(",")]
+    except ValueError:
+        parser.error("--processes must be whole numbers")
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": {}
+    }
+    for label in args.sizes.split(","):
+        label = label.strip().lower()
+        if label not in bench.SIZES:
+            parser.error("Unknown size " + label)
+        print("Benchmarking", label)
+        results["results"][label] = bench_size(bench.SIZES[label], process_counts)
+    with open(args.output, "w") as f:
+        f.write(json.dumps(results, indent=2))
+    print("Results written to", args.output)
+
+if __name__ == "__main__": main()
@@ -0,0 +1,116 @@
+import os, tempfile, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import instrument
+
+# Write-behind persistence. Saving queues a write and returns straight away, and a background thread
+# does the writing. Writes are keyed by their target (usually the filename): a write queued for a
+# target that already has one waiting replaces it, so a burst of saves only writes the latest state.
+# A write is a function of no arguments, and should hold its own copy of anything the caller goes on changing
+
+# Read once at import, as reading it means setting it and the process may have threads later
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+@contextmanager
+def atomic_path(filename):
+    # A temporary filename to write filename's new contents to, for writers that want a filename rather
+    # than a file, which replaces filename once the with block finishes. filename always has either the
+    # old or the new contents, never part of either, and keeps the old ones if the block raises.
+    # It keeps filename's permissions, or gets the usual ones for a new file, rather than the owner
+    # only ones of a temporary file
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(filename) + ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        yield temp
+        with open(temp, "rb+") as f:
+            os.fsync(f.fileno())
+        try:
+            mode = os.stat(filename).st_mode & 0o7777
+        except OSError:
+            mode = 0o666 & ~UMASK
+        os.chmod(temp, mode)
+        os.replace(temp, filename)
+    except BaseException:
+        try: os.remove(temp)
+        except OSError: pass
+        raise
+
+@contextmanager
+def atomic_open(filename, mode="w", encoding="utf-8", newline=None):
+    # A file to write filename's new contents to, in place of filename once the with block finishes, see atomic_path
+    with atomic_path(filename) as temp:
+        with open(temp, mode, encoding=None if "b" in mode else encoding, newline=newline) as f:
+            yield f
+
+def atomic_write(filename, data, mode="w", encoding="utf-8"):
+    with atomic_open(filename, mode, encoding) as f:
+        f.write(data)
+
+class WriteBehind:
+    # on_error(target, exception) is called on the writer thread when a write fails; the write is dropped
+    def __init__(self, on_error=None, name="write-behind"):
+        self.on_error = on_error
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.writing = None # Target being written
+        self.closed = False
+        self.submitted = self.written = self.coalesced = self.failed = 0
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, target, write):
+        with self.condition:
+            if self.closed: raise RuntimeError("Writes can't be queued after the writer is closed")
+            self.submitted += 1
+            if target in self.pending:
+                # Keeps its place in the queue, so a target saved over and over is still written
+                self.coalesced += 1
+                instrument.count("persist.coalesced")
+            self.pending[target] = write
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending: return # Closed, and everything is written
+                target, write = self.pending.popitem(last=False)
+                self.writing = target
+            try:
+                with instrument.span("persist.write", target=str(target)):
+                    write()
+            except Exception as e:
+                with self.condition: self.failed += 1
+                if self.on_error: self.on_error(target, e)
+            finally:
+                with self.condition:
+                    self.written += 1
+                    self.writing = None
+                    self.condition.notify_all()
+
+    def is_pending(self, target):
+        with self.condition:
+            return target in self.pending or self.writing == target
+
+    def flush(self, timeout=None):
+        # Waits until everything queued so far has been written. False if timeout ran out first
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and self.writing is None, timeout)
+
+    def close(self, timeout=None):
+        # Writes everything still queued, then stops the thread
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending": len(self.pending), "submitted": self.submitted, "written": self.written,
+                "coalesced": self.coalesced, "failed": self.failed,
+            }
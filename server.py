@@ -0,0 +1,427 @@
+import argparse, asyncio, json, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs, quote, unquote
+import loader, instrument, tagstore, persist, parallel
+
+# Spellbook query server, so everyone at the table can look spells up from one loaded, indexed
+# spellbook instead of each running the app. Plain HTTP/1.1 and JSON on asyncio, no dependencies.
+#   python server.py serve Spells.xlsx --host 0.0.0.0 --tags tags.json
+#   python server.py selftest Spells.xlsx
+#
+#   GET  /spells?name=fire&level=3&class=Wizard&tag=Prepared&fuzzy=1&sort=level,-name&offset=0&limit=50
+#        &where=range%3D60ft..&flag=concentration&text=saving+throw&source=Homebrew   (see loader.parse_range_filter and loader.FLAGS)
+#   GET  /spells/<id>           Everything about one spell (ids are quoted, e.g. name%3Afireball)
+#   PUT  /spells/<id>/tags      Replaces the spell's tags with the JSON list in the body
+#   GET  /tags, /classes, /version
+#
+# Responses carry an ETag made of the spellbook and tag versions. Send it back in If-None-Match to
+# get 304 Not Modified while nothing has changed, or in If-Match on a PUT to only update tags
+# nobody else has changed since.
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_PAGE = 50
+MAX_PAGE = 500
+MAX_HEADER_BYTES = 16384
+MAX_BODY_BYTES = 65536
+QUERY_CACHE_SIZE = 128 # More varied queries than one window makes
+QUERY_THREADS = 4 # GETs are answered on these, so a slow query doesn't hold up the other clients
+IDLE_TIMEOUT = 60 # Seconds a connection can go without sending a request before it's closed
+
+STATUS_TEXT = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               412: "Precondition Failed", 413: "Payload Too Large", 431: "Request Header Fields Too Large",
+               500: "Internal Server Error"}
+
+SUMMARY_FIELDS = ("id", "name", "level", "school", "ritual", "time", "range", "compstr", "duration", "origin")
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def is_true(value):
+    return value.lower() in ("1", "true", "yes", "on")
+
+def spell_summary(spell, tags):
+    summary = {field: getattr(spell, field) for field in SUMMARY_FIELDS}
+    summary["classes"] = [cls for cls, member in spell.classes.items() if member]
+    if "source" in spell.__dict__: summary["source"] = spell.source
+    summary["tags"] = tags.get(spell.id, [])
+    return summary
+
+def spell_details(spell, tags):
+    details = spell.to_dict()
+    details["tags"] = tags.get(spell.id, [])
+    return details
+
+class SortedQuery:
+    # A loader.Query with the order its results are served in, so sorted pages come straight out of the QueryCache
+    def __init__(self, query, keys):
+        self.query = query
+        self.keys = keys
+        self.key = (query.key, tuple((key, descending) for key, _, descending in keys))
+
+    def __eq__(self, other):
+        return isinstance(other, SortedQuery) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def run(self, snapshot, tags=None):
+        spells = self.query.run(snapshot, tags)
+        return snapshot.sort_spells(spells, self.keys) if self.keys else spells
+
+class SpellServer:
+    # Serves one spellbook and its tags. Every request works from the snapshot current when it
+    # arrives, so the spellbook can be republished (see loader.Snapshot) while clients are reading.
+    # GETs run on a thread pool and tag updates on the event loop. An update replaces the tags dict
+    # rather than changing it, so a GET keeps the tags (and tag version) it started with
+    def __init__(self, spellbook, tags=None, tags_filename=None):
+        self.spellbook = spellbook
+        self.tags = tags or {}
+        self.tag_version = 0
+        self.lock = threading.Lock() # Held to swap or take the tags and tag version together
+        self.tags_filename = tags_filename
+        self.writer = persist.WriteBehind() if tags_filename else None
+        self.cache = loader.QueryCache(QUERY_CACHE_SIZE)
+        self.executor = ThreadPoolExecutor(QUERY_THREADS, thread_name_prefix="query")
+        self.instance = os.urandom(4).hex() # Versions restart with the process, ETags from an earlier run mustn't match
+        self.requests = self.not_modified = self.connections = 0
+
+    def etag(self, snapshot, tag_version):
+        return '"{}-{}-{}"'.format(self.instance, snapshot.version, tag_version)
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        return await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_BYTES)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.writer: self.writer.close()
+
+    async def handle(self, reader, writer):
+        # One connection, which is kept alive for as many requests as the client sends
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    return # Client closed the connection, or went quiet
+                except asyncio.LimitOverrunError:
+                    await self.respond(writer, 431, {"error": "Request headers too large"}, close=True)
+                    return
+                try:
+                    method, target, version, headers = self.parse_head(head)
+                except HTTPError as e:
+                    await self.respond(writer, e.status, {"error": str(e)}, close=True)
+                    return
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY_BYTES:
+                    await self.respond(writer, 413, {"error": "Request body too large"}, close=True)
+                    return
+                try:
+                    body = await asyncio.wait_for(reader.readexactly(length), IDLE_TIMEOUT) if length else b""
+                except asyncio.TimeoutError:
+                    return
+                close = headers.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+                self.requests += 1
+                with instrument.span("server.request", method=method, target=target):
+                    try:
+                        if method == "GET":
+                            status, data, extra = await asyncio.get_running_loop().run_in_executor(
+                                self.executor, self.dispatch, method, target, headers, body)
+                        else:
+                            status, data, extra = self.dispatch(method, target, headers, body)
+                    except HTTPError as e:
+                        status, data, extra = e.status, {"error": str(e)}, {}
+                    except Exception as e: # The server carries on, and so does this connection
+                        status, data, extra = 500, {"error": "{}: {}".format(type(e).__name__, e)}, {}
+                await self.respond(writer, status, data, extra, close)
+                if close: return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def parse_head(self, head):
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            if not line: continue
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if not (headers.get("content-length") or "0").isdigit():
+            raise HTTPError(400, "Bad Content-Length")
+        return method, target, version, headers
+
+    async def respond(self, writer, status, data, extra=None, close=False):
+        body = b"" if status == 304 else json.dumps(data, ensure_ascii=False).encode("utf-8")
+        head = ["HTTP/1.1 {} {}".format(status, STATUS_TEXT.get(status, "")),
+                "Content-Type: application/json; charset=utf-8",
+                "Content-Length: {}".format(len(body)),
+                "Cache-Control: no-cache"] # Clients may keep responses, but have to check the ETag before using them
+        head += ["{}: {}".format(name, value) for name, value in (extra or {}).items()]
+        if close: head.append("Connection: close")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    def dispatch(self, method, target, headers, body):
+        url = urlsplit(target)
+        params = parse_qs(url.query)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        snapshot = self.spellbook.snapshot()
+        with self.lock:
+            tags, tag_version = self.tags, self.tag_version
+        etag = self.etag(snapshot, tag_version)
+
+        if method == "PUT" and len(parts) == 3 and parts[0] == "spells" and parts[2] == "tags":
+            if headers.get("if-match") not in (None, "*", etag):
+                raise HTTPError(412, "The spellbook or tags have changed since " + headers["if-match"])
+            spell = self.find(snapshot, parts[1])
+            values = self.set_tags(spell, body)
+            return 200, values, {"ETag": self.etag(snapshot, self.tag_version)}
+        if method != "GET":
+            raise HTTPError(405, "Method not allowed")
+        if headers.get("if-none-match") == etag:
+            with self.lock: self.not_modified += 1
+            instrument.count("server.not_modified")
+            return 304, None, {"ETag": etag}
+
+        if parts == ["spells"]:
+            data = self.query(snapshot, params, tags, tag_version)
+        elif len(parts) == 2 and parts[0] == "spells":
+            data = spell_details(self.find(snapshot, parts[1]), tags)
+        elif len(parts) == 3 and parts[0] == "spells" and parts[2] == "tags":
+            data = tags.get(self.find(snapshot, parts[1]).id, [])
+        elif parts == ["tags"]:
+            counts = {}
+            for values in tags.values():
+                for tag in values: counts[tag] = counts.get(tag, 0) + 1
+            data = {"tags": counts}
+        elif parts == ["classes"]:
+            data = {"classes": list(snapshot.spells[0].classes) if snapshot.spells else loader.all_classes}
+        elif parts == ["version"]:
+            data = {"spellbook": snapshot.version, "tags": tag_version, "spells": len(snapshot.spells), "etag": etag}
+        else:
+            raise HTTPError(404, "No such resource " + url.path)
+        return 200, data, {"ETag": etag}
+
+    def find(self, snapshot, spell_id):
+        spell = snapshot.by_id().get(spell_id)
+        if spell is None: raise HTTPError(404, "No spell with id " + spell_id)
+        return spell
+
+    def query(self, snapshot, params, tags, tag_version):
+        def one(name, default=""):
+            values = params.get(name)
+            return values[-1] if values else default
+        try:
+            level = int(one("level")) if one("level") else None
+            offset = max(0, int(one("offset", "0")))
+            limit = min(MAX_PAGE, max(1, int(one("limit", str(DEFAULT_PAGE)))))
+        except ValueError:
+            raise HTTPError(400, "level, offset and limit must be whole numbers")
+        classes = params.get("class", [])
+        known = snapshot.spells[0].classes if snapshot.spells else loader.all_classes
+        for cls in classes:
+            if cls not in known: raise HTTPError(400, "Unknown class " + cls)
+        try:
+            ranges = {field: (low, high) for field, low, high in map(loader.parse_range_filter, params.get("where", []))}
+            query = loader.Query(one("name"), level, classes, params.get("tag", []), is_true(one("fuzzy", "no")),
+                                 ranges, params.get("flag", []), one("text"), params.get("source", []))
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        sort = one("sort")
+        try:
+            # Fuzzy results come closest first unless a sort is asked for
+            keys = loader.parse_sort_keys(sort or "name") if sort or not query.ordered else []
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        spells = self.cache.search(snapshot, SortedQuery(query, keys), tags, tag_version)
+        page = spells[offset:offset + limit]
+        return {
+            "total": len(spells), "offset": offset, "limit": limit,
+            "next": offset + limit if offset + limit < len(spells) else None,
+            "spells": [spell_summary(spell, tags) for spell in page],
+        }
+
+    def set_tags(self, spell, body):
+        try:
+            values = json.loads(body.decode("utf-8"))
+        except (ValueError, UnicodeDecodeError):
+            raise HTTPError(400, "The body must be a JSON list of tags")
+        if type(values) != list or any(type(tag) != str or not tag.strip() for tag in values):
+            raise HTTPError(400, "The body must be a JSON list of tags")
+        values = tagstore.merge_tag_lists([], [tag.strip() for tag in values])
+        tags = dict(self.tags)
+        if values: tags[spell.id] = values
+        else: tags.pop(spell.id, None)
+        with self.lock:
+            self.tags, self.tag_version = tags, self.tag_version + 1
+        if self.writer: # Nothing changes tags once it's been swapped in, so the write can have it as it is
+            filename = self.tags_filename
+            self.writer.submit(filename, lambda: tagstore.save_tags(tags, filename))
+        return values
+
+    def stats(self):
+        return {"requests": self.requests, "not_modified": self.not_modified, "connections": self.connections,
+                "queryCache": self.cache.stats()}
+
+class Client:
+    # Minimal HTTP/1.1 client on one kept-alive connection, for trying the server out without anything else.
+    # GET responses are remembered with their ETag and revalidated, so repeats cost a 304
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+        self.cached = {} # path -> (etag, data)
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+    async def request(self, method, path, body=None, headers=None):
+        # Returns (status, headers, data)
+        if self.writer is None: await self.connect()
+        data = b"" if body is None else json.dumps(body).encode("utf-8")
+        head = ["{} {} HTTP/1.1".format(method, path), "Host: {}:{}".format(self.host, self.port),
+                "Content-Length: {}".format(len(data))]
+        head += ["{}: {}".format(name, value) for name, value in (headers or {}).items()]
+        self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+        await self.writer.drain()
+        status_line, *lines = (await self.reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        response_headers = {}
+        for line in lines:
+            if line:
+                name, _, value = line.partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+        length = int(response_headers.get("content-length", 0))
+        payload = await self.reader.readexactly(length) if length else b""
+        return int(status_line.split(" ")[1]), response_headers, json.loads(payload) if payload else None
+
+    async def get(self, path):
+        cached = self.cached.get(path)
+        status, headers, data = await self.request("GET", path, headers={"If-None-Match": cached[0]} if cached else None)
+        if status == 304: return cached[1]
+        if status != 200: raise HTTPError(status, (data or {}).get("error", "Request failed"))
+        if "etag" in headers: self.cached[path] = (headers["etag"], data)
+        return data
+
+    async def set_tags(self, spell_id, tags, etag=None):
+        status, headers, data = await self.request("PUT", "/spells/{}/tags".format(quote(spell_id, safe="")), tags,
+                                                   {"If-Match": etag} if etag else None)
+        if status != 200: raise HTTPError(status, data["error"])
+        return data
+
+async def load_test(host, port, clients=20, requests=50, paths=None):
+    # Each client works through paths on its own connection. Returns request latencies in seconds
+    paths = paths or ["/spells", "/spells?level=3&sort=name", "/spells?name=fire", "/spells?name=frie&fuzzy=1",
+                      "/spells?class=Wizard&limit=100", "/spells?where=level%3D1..3&where=range%3D60ft..&flag=concentration", "/tags"]
+    latencies = []
+    async def run(n):
+        client = Client(host, port)
+        try:
+            for i in range(requests):
+                start = time.perf_counter()
+                await client.get(paths[(n + i) % len(paths)])
+                latencies.append(time.perf_counter() - start)
+        finally:
+            await client.close()
+    await asyncio.gather(*(run(n) for n in range(clients)))
+    return latencies
+
+def report(latencies, elapsed):
+    latencies = sorted(latencies)
+    def percentile(p): return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+    print("{} requests in {:.2f}s ({:.0f}/s), p50 {:.2f}ms, p95 {:.2f}ms, max {:.2f}ms".format(
+        len(latencies), elapsed, len(latencies) / elapsed, percentile(0.5), percentile(0.95), latencies[-1] * 1000))
+
+async def selftest(server, clients, requests):
+    # Runs the server on a free local port and checks it from the test client
+    listener = await server.serve(DEFAULT_HOST, 0)
+    port = listener.sockets[0].getsockname()[1]
+    client = Client(DEFAULT_HOST, port)
+    try:
+        first = await client.get("/spells?limit=10")
+        print("{} spells, first page of {}".format(first["total"], len(first["spells"])))
+        status, headers, _ = await client.request("GET", "/spells?limit=10", headers={"If-None-Match": client.cached["/spells?limit=10"][0]})
+        assert status == 304, status
+        if first["spells"]:
+            spell = first["spells"][0]
+            details = await client.get("/spells/" + quote(spell["id"], safe=""))
+            assert details["name"] == spell["name"]
+            etag = headers["etag"]
+            await client.set_tags(spell["id"], ["Prepared"], etag)
+            status, _, _ = await client.request("PUT", "/spells/{}/tags".format(quote(spell["id"], safe="")), ["Known"], {"If-Match": etag})
+            assert status == 412, status # The first update changed the version
+            tagged = await client.get("/spells?tag=Prepared")
+            assert spell["id"] in [x["id"] for x in tagged["spells"]]
+        if first["next"] is not None:
+            second = await client.get("/spells?limit=10&offset=10")
+            assert not {x["id"] for x in second["spells"]} & {x["id"] for x in first["spells"]}
+        print("Conditional requests, tag updates and paging work")
+        start = time.perf_counter()
+        latencies = await load_test(DEFAULT_HOST, port, clients, requests)
+        report(latencies, time.perf_counter() - start)
+        print(json.dumps(server.stats()))
+    finally:
+        await client.close()
+        listener.close()
+        await listener.wait_closed()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a spellbook over HTTP/JSON to everyone at the table")
+    commands = parser.add_subparsers(dest="command")
+    serveParser = commands.add_parser("serve", help="Serve a spellbook")
+    serveParser.add_argument("source", help="Spreadsheet (.xlsx) or cache (.json) to serve")
+    serveParser.add_argument("--host", default=DEFAULT_HOST, help="Address to listen on, 0.0.0.0 for the whole LAN")
+    serveParser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serveParser.add_argument("--tags", help="Tag file to serve, tag updates are saved back to it")
+    testParser = commands.add_parser("selftest", help="Serve a spellbook on a free local port and check it with the test client")
+    testParser.add_argument("source")
+    testParser.add_argument("--clients", type=int, default=20)
+    testParser.add_argument("--requests", type=int, default=50, help="Requests per client")
+    clientParser = commands.add_parser("client", help="Load test a running server")
+    clientParser.add_argument("--host", default=DEFAULT_HOST)
+    clientParser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    clientParser.add_argument("--clients", type=int, default=20)
+    clientParser.add_argument("--requests", type=int, default=50, help="Requests per client")
+    args = parser.parse_args(argv)
+
+    if args.command == "client":
+        start = time.perf_counter()
+        report(asyncio.run(load_test(args.host, args.port, args.clients, args.requests)), time.perf_counter() - start)
+        return
+    if args.command not in ("serve", "selftest"):
+        parser.print_help()
+        return
+    spellbook = loader.open_spellbook(args.source)
+    spellbook.snapshot().prepare(loader.parse_sort_keys("name"))
+    parallel.attach(spellbook.snapshot())
+    if args.command == "selftest":
+        asyncio.run(selftest(SpellServer(spellbook), args.clients, args.requests))
+        return
+    tags = {}
+    if args.tags and os.path.isfile(args.tags):
+        tags, _ = tagstore.remap_tags(tagstore.load_tags(args.tags), spellbook.spells)
+    server = SpellServer(spellbook, tags, args.tags)
+    async def serve():
+        listener = await server.serve(args.host, args.port)
+        print("Serving {} spells on http://{}:{}".format(len(spellbook.spells), args.host, args.port), file=sys.stderr)
+        async with listener:
+            await listener.serve_forever()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == "__main__": main()
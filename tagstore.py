@@ -0,0 +1,134 @@
+import json, re
+import persist
+
+# Tags are stored as {spell id: [tag, ...]}, see loader.spell_id. Older tag files are keyed by
+# hash(spell) instead, which changes whenever anything about the spell is edited. remap_tags
+# moves those over to spell ids.
+
+IMPORT_MODES = ("merge", "replace", "existing")
+READ_SIZE = 1 << 16 # Characters of a tag file read at a time, see iter_tag_file
+WHITESPACE = re.compile(r"\s*")
+
+def is_legacy_key(key):
+    return key.isdigit()
+
+def load_tags(filename):
+    with open(filename) as f:
+        data = json.loads(f.read())
+    if not isinstance(data, dict) or not all(isinstance(value, list) for value in data.values()):
+        raise ValueError("expected an object of tag lists")
+    return {str(key): list(value) for key, value in data.items()}
+
+def save_tags(tags, filename):
+    persist.atomic_write(filename, json.dumps(tags))
+
+def merge_tag_lists(current, new):
+    return current + [tag for tag in new if tag not in current]
+
+def remap_tags(tags, spells, previous_spells=()):
+    # Returns (tags, orphans). Hash keyed entries are matched against the hashes of spells and
+    # previous_spells (the spellbook before a reload, which old hashes are more likely to match).
+    # Entries that don't belong to any spell in spells are kept, and also returned as orphans.
+    # spells is only gone through once, so it can be a stream of them (see loader.iter_spells)
+    legacy = any(is_legacy_key(key) for key in tags)
+    ids = set()
+    by_hash = {}
+    if legacy:
+        for spell in previous_spells:
+            by_hash.setdefault(str(hash(spell)), spell.id)
+    for spell in spells:
+        ids.add(spell.id)
+        if legacy: by_hash.setdefault(str(hash(spell)), spell.id)
+    remapped = {}
+    orphans = {}
+    for key, values in tags.items():
+        if is_legacy_key(key) and key in by_hash:
+            key = by_hash[key]
+        remapped[key] = merge_tag_lists(remapped.get(key, []), values)
+    for key, values in remapped.items():
+        if key not in ids:
+            orphans[key] = values
+    return remapped, orphans
+
+def iter_tag_file(filename):
+    # The (key, tags) entries of a tag file one at a time, as it's read, so checking one never waits on
+    # the rest of the file. Raises ValueError at the first entry that isn't a key with a list of tag strings
+    decoder = json.JSONDecoder()
+    with open(filename) as f:
+        text = ""
+        position = 0
+        offset = 0 # Characters of the file before text
+        done = False
+        def value(kind):
+            # The next JSON value, reading more of the file until there's all of it
+            nonlocal text, position, offset, done
+            while True:
+                position = WHITESPACE.match(text, position).end()
+                try:
+                    found, end = decoder.raw_decode(text, position)
+                    if end < len(text) or done:
+                        position = end
+                        return found
+                except json.JSONDecodeError:
+                    if done: raise ValueError("The tags file isn't valid JSON (expected {} at character {})".format(kind, offset + position))
+                chunk = f.read(READ_SIZE)
+                offset += position
+                text, position = text[position:] + chunk, 0
+                done = not chunk
+        def punctuation(marks):
+            nonlocal text, position, offset, done
+            while True:
+                position = WHITESPACE.match(text, position).end()
+                if position < len(text) or done: break
+                chunk = f.read(READ_SIZE)
+                offset += len(text)
+                text, position, done = chunk, 0, not chunk
+            mark = text[position:position + 1]
+            if mark not in marks: raise ValueError("The tags file isn't valid JSON (expected {} at character {})".format(" or ".join(marks), offset + position))
+            position += 1
+            return mark
+        punctuation(["{"])
+        if punctuation(["}", '"']) == "}": return
+        position -= 1
+        while True:
+            key = value("a spell key")
+            if type(key) != str: raise ValueError("The tags file has a key that isn't a string")
+            punctuation([":"])
+            tags = value("a list of tags")
+            if type(tags) != list or any(type(tag) != str for tag in tags):
+                raise ValueError("The tags of {} aren't a list of strings".format(key))
+            yield key, tags
+            if punctuation([",", "}"]) == "}": return
+
+def import_tags(tags, entries, spells, mode="merge", previous_spells=()):
+    # Returns (tags, counts) with entries, (key, tags) pairs such as iter_tag_file gives, imported into tags
+    # (which is left alone). "merge" adds the imported tags to each spell's own, "replace" drops the tags
+    # there were, and "existing" merges but skips entries for spells that aren't in spells. Hash keyed
+    # entries are moved to spell ids as remap_tags does. counts are of entries merged into a spell,
+    # skipped, and orphaned: kept for a spell that isn't in the spellbook
+    if mode not in IMPORT_MODES: raise ValueError("Unknown import mode " + mode)
+    ids = {spell.id for spell in spells}
+    by_hash = None # Only worked out if an entry needs it
+    # Every spell's tags and a set of them, so merging an entry is one lookup however many tags there are
+    imported = {} if mode == "replace" else {key: (list(values), set(values)) for key, values in tags.items()}
+    counts = {"merged": 0, "skipped": 0, "orphaned": 0}
+    for key, values in entries:
+        if is_legacy_key(key):
+            if by_hash is None:
+                by_hash = {}
+                for spell in previous_spells: by_hash.setdefault(str(hash(spell)), spell.id)
+                for spell in spells: by_hash.setdefault(str(hash(spell)), spell.id)
+            key = by_hash.get(key, key)
+        if key in ids:
+            counts["merged"] += 1
+        elif mode == "existing":
+            counts["skipped"] += 1
+            continue
+        else:
+            counts["orphaned"] += 1
+        current, seen = imported.setdefault(key, ([], set()))
+        for tag in values:
+            if tag not in seen:
+                seen.add(tag)
+                current.append(tag)
+    return {key: current for key, (current, _) in imported.items()}, counts
@@ -0,0 +1,185 @@
+import os, sys
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen") # Must be set before Qt is imported
+import argparse, json, math, platform, shutil, statistics, tempfile, time
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+import bench
+import main as gui # main() below would shadow the module name
+
+# Drives MainWindow through a scripted session against a synthetic spellbook and reports
+# per-operation latency. Runs headless, so it works on a Linux box without a display
+#   python uibench.py --rows 5000 --output uibench_results.json
+
+DEFAULT_ROWS = 2000
+DEFAULT_REPEATS = 3
+DEFAULT_OUTPUT = "uibench_results.json"
+HARNESS_PROGRAM_NAME = "QSpellbookUIBench" # Keeps the harness' QSettings away from the real app's
+
+TYPING_SESSION = ["storm", "fist 1", "arcane bolt"]
+FUZZY_TYPING_SESSION = ["blazng strom", "eldrich blaed"]
+CLASS_TOGGLES = ["Wizard", "Druid", "Cleric", "Warlock"]
+VIEW_SWITCHES = 5
+COLUMN_TOGGLES = ["School", "Description", "Origin"]
+BENCH_TAG = "UIBench"
+
+def percentile(values, p):
+    values = sorted(values)
+    index = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[index]
+
+class Recorder:
+    def __init__(self, app):
+        self.app = app
+        self.times = {}
+
+    def record(self, name, fn):
+        # The pending events are flushed inside the timing, so repaints caused by the operation are included
+        start = time.perf_counter()
+        fn()
+        self.app.processEvents()
+        elapsed = (time.perf_counter() - start) * 1000
+        self.times.setdefault(name, []).append(elapsed)
+        return elapsed
+
+    def summary(self):
+        summary = {}
+        for name, times in self.times.items():
+            summary[name] = {
+                "count": len(times),
+                "mean": statistics.mean(times),
+                "p50": percentile(times, 50),
+                "p90": percentile(times, 90),
+                "p99": percentile(times, 99),
+                "max": max(times),
+            }
+        return summary
+
+def setupData(dataDir, rows):
+    gui.CACHE_FILENAME = os.path.join(dataDir, "spells.json")
+    gui.TAGS_FILENAME = os.path.join(dataDir, "tags.json")
+    gui.WB_DEFAULT_FILENAME = os.path.join(dataDir, "Spells.xlsx")
+    gui.PROGRAM_NAME = HARNESS_PROGRAM_NAME
+    # Only the cache is read at startup, the workbook just has to exist
+    open(gui.WB_DEFAULT_FILENAME, "w").close()
+    bench.write_cache(gui.CACHE_FILENAME, rows)
+    QSettings(gui.PROGRAM_AUTHOR, gui.PROGRAM_NAME).clear()
+
+def startWindow(app):
+    win = gui.MainWindow()
+    finished = []
+    win.startupFinished.connect(lambda: finished.append(True))
+    win.startup()
+    while not finished:
+        app.processEvents(QEventLoop.AllEvents, 50)
+    return win
+
+def classCheckBoxes(filterBar):
+    boxes = {}
+    for vbox in (filterBar.classLeftVBox, filterBar.classRightVBox):
+        for i in range(vbox.count()):
+            checkBox = vbox.itemAt(i).widget()
+            boxes[checkBox.cls] = checkBox
+    return boxes
+
+def columnCheckBoxes(visibilityBar):
+    boxes = {}
+    for vbox in (visibilityBar.colLeftVBox, visibilityBar.colRightVBox):
+        for i in range(vbox.count()):
+            checkBox = vbox.itemAt(i).widget()
+            boxes[checkBox.col] = checkBox
+    return boxes
+
+def typeText(recorder, nameEdit, text, name="keystroke"):
+    for i in range(1, len(text) + 1):
+        recorder.record(name, lambda: nameEdit.setText(text[:i]))
+    for i in range(len(text) - 1, -1, -1):
+        recorder.record("backspace", lambda: nameEdit.setText(text[:i]))
+
+def runSession(app, win, recorder):
+    filterBar = win.filterBar.widget().widget()
+    tagBar = win.tagBar.widget()
+    win.currentSettings["dontUpdateWhileTyping"] = False
+    filterBar.autoCheckBox.setChecked(True)
+
+    for text in TYPING_SESSION:
+        typeText(recorder, filterBar.nameEdit, text)
+    filterBar.fuzzyCheckBox.setChecked(True)
+    for text in FUZZY_TYPING_SESSION:
+        typeText(recorder, filterBar.nameEdit, text, "fuzzy keystroke")
+    filterBar.fuzzyCheckBox.setChecked(False)
+
+    boxes = classCheckBoxes(filterBar)
+    for cls in CLASS_TOGGLES:
+        recorder.record("class toggle", lambda: boxes[cls].setChecked(True))
+    for cls in CLASS_TOGGLES:
+        recorder.record("class toggle", lambda: boxes[cls].setChecked(False))
+
+    # Flipping between a couple of recent views, which the query cache should answer
+    for _ in range(VIEW_SWITCHES):
+        recorder.record("view switch", lambda: boxes["Wizard"].setChecked(True))
+        recorder.record("view switch", lambda: boxes["Wizard"].setChecked(False))
+
+    columns = columnCheckBoxes(win.visBar.widget())
+    for col in COLUMN_TOGGLES:
+        recorder.record("column toggle", lambda: columns[col].toggle())
+    for col in COLUMN_TOGGLES:
+        recorder.record("column toggle", lambda: columns[col].toggle())
+
+    recorder.record("updateTable", lambda: win.updateTable(win.spellbook.spells))
+    recorder.record("resizeTableCols", win.resizeTableCols)
+    recorder.record("resizeTableRows", win.resizeTableRows)
+
+    recorder.record("bulk tag", lambda: win.tagSpells(win.spells, BENCH_TAG))
+    recorder.record("reupTagBox", tagBar.reupTagBox)
+    recorder.record("bulk untag", lambda: win.untagSpells(win.spells, BENCH_TAG))
+
+    recorder.record("expand rows on", win.expandRowsAction.trigger)
+    recorder.record("expand rows off", win.expandRowsAction.trigger)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure MainWindow operation latency offscreen on a synthetic spellbook")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="Number of spells in the synthetic spellbook")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS, help="How many times the scripted session is run")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSON file the results are written to")
+    args = parser.parse_args(argv)
+
+    dataDir = tempfile.mkdtemp(prefix="qspellbook-uibench-")
+    try:
+        setupData(dataDir, args.rows)
+        app = QApplication.instance() or QApplication(sys.argv[:1])
+        recorder = Recorder(app)
+        start = time.perf_counter()
+        win = startWindow(app)
+        startup = {phase: total for phase, _, total in win.startupTimer.phases}
+        startup["window ready"] = (time.perf_counter() - start) * 1000
+        for _ in range(args.repeats):
+            runSession(app, win, recorder)
+        queryCache = win.queryCache.stats()
+        win.close()
+    finally:
+        QSettings(gui.PROGRAM_AUTHOR, gui.PROGRAM_NAME).clear()
+        shutil.rmtree(dataDir, ignore_errors=True)
+
+    summary = recorder.summary()
+    print("{:<18} {:>6} {:>9} {:>9} {:>9} {:>9}".format("operation (ms)", "count", "p50", "p90", "p99", "max"))
+    for name, stats in summary.items():
+        print("{:<18} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(name, stats["count"], stats["p50"], stats["p90"], stats["p99"], stats["max"]))
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "qpa": os.environ["QT_QPA_PLATFORM"],
+            "rows": args.rows,
+            "repeats": args.repeats,
+        },
+        "startup": startup,
+        "operations": summary,
+        "queryCache": queryCache,
+    }
+    with open(args.output, "w") as f:
+        f.write(json.dumps(results, indent=2))
+    print("Query cache: {hits} hits, {misses} misses, {invalidations} invalidations".format(**queryCache))
+    print("Results written to", args.output)
+
+if __name__ == "__main__": main()